@@ -0,0 +1,239 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from app.constants import ANCHOR_DB_PATH, ANCHOR_WINDOW, ANCHOR_MAX_BATCH
+
+def message_digest(message):
+    """Hex SHA-256 of a message, the value that gets anchored"""
+    return hashlib.sha256(message.encode()).hexdigest()
+
+def _leaf_hash(digest):
+    # Domain-separate leaves from inner nodes so a node can't pose as a leaf
+    return hashlib.sha256(b'\x00' + bytes.fromhex(digest)).digest()
+
+def _node_hash(left, right):
+    return hashlib.sha256(b'\x01' + left + right).digest()
+
+def _tree_levels(digests):
+    """All levels of the Merkle tree, leaves first; an unpaired node moves up as is"""
+    level = [_leaf_hash(d) for d in digests]
+    levels = [level]
+    while len(level) > 1:
+        level = [
+            _node_hash(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+            for i in range(0, len(level), 2)
+        ]
+        levels.append(level)
+    return levels
+
+def merkle_root(digests):
+    return _tree_levels(digests)[-1][0].hex()
+
+def merkle_proofs(digests):
+    """Return (root, proofs); proofs[i] lists [sibling hex, 'L' or 'R'] steps for leaf i"""
+    levels = _tree_levels(digests)
+    proofs = []
+    for index in range(len(digests)):
+        proof = []
+        position = index
+        for level in levels[:-1]:
+            sibling = position ^ 1
+            if sibling < len(level):
+                side = 'L' if sibling < position else 'R'
+                proof.append([level[sibling].hex(), side])
+            position //= 2
+        proofs.append(proof)
+    return levels[-1][0].hex(), proofs
+
+def verify_proof(digest, proof, root):
+    node = _leaf_hash(digest)
+    for sibling, side in proof:
+        sibling = bytes.fromhex(sibling)
+        node = _node_hash(sibling, node) if side == 'L' else _node_hash(node, sibling)
+    return node.hex() == root
+
+class FakeChain:
+    """In-process stand-in for the MessageStore contract"""
+
+    def __init__(self):
+        self.stored = set()
+        self.transactions = []
+        self.receipts = {}
+
+    def store_digest(self, digest):
+        return self.send_store(digest, len(self.transactions))
+
+    def verify_digest(self, digest):
+        return digest in self.stored
+
+    def pending_nonce(self):
+        return len(self.transactions)
+
+    def send_store(self, digest, nonce):
+        if nonce != len(self.transactions):
+            raise ValueError("nonce too low" if nonce < len(self.transactions) else "nonce gap")
+        self.stored.add(digest)
+        self.transactions.append(digest)
+        tx_hash = hashlib.sha256(f"tx-{nonce}".encode()).hexdigest()
+        self.receipts[tx_hash] = {'status': 1, 'blockNumber': nonce + 1}
+        return tx_hash
+
+    def get_receipt(self, tx_hash):
+        return self.receipts.get(tx_hash)
+
+class AnchorService:
+    """Batch message hashes into Merkle trees and anchor only the roots.
+
+    add() just queues a hash. Every `window` seconds (or once `max_batch`
+    hashes are pending) the batch is turned into a tree, its root is stored
+    on `chain` with one transaction and each message's inclusion proof is
+    saved in SQLite. verify() checks a message against its proof and asks
+    the chain about each root only once.
+    """
+
+    def __init__(self, chain, db_path=ANCHOR_DB_PATH, window=ANCHOR_WINDOW,
+                 max_batch=ANCHOR_MAX_BATCH, auto_flush=True):
+        self.chain = chain
+        self.db_path = db_path
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.verified_roots = set()
+        self.running = True
+        self.init_database()
+        self.flush_thread = None
+        if auto_flush:
+            self.flush_thread = threading.Thread(target=self._flush_loop)
+            self.flush_thread.daemon = True
+            self.flush_thread.start()
+
+    def init_database(self):
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS anchors (
+                    root TEXT PRIMARY KEY,
+                    tx_hash TEXT,
+                    leaf_count INTEGER NOT NULL,
+                    anchored_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                );
+                CREATE TABLE IF NOT EXISTS proofs (
+                    digest TEXT PRIMARY KEY,
+                    root TEXT NOT NULL,
+                    leaf_index INTEGER NOT NULL,
+                    proof TEXT NOT NULL
+                );
+            ''')
+
+    def add(self, message):
+        """Queue a message for the next anchored batch; returns its digest"""
+        digest = message_digest(message)
+        with self.lock:
+            self.pending.append(digest)
+            if len(self.pending) >= self.max_batch:
+                self.wakeup.set()
+        return digest
+
+    def _flush_loop(self):
+        while self.running:
+            self.wakeup.wait(self.window)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Anchoring error: {e}")
+
+    def flush(self):
+        """Anchor everything pending now; returns the root or None"""
+        with self.lock:
+            digests = list(dict.fromkeys(self.pending))
+            self.pending = []
+        if not digests:
+            return None
+        
+        root, proofs = merkle_proofs(digests)
+        # Record the batch before submitting it: in background mode status
+        # events for the root can arrive before store_digest returns
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute(
+                'INSERT OR IGNORE INTO anchors (root, tx_hash, leaf_count) VALUES (?, NULL, ?)',
+                (root, len(digests))
+            )
+            conn.executemany(
+                'INSERT OR REPLACE INTO proofs (digest, root, leaf_index, proof) VALUES (?, ?, ?, ?)',
+                [(d, root, i, json.dumps(p)) for i, (d, p) in enumerate(zip(digests, proofs))]
+            )
+        try:
+            tx_hash = self.chain.store_digest(root)
+        except Exception:
+            # Put the batch back so the next flush retries it under a new root
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute('DELETE FROM proofs WHERE root = ?', (root,))
+                conn.execute('DELETE FROM anchors WHERE root = ? AND tx_hash IS NULL', (root,))
+            with self.lock:
+                self.pending[:0] = digests
+            raise
+        if hasattr(tx_hash, 'hex'):
+            tx_hash = tx_hash.hex()
+        if tx_hash is not None:
+            self._set_tx_hash(root, tx_hash)
+        return root
+
+    def _set_tx_hash(self, root, tx_hash):
+        # A recorded transaction hash is never overwritten
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute('UPDATE anchors SET tx_hash = ? WHERE root = ? AND tx_hash IS NULL',
+                         (tx_hash, root))
+
+    def record_status(self, event):
+        """Apply a submission pipeline event for an anchored root"""
+        root = event['digest']
+        if event['status'] == 'failed' and event.get('tx_hash'):
+            # Reverted; a resubmission records its own transaction
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute('UPDATE anchors SET tx_hash = NULL WHERE root = ? AND tx_hash = ?',
+                             (root, event['tx_hash']))
+        elif event.get('tx_hash'):
+            self._set_tx_hash(root, event['tx_hash'])
+        if event['status'] == 'confirmed':
+            # Mined: verify() need not ask the node about this root
+            self.verified_roots.add(root)
+
+    def get_proof(self, message):
+        """Return (root, proof) for an anchored message, or None"""
+        with sqlite3.connect(self.db_path) as conn:
+            row = conn.execute(
+                'SELECT root, proof FROM proofs WHERE digest = ?',
+                (message_digest(message),)
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def verify(self, message):
+        """True if the message is in a batch whose root is on chain"""
+        found = self.get_proof(message)
+        if found is None:
+            return False
+        root, proof = found
+        if not verify_proof(message_digest(message), proof, root):
+            return False
+        if root not in self.verified_roots:
+            if not self.chain.verify_digest(root):
+                return False
+            self.verified_roots.add(root)
+        return True
+
+    def close(self):
+        """Stop the flush thread and anchor what is still pending"""
+        self.running = False
+        self.wakeup.set()
+        if self.flush_thread is not None:
+            self.flush_thread.join()
+            self.flush_thread = None
+        self.flush()
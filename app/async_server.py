@@ -0,0 +1,181 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+from app.constants import RECV_SIZE, WORKER_MAX_PENDING, BACKPRESSURE_TIMEOUT
+from app.codec import wire_format
+from app.framing import FrameDecoder, FrameError
+from app.outbound import AsyncOutboundQueue
+from app.server import SecureServer, CLIENT_SEND
+
+class AsyncSecureServer(SecureServer):
+    """SecureServer running every connection as a coroutine on one event loop.
+
+    Speaks the same framed JSON protocol as the threaded engine and reuses
+    its SSL context and message handling; only the socket I/O is replaced
+    by asyncio streams. The loop only frames and dispatches: messages are
+    handled on the worker pool, and whatever they send is handed back to
+    the loop, which owns the outbound queues and the transports.
+    """
+
+    def setup_server(self):
+        super().setup_server()
+        # asyncio.start_server opens its own listening socket
+        self.sock.close()
+        self.server = None
+        # Clients whose queue a backpressure put overfilled
+        self.overfull = set()
+
+    def on_loop(self):
+        return threading.get_ident() == self.loop_thread
+
+    def send_raw(self, client, data):
+        if client.is_closing():
+            raise ConnectionError("Connection closed")
+        client.write(data)
+
+    def close_client(self, client):
+        client.close()
+
+    def open_outbound(self, client):
+        queue = AsyncOutboundQueue(self.queue_size, self.slow_policy)
+        self.outbound[client] = queue
+        queue.task = asyncio.ensure_future(self.write_loop(client, queue))
+
+    async def write_loop(self, client, queue):
+        while True:
+            data = await queue.get()
+            if data is None:
+                break
+            try:
+                start = time.perf_counter()
+                self.send_raw(client, data)
+                await client.drain()
+                CLIENT_SEND.observe(time.perf_counter() - start)
+            except Exception:
+                self.remove_client(client)
+                break
+
+    def enqueue(self, client, data):
+        if self.on_loop():
+            return self.enqueue_on_loop(client, data)
+        # Frames posted by one thread keep their order on the loop
+        self.loop.call_soon_threadsafe(self.enqueue_or_drop, client, data)
+        return True
+
+    def enqueue_on_loop(self, client, data):
+        queue = self.outbound.get(client)
+        if queue is None or not queue.put(data):
+            return False
+        if queue.overfull():
+            self.overfull.add(client)
+        return True
+
+    def enqueue_or_drop(self, client, data):
+        if not self.enqueue_on_loop(client, data):
+            if client in self.clients:
+                print(f"[-] Dropping slow client: {self.clients[client]}")
+            self.remove_client(client)
+
+    def broadcast_frames(self, make_frame, clients=None):
+        if self.on_loop():
+            super().broadcast_frames(make_frame, clients)
+            return
+        # Encode on the calling worker, then fan out in a single loop callback
+        if clients is None:
+            clients = list(self.clients)
+        encoded = {}
+        for client in clients:
+            wire = self.formats.get(client, wire_format())
+            if wire not in encoded:
+                encoded[wire] = make_frame(wire)
+        frame = lambda wire: encoded[wire] if wire in encoded else make_frame(wire)
+        self.loop.call_soon_threadsafe(super().broadcast_frames, frame, clients)
+
+    def remove_client(self, client):
+        if self.on_loop():
+            self.overfull.discard(client)
+            super().remove_client(client)
+        else:
+            self.loop.call_soon_threadsafe(super().remove_client, client)
+
+    def wait_for_room(self, client):
+        queue = self.outbound.get(client)
+        if queue is None:
+            return False
+        future = asyncio.run_coroutine_threadsafe(
+            queue.wait_below(max(1, self.queue_size // 2)), self.loop)
+        try:
+            return future.result(BACKPRESSURE_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            return False
+
+    async def apply_backpressure(self):
+        """Wait for overfull queues to drain, dropping clients that stay stuck"""
+        for client in list(self.overfull):
+            queue = self.outbound.get(client)
+            if queue is not None and not await queue.wait_for_space():
+                if client in self.clients:
+                    print(f"[-] Dropping slow client: {self.clients[client]}")
+                self.remove_client(client)
+            self.overfull.discard(client)
+
+    async def handle_connection(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        print(f"[+] New connection from {addr}")
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = await reader.read(RECV_SIZE)
+                if not data:
+                    # Let frames already dispatched finish before cleanup
+                    if self.workers.pending(writer):
+                        await self.loop.run_in_executor(None, self.workers.wait, writer, 0)
+                    break
+
+                decoder.feed(data)
+                for frame in decoder:
+                    try:
+                        if not self.handle_frame(writer, decoder, frame):
+                            return
+                    except Exception as e:
+                        print(f"Error handling client message: {e}")
+                        return
+                await self.apply_backpressure()
+                if self.workers.pending(writer) > WORKER_MAX_PENDING:
+                    await self.loop.run_in_executor(
+                        None, self.workers.wait, writer, WORKER_MAX_PENDING)
+
+        except asyncio.CancelledError:
+            # Server shutting down
+            pass
+        except FrameError as e:
+            print(f"Framing error from {addr}: {e}")
+        except Exception as e:
+            print(f"Client handler error: {e}")
+        finally:
+            self.remove_client(writer)
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.server = await asyncio.start_server(
+            self.handle_connection,
+            self.host,
+            self.port,
+            ssl=self.context,
+            reuse_address=True,
+            reuse_port=self.reuse_port
+        )
+        self.print_server_info()
+        async with self.server:
+            await self.server.serve_forever()
+
+    def start(self):
+        try:
+            asyncio.run(self.serve())
+        except Exception as e:
+            print(f"Server error: {e}")
+        finally:
+            self.running = False
@@ -0,0 +1,117 @@
+import hashlib
+import mmap
+import os
+import time
+from app.constants import BLOB_DIR, FILE_CHUNK_SIZE, UPLOAD_EXPIRY, UPLOAD_SWEEP_INTERVAL
+
+def valid_digest(digest):
+    """True for a lowercase hex SHA-256 digest"""
+    return (isinstance(digest, str) and len(digest) == 64
+            and all(c in '0123456789abcdef' for c in digest))
+
+class BlobUpload:
+    """A file being uploaded into the store, written strictly in order"""
+
+    def __init__(self, path, offset=0):
+        self.path = path
+        mode = 'r+b' if os.path.exists(path) else 'w+b'
+        self.file = open(path, mode)
+        # Resuming: keep what was already received up to offset
+        self.digest = hashlib.sha256()
+        self.size = 0
+        have = os.fstat(self.file.fileno()).st_size
+        self.file.seek(0)
+        while self.size < min(offset, have):
+            data = self.file.read(min(FILE_CHUNK_SIZE, min(offset, have) - self.size))
+            self.digest.update(data)
+            self.size += len(data)
+        self.file.truncate(self.size)
+
+    def write(self, offset, data):
+        if offset != self.size:
+            raise ValueError(f"Expected offset {self.size}, got {offset}")
+        self.file.write(data)
+        self.digest.update(data)
+        self.size += len(data)
+
+    def close(self):
+        self.file.close()
+
+class BlobStore:
+    """Files stored once on disk under the SHA-256 of their content.
+
+    Blobs live at <root>/ab/cd/abcd...; in-progress uploads live in
+    <root>/tmp until their hash is known. Partial uploads nobody has
+    touched for UPLOAD_EXPIRY seconds are deleted, at startup and then
+    at most every UPLOAD_SWEEP_INTERVAL seconds as new uploads open.
+    """
+
+    def __init__(self, root=BLOB_DIR):
+        self.root = root
+        self.tmp_dir = os.path.join(root, 'tmp')
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self.expire_uploads()
+
+    def path_for(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def exists(self, digest):
+        return valid_digest(digest) and os.path.exists(self.path_for(digest))
+
+    def size(self, digest):
+        return os.path.getsize(self.path_for(digest))
+
+    def expire_uploads(self, keep=()):
+        """Delete stale partial uploads, except the upload ids in keep"""
+        self.swept = time.monotonic()
+        cutoff = time.time() - UPLOAD_EXPIRY
+        for name in os.listdir(self.tmp_dir):
+            if not name.endswith('.part') or name[:-len('.part')] in keep:
+                continue
+            path = os.path.join(self.tmp_dir, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def open_upload(self, upload_id, offset=0, active=()):
+        """Start or resume an upload; upload_id must be a validated transfer id.
+
+        active holds the ids of uploads still in progress, which a sweep
+        never deletes however long they have been idle.
+        """
+        if time.monotonic() - self.swept >= UPLOAD_SWEEP_INTERVAL:
+            self.expire_uploads(set(active) | {upload_id})
+        return BlobUpload(os.path.join(self.tmp_dir, f"{upload_id}.part"), offset)
+
+    def commit(self, upload, expected_digest=None):
+        """Move a finished upload into place and return its digest.
+
+        Content that is already stored is not written twice.
+        """
+        upload.file.flush()
+        os.fsync(upload.file.fileno())
+        upload.close()
+        digest = upload.digest.hexdigest()
+        if expected_digest and digest != expected_digest:
+            os.remove(upload.path)
+            raise ValueError("Checksum mismatch")
+        path = self.path_for(digest)
+        if os.path.exists(path):
+            os.remove(upload.path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(upload.path, path)
+        return digest
+
+    def iter_range(self, digest, offset=0, length=None, chunk_size=FILE_CHUNK_SIZE):
+        """Yield (offset, data) chunks of a blob, read through a memory map"""
+        with open(self.path_for(digest), 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            end = size if length is None else min(size, offset + length)
+            if offset >= end:
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for pos in range(offset, end, chunk_size):
+                    yield pos, data[pos:min(pos + chunk_size, end)]
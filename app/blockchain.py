@@ -1,24 +1,90 @@
 import json
 from web3 import Web3
+from web3.exceptions import TransactionNotFound
 import hashlib
 import os
+import requests
+from app.anchoring import AnchorService
+from app.submission import SubmissionPipeline
+from app.constants import CHAIN_URL, CHAIN_POOL_SIZE
+
+def make_provider(url=CHAIN_URL, pool_size=CHAIN_POOL_SIZE):
+    """HTTP provider that reuses keep-alive connections to the node"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return Web3.HTTPProvider(url, session=session)
 
 class BlockchainManager:
-    def __init__(self):
+    def __init__(self, anchor_window=None, background=False, on_status=None):
         with open(os.path.join("app/contracts/deploy_config.json")) as f:
             data = json.load(f)
-        self.w3 = Web3(Web3.HTTPProvider("http://127.0.0.1:7545"))
+        self.w3 = Web3(make_provider())
         self.contract = self.w3.eth.contract(
             address=data["address"],
             abi=data["abi"]
         )
         self.account = data["account"]
+        self.on_status = on_status
+        # In background mode transactions are sent by a pipeline thread and
+        # store_digest returns immediately
+        self.pipeline = None
+        if background:
+            self.pipeline = SubmissionPipeline(self, on_status=self._on_status)
+        # With a window, messages are anchored in batches as Merkle roots
+        self.anchor = None
+        if anchor_window:
+            self.anchor = AnchorService(self, window=anchor_window)
+
+    def _on_status(self, event):
+        if self.anchor is not None:
+            self.anchor.record_status(event)
+        if self.on_status is not None:
+            self.on_status(event)
+
+    def pending_nonce(self):
+        return self.w3.eth.get_transaction_count(self.account, "pending")
+
+    def send_store(self, h, nonce):
+        return self.contract.functions.storeHash(h).transact({"from": self.account, "nonce": nonce})
+
+    def get_receipt(self, tx_hash):
+        try:
+            return self.w3.eth.get_transaction_receipt(tx_hash)
+        except TransactionNotFound:
+            return None
+
+    def store_digest(self, h):
+        """Store a hex digest on chain; queued when running in background mode"""
+        if self.pipeline is not None:
+            self.pipeline.submit(h)
+            return None
+        return self.contract.functions.storeHash(h).transact({"from": self.account})
+
+    def verify_digest(self, h):
+        return self.contract.functions.verifyHash(h).call()
 
     def store_hash(self, message):
+        if self.anchor is not None:
+            return self.anchor.add(message)
         h = hashlib.sha256(message.encode()).hexdigest()
-        tx = self.contract.functions.storeHash(h).transact({"from": self.account})
-        return tx
+        return self.store_digest(h)
 
     def verify_hash(self, message):
+        if self.anchor is not None:
+            return self.anchor.verify(message)
         h = hashlib.sha256(message.encode()).hexdigest()
-        return self.contract.functions.verifyHash(h).call()
+        return self.verify_digest(h)
+
+    def verify_hash_async(self, message):
+        """verify_hash on a pool thread; returns a Future"""
+        if self.pipeline is None:
+            raise RuntimeError("verify_hash_async needs background=True")
+        return self.pipeline.call(self.verify_hash, message)
+
+    def close(self):
+        if self.anchor is not None:
+            self.anchor.close()
+        if self.pipeline is not None:
+            self.pipeline.close()
@@ -0,0 +1,230 @@
+import json
+import os
+import socket
+import threading
+import time
+from app.constants import RECV_SIZE, BUS_RECONNECT_INTERVAL
+from app.framing import FrameDecoder, FrameError, encode_frame, LENGTH
+from app.presence import Presence
+
+# Bus message types
+PUBLISH = 'publish'  # deliver a message to the clients of every other shard,
+                     # or only to the given users or room members there
+JOIN = 'join'        # a user logged in on the sending shard
+LEAVE = 'leave'      # a user left the sending shard
+
+def _encode(message):
+    return encode_frame(json.dumps(message).encode(), LENGTH)
+
+def _read_messages(sock):
+    """Yield bus messages from a connected socket until it closes"""
+    decoder = FrameDecoder(LENGTH)
+    while True:
+        data = sock.recv(RECV_SIZE)
+        if not data:
+            return
+        decoder.feed(data)
+        for frame in decoder:
+            yield json.loads(frame)
+
+class BusBroker:
+    """Local pub/sub hub connecting the shards of one server.
+
+    Shards connect over a Unix domain socket. Published messages are relayed
+    to every other shard, and the broker owns the roster of logged-in users:
+    joins and leaves are applied to a single Presence here and its versioned
+    events are sent to all shards, so every client sees the same list.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.shards = {}  # {connection: usernames logged in on that shard}
+        self.lock = threading.Lock()
+        self.presence = Presence(on_events=self._presence_events)
+        self.running = True
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen()
+        accept_thread = threading.Thread(target=self._accept_loop)
+        accept_thread.daemon = True
+        accept_thread.start()
+
+    def _accept_loop(self):
+        while self.running:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                break
+            with self.lock:
+                self.shards[conn] = []
+                # New shards start from a snapshot and then follow the deltas
+                self._send([conn], {'type': PUBLISH, 'message': self.presence.snapshot()})
+            shard_thread = threading.Thread(target=self._shard_loop, args=(conn,))
+            shard_thread.daemon = True
+            shard_thread.start()
+
+    def _send(self, conns, message):
+        data = _encode(message)
+        for conn in conns:
+            try:
+                conn.sendall(data)
+            except OSError:
+                pass
+
+    def _presence_events(self, events):
+        with self.lock:
+            for event in events:
+                self._send(list(self.shards), {'type': PUBLISH, 'message': event})
+
+    def _shard_loop(self, conn):
+        try:
+            for message in _read_messages(conn):
+                with self.lock:
+                    if message['type'] == PUBLISH:
+                        self._send([c for c in self.shards if c is not conn], message)
+                    elif message['type'] == JOIN:
+                        self.shards[conn].append(message['username'])
+                        self.presence.join(message['username'])
+                    elif message['type'] == LEAVE:
+                        if message['username'] in self.shards[conn]:
+                            self.shards[conn].remove(message['username'])
+                            self.presence.leave(message['username'])
+        except (OSError, FrameError, ValueError) as e:
+            print(f"Bus shard error: {e}")
+        finally:
+            with self.lock:
+                # A crashed shard takes its users with it
+                for username in self.shards.pop(conn, []):
+                    self.presence.leave(username)
+            conn.close()
+
+    def close(self):
+        self.running = False
+        self.presence.close()
+        self.sock.close()
+        with self.lock:
+            for conn in self.shards:
+                conn.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+class BusClient:
+    """A shard's connection to the BusBroker.
+
+    If the broker goes away, sends are dropped (returning False) rather
+    than raised, so the shard keeps serving its own clients, and a
+    background thread reconnects. on_reconnect(attach) is then called;
+    sends keep being dropped until it calls attach(), so the shard can
+    switch over and announce its users again atomically with its logins.
+    """
+
+    def __init__(self, path, on_message, on_reconnect=None):
+        self.path = path
+        self.on_message = on_message
+        self.on_reconnect = on_reconnect
+        self.send_lock = threading.Lock()
+        self.closed = False
+        self.reconnecting = False
+        self.sock = None
+        self._attach(self._open())
+
+    def _open(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def _attach(self, sock):
+        with self.send_lock:
+            if self.closed:
+                sock.close()
+                return
+            self.sock = sock
+        receive_thread = threading.Thread(target=self._receive_loop, args=(sock,))
+        receive_thread.daemon = True
+        receive_thread.start()
+
+    def send(self, message):
+        """Send to the broker; False if the bus is down and the message was dropped"""
+        data = _encode(message)
+        with self.send_lock:
+            if self.sock is None:
+                return False
+            try:
+                self.sock.sendall(data)
+                return True
+            except OSError as e:
+                print(f"Bus send failed: {e}")
+                self._lost(self.sock)
+                return False
+
+    def _lost(self, sock):
+        # Called with send_lock held
+        if self.sock is not sock or self.closed:
+            return
+        print("[-] Lost connection to the server bus; delivering locally until it is back")
+        self.sock = None
+        try:
+            sock.close()
+        except OSError:
+            pass
+        if not self.reconnecting:
+            self.reconnecting = True
+            reconnect_thread = threading.Thread(target=self._reconnect_loop)
+            reconnect_thread.daemon = True
+            reconnect_thread.start()
+
+    def _reconnect_loop(self):
+        while not self.closed:
+            time.sleep(BUS_RECONNECT_INTERVAL)
+            try:
+                sock = self._open()
+            except OSError:
+                continue
+            self.reconnecting = False
+            print("[+] Reconnected to the server bus")
+            attach = lambda: self._attach(sock)
+            if self.on_reconnect is not None:
+                self.on_reconnect(attach)
+            else:
+                attach()
+            return
+        self.reconnecting = False
+
+    def publish(self, message, users=None, room=None):
+        bus_message = {'type': PUBLISH, 'message': message}
+        if users is not None:
+            bus_message['users'] = users
+        if room is not None:
+            bus_message['room'] = room
+        return self.send(bus_message)
+
+    def _receive_loop(self, sock):
+        try:
+            for message in _read_messages(sock):
+                if message['type'] == PUBLISH:
+                    self.on_message(message['message'], message.get('users'), message.get('room'))
+        except (OSError, FrameError, ValueError) as e:
+            if self.closed:
+                return
+            print(f"Bus error: {e}")
+        with self.send_lock:
+            self._lost(sock)
+
+    def close(self):
+        with self.send_lock:
+            self.closed = True
+            sock, self.sock = self.sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
@@ -1,24 +1,48 @@
 import socket, ssl
-import json
 import threading
 import base64
 import os
 import argparse
 from app.crypto import CryptoHandler
+from app.constants import RECV_SIZE, BLOB_RANGE_SIZE, HISTORY_VIEW_PAGE_SIZE
+from app.framing import FrameDecoder, LINE, LENGTH, FRAMING_MODES
+from app.codec import (
+    wire_format, available_codecs, available_compressions, JSON, CODECS, COMPRESSIONS
+)
+from app.filetransfer import (
+    FILE_TRANSFER_TYPES, decode_message, encode_chunk, verify_chunk,
+    new_transfer_id, iter_file_chunks, file_sha256
+)
+from app.localhistory import LocalHistory, local_history_path
 from app.gui import ChatGUI, LoginWindow
 
 class SecureClient:
-    def __init__(self, username, server_ip='127.0.0.1', port=9999):
+    def __init__(self, username, server_ip='127.0.0.1', port=9999, framing=LINE,
+                 codec=JSON, compression=None, local_history=True):
         self.username = username
         self.server_ip = server_ip
         self.port = port
+        self.requested_framing = framing
+        self.framing = LINE
+        self.requested_codec = codec
+        self.requested_compression = compression
+        self.wire = wire_format()
         self.running = True
         self.message_queue = []
+        # Called from the receiver thread after new messages are queued
+        # and when the connection drops
+        self.on_receive = None
         self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
         self.connected = False
+        self.incoming = {}  # {transfer id: partially received file}
         
         # Create downloads directory
         os.makedirs('downloads', exist_ok=True)
+        # History already fetched survives restarts; only newer rows are synced
+        self.local_history = None
+        if local_history:
+            self.local_history = LocalHistory(local_history_path(username, server_ip, port))
         
         # Connect to server
         if not self.connect():
@@ -26,7 +50,8 @@ class SecureClient:
 
     def connect(self):
         try:
-            self.context = ssl.create_default_context()
+            # Certificates are not verified, so skip loading the system CA store
+            self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
             self.context.check_hostname = False
             self.context.verify_mode = ssl.CERT_NONE
             
@@ -34,12 +59,24 @@ class SecureClient:
             self.ssl_sock = self.context.wrap_socket(self.sock, server_hostname=self.server_ip)
             self.ssl_sock.connect((self.server_ip, self.port))
             
-            # Send login info
+            # Send login info, always as a JSON line
+            self.framing = LINE
+            self.wire = wire_format()
             login_message = {
                 'type': 'login',
                 'username': self.username
             }
+            if self.requested_framing != LINE:
+                login_message['framing'] = self.requested_framing
+            # Offer a compact codec; the server answers with a welcome message
+            if self.requested_framing == LENGTH:
+                if self.requested_codec != JSON and self.requested_codec in available_codecs():
+                    login_message['codecs'] = [self.requested_codec, JSON]
+                if self.requested_compression in available_compressions():
+                    login_message['compression'] = [self.requested_compression]
             self.send_message(login_message)
+            self.framing = self.requested_framing
+            self.wire = wire_format(self.framing)
             
             self.connected = True
             
@@ -48,6 +85,11 @@ class SecureClient:
             self.receiver_thread.daemon = True
             self.receiver_thread.start()
             
+            # Catch up on what was missed since the last session
+            if self.local_history is not None:
+                self.local_history.reset()
+                self.sync_history()
+            
             return True
             
         except Exception as e:
@@ -61,8 +103,17 @@ class SecureClient:
                     'type': 'chat',
                     'message': message
                 }
-            data = json.dumps(message).encode() + b'\n'
-            self.ssl_sock.sendall(data)
+            return self.send_frame(self.wire.encode(message))
+        except Exception as e:
+            print(f"Send error: {e}")
+            return False
+
+    def send_frame(self, data):
+        """Send an already-encoded frame"""
+        try:
+            # The GUI and receiver threads both send; keep frames whole
+            with self.send_lock:
+                self.ssl_sock.sendall(data)
             return True
         except Exception as e:
             print(f"Send error: {e}")
@@ -70,23 +121,41 @@ class SecureClient:
             return False
 
     def _receive_messages(self):
-        buffer = ""
+        decoder = FrameDecoder(self.framing)
         while self.running and self.connected:
             try:
-                chunk = self.ssl_sock.recv(4096)
+                chunk = self.ssl_sock.recv(RECV_SIZE)
                 if not chunk:
                     break
                 
-                buffer += chunk.decode('utf-8')
-                while '\n' in buffer:
-                    message_str, buffer = buffer.split('\n', 1)
-                    if message_str:
-                        try:
-                            message = json.loads(message_str)
-                            with self.lock:
-                                self.message_queue.append(message)
-                        except json.JSONDecodeError as e:
-                            print(f"Invalid message format: {e}")
+                decoder.feed(chunk)
+                received = False
+                for frame in decoder:
+                    try:
+                        message = decode_message(frame)
+                    except ValueError as e:
+                        print(f"Invalid message format: {e}")
+                        continue
+                    if message['type'] == 'welcome':
+                        # Everything we send from now on uses the negotiated format
+                        self.wire = wire_format(self.framing, message['codec'],
+                                                message.get('compression'))
+                        continue
+                    # History for the local mirror is stored before the GUI sees it
+                    if (message['type'] in ('history_chunk', 'history_end')
+                            and self.local_history is not None):
+                        self.local_history.receive(message)
+                    # File chunks go straight to disk, not through the queue
+                    if message['type'] in FILE_TRANSFER_TYPES:
+                        message = self.handle_file_transfer(message)
+                        if message is None:
+                            continue
+                    with self.lock:
+                        self.message_queue.append(message)
+                    received = True
+                # One notification per received chunk, however many messages it held
+                if received and self.on_receive is not None:
+                    self.on_receive()
                 
             except Exception as e:
                 print(f"Receive error: {e}")
@@ -94,13 +163,21 @@ class SecureClient:
         
         self.connected = False
         self.running = False
+        if self.on_receive is not None:
+            self.on_receive()
 
     def check_messages(self):
         with self.lock:
-            messages = self.message_queue.copy()
-            self.message_queue.clear()
+            messages, self.message_queue = self.message_queue, []
         return messages
 
+    def post_local(self, message):
+        """Queue a message produced on this side, such as upload progress, for the GUI"""
+        with self.lock:
+            self.message_queue.append(message)
+        if self.on_receive is not None:
+            self.on_receive()
+
     def is_connected(self):
         return self.connected
 
@@ -113,30 +190,133 @@ class SecureClient:
         except:
             pass
 
-    def send_file(self, filepath):
+    def send_file(self, filepath, offset=0, transfer_id=None, progress=None):
+        """Stream a file in chunks; pass transfer_id and offset to resume.
+
+        progress, if given, is called with (bytes sent, size) after each
+        chunk. Returns the transfer id on success, False otherwise.
+        """
         try:
-            # Read file in binary mode
+            filename = os.path.basename(filepath)
+            transfer_id = transfer_id or new_transfer_id()
             with open(filepath, 'rb') as file:
-                file_data = base64.b64encode(file.read()).decode('utf-8')
-                filename = os.path.basename(filepath)
-                
-                # Create file message
-                message = {
-                    'type': 'file',
+                size = os.fstat(file.fileno()).st_size
+                if not self.send_message({
+                    'type': 'file_begin',
+                    'transfer_id': transfer_id,
                     'filename': filename,
-                    'file_data': file_data
-                }
+                    'size': size,
+                    'offset': offset
+                }):
+                    return False
+                
+                # When resuming, hash the part that was already sent
+                digest = file_sha256(file, offset)
+                for chunk_offset, data in iter_file_chunks(file, offset):
+                    digest.update(data)
+                    if not self.send_frame(encode_chunk(transfer_id, chunk_offset, data, self.framing)):
+                        return False
+                    if progress is not None:
+                        progress(chunk_offset + len(data), size)
                 
-                # Send the message
-                success = self.send_message(message)
+                success = self.send_message({
+                    'type': 'file_end',
+                    'transfer_id': transfer_id,
+                    'size': size,
+                    'sha256': digest.hexdigest()
+                })
                 if success:
                     print(f"File sent: {filename}")
-                return success
+                    return transfer_id
+                return False
                 
         except Exception as e:
             print(f"Error sending file: {e}")
             return False
 
+    def download_file(self, sha256, filename=None):
+        """Fetch a shared file from the server, resuming a partial download"""
+        part_path = os.path.join('downloads', f"{sha256[:32]}.part")
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        return self.request_blob_range(sha256, offset, filename)
+
+    def request_blob_range(self, sha256, offset, filename=None):
+        return self.send_message({
+            'type': 'blob_request',
+            'sha256': sha256,
+            'offset': offset,
+            'length': BLOB_RANGE_SIZE,
+            'filename': filename
+        })
+
+    def handle_file_transfer(self, message):
+        """Write a downloaded file range to disk as it arrives.
+
+        Returns a message for the GUI when a file completes, otherwise None.
+        Data is kept in downloads/<transfer id>.part until the whole file
+        has arrived and its hash matches, so an interrupted download resumes
+        from where it stopped.
+        """
+        transfer_id = message['transfer_id']
+        if message['type'] == 'file_begin':
+            if transfer_id not in self.incoming:
+                part_path = os.path.join('downloads', f"{transfer_id}.part")
+                mode = 'r+b' if os.path.exists(part_path) else 'w+b'
+                self.incoming[transfer_id] = {
+                    'file': open(part_path, mode),
+                    'part_path': part_path,
+                    'filename': os.path.basename(message['filename'])
+                }
+            return None
+        
+        transfer = self.incoming.get(transfer_id)
+        if transfer is None:
+            return None
+        
+        if message['type'] == 'file_chunk':
+            if not verify_chunk(message):
+                print(f"Corrupt chunk for {transfer['filename']} at offset {message['offset']}")
+                transfer['file'].close()
+                del self.incoming[transfer_id]
+                return None
+            transfer['file'].seek(message['offset'])
+            transfer['file'].write(message['data'])
+            return None
+        
+        # file_end: ask for the next range until the whole file is here
+        if message['end'] < message['size']:
+            self.request_blob_range(message['sha256'], message['end'], transfer['filename'])
+            return None
+        
+        # Check the whole file before moving it into place
+        del self.incoming[transfer_id]
+        file = transfer['file']
+        file.truncate(message['size'])
+        digest = file_sha256(file).hexdigest()
+        file.close()
+        if digest != message['sha256']:
+            print(f"Checksum mismatch for {transfer['filename']}")
+            os.remove(transfer['part_path'])
+            return None
+        filepath = self._download_path(transfer['filename'])
+        os.replace(transfer['part_path'], filepath)
+        print(f"File saved: {filepath}")
+        return {
+            'type': 'file_saved',
+            'filename': transfer['filename'],
+            'path': filepath
+        }
+
+    def _download_path(self, filename):
+        """Pick a path in downloads/ that does not overwrite an existing file"""
+        base, ext = os.path.splitext(filename)
+        filepath = os.path.join('downloads', filename)
+        counter = 1
+        while os.path.exists(filepath):
+            filepath = os.path.join('downloads', f"{base} ({counter}){ext}")
+            counter += 1
+        return filepath
+
     def save_file(self, filename, file_data):
         try:
             # Create downloads directory if it doesn't exist
@@ -155,11 +335,86 @@ class SecureClient:
             print(f"Error saving file: {e}")
             return None
 
-    def request_history(self):
-        """Request chat history from server"""
-        self.send_message({
+    def send_direct(self, username, text):
+        """Send a chat message only to one user"""
+        return self.send_message({'type': 'chat', 'message': text, 'to': username})
+
+    def send_to_room(self, room, text):
+        """Send a chat message to a room's members, joining it first if needed"""
+        return self.send_message({'type': 'chat', 'message': text, 'room': room})
+
+    def join_room(self, room):
+        return self.send_message({'type': 'join_room', 'room': room})
+
+    def leave_room(self, room):
+        return self.send_message({'type': 'leave_room', 'room': room})
+
+    def request_room_history(self, room, before_id=None, limit=None):
+        """Request one page of a room's history, older than before_id"""
+        message = {'type': 'history_request', 'room': room}
+        if before_id is not None:
+            message['before_id'] = before_id
+        if limit is not None:
+            message['limit'] = limit
+        return self.send_message(message)
+
+    def search(self, query, sender=None, room=None, since=None, until=None,
+               offset=0, limit=None):
+        """Ask the server for messages matching every word of query, best first.
+
+        The answer is a search_results message; its results are (id, sender,
+        receiver, message_type, content, timestamp, file_path, snippet) and
+        next_offset, if not None, fetches the next page. since and until are
+        'YYYY-MM-DD HH:MM:SS' UTC timestamps.
+        """
+        message = {'type': 'search_request', 'query': query}
+        for key, value in (('sender', sender), ('room', room), ('since', since),
+                           ('until', until), ('limit', limit)):
+            if value is not None:
+                message[key] = value
+        if offset:
+            message['offset'] = offset
+        return self.send_message(message)
+
+    def request_user_list(self):
+        """Ask for a full user list snapshot"""
+        return self.send_message({'type': 'user_list_request'})
+
+    def request_history(self, before_id=None, limit=None, stream=False, after_id=None):
+        """Request chat history from server, optionally the page older than before_id.
+
+        With stream=True the server answers with history_chunk messages and a
+        final history_end instead of a single chat_history page, and limit
+        may be None for as much as the server sends in one stream. A stream
+        with after_id returns the messages newer than it, oldest first.
+        """
+        message = {
             'type': 'history_request'
-        })
+        }
+        if stream:
+            message['stream'] = True
+        if before_id is not None:
+            message['before_id'] = before_id
+        if after_id is not None:
+            message['after_id'] = after_id
+        if limit is not None:
+            message['limit'] = limit
+        self.send_message(message)
+
+    def sync_history(self):
+        """Fetch the messages newer than the local mirror's high-water mark"""
+        _, newest = self.local_history.bounds()
+        if newest is None:
+            # Nothing mirrored yet; start with the newest page
+            self.fetch_older_history()
+        elif self.local_history.expect('after', newest):
+            self.request_history(after_id=newest, stream=True)
+
+    def fetch_older_history(self, limit=HISTORY_VIEW_PAGE_SIZE):
+        """Extend the local mirror by one page before its oldest message"""
+        oldest, _ = self.local_history.bounds()
+        if self.local_history.expect('before', oldest):
+            self.request_history(before_id=oldest, limit=limit, stream=True)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Secure Chat Client')
@@ -170,6 +425,17 @@ if __name__ == "__main__":
                        type=int,
                        default=9999,
                        help='Server port to connect to')
+    parser.add_argument('--framing',
+                       choices=FRAMING_MODES,
+                       default=LINE,
+                       help='Wire framing to negotiate at login')
+    parser.add_argument('--codec',
+                       choices=CODECS,
+                       default=JSON,
+                       help='Message encoding to negotiate (needs --framing length)')
+    parser.add_argument('--compression',
+                       choices=COMPRESSIONS,
+                       help='Compress large frames (needs --framing length)')
     
     args = parser.parse_args()
     
@@ -183,7 +449,9 @@ if __name__ == "__main__":
         success, username = login_window.mainloop()
         
         if success:
-            client = SecureClient(username, server_ip=args.server, port=args.port)
+            client = SecureClient(username, server_ip=args.server, port=args.port,
+                                  framing=args.framing, codec=args.codec,
+                                  compression=args.compression)
             chat_gui = ChatGUI(client)
             chat_gui.mainloop()
     except Exception as e:
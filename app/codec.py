@@ -0,0 +1,120 @@
+import json
+import zlib
+from app.constants import MAX_FRAME_SIZE, COMPRESS_THRESHOLD, ZLIB_LEVEL, ZSTD_LEVEL
+from app.framing import encode_frame, LINE, LENGTH
+
+# Both are optional; without them only JSON and zlib are offered
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Codecs, negotiated at login
+JSON = 'json'
+MSGPACK = 'msgpack'
+CODECS = (JSON, MSGPACK)
+
+# Per-frame compression, negotiated at login
+ZLIB = 'zlib'
+ZSTD = 'zstd'
+COMPRESSIONS = (ZLIB, ZSTD)
+
+# In length-prefixed framing the first payload byte says how to read it:
+# '{' is JSON, CHUNK_MAGIC (0x01) a binary file chunk, and then these.
+# Compressed payloads hold a complete JSON or msgpack payload.
+MSGPACK_MAGIC = b'\x02'
+ZLIB_MAGIC = b'\x03'
+ZSTD_MAGIC = b'\x04'
+
+def available_codecs():
+    return [JSON] + ([MSGPACK] if msgpack is not None else [])
+
+def available_compressions():
+    return [ZLIB] + ([ZSTD] if zstandard is not None else [])
+
+def negotiate(offered, available):
+    """First entry of the peer's preference list that we support"""
+    for name in offered or ():
+        if name in available:
+            return name
+    return None
+
+class WireFormat:
+    """How messages are encoded for one connection.
+
+    Binary codecs and compression need length-prefixed framing. Instances
+    are shared through wire_format(), so a broadcast is encoded once per
+    distinct format rather than once per client.
+    """
+
+    def __init__(self, framing=LINE, codec=JSON, compression=None,
+                 threshold=COMPRESS_THRESHOLD):
+        if codec not in CODECS:
+            raise ValueError(f"Unknown codec: {codec}")
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression: {compression}")
+        if framing != LENGTH and (codec != JSON or compression is not None):
+            raise ValueError("Binary codecs and compression need length framing")
+        self.framing = framing
+        self.codec = codec
+        self.compression = compression
+        self.threshold = threshold
+
+    def encode_payload(self, message):
+        if self.codec == MSGPACK:
+            payload = MSGPACK_MAGIC + msgpack.packb(message, use_bin_type=True)
+        else:
+            payload = json.dumps(message).encode()
+        # Small frames are sent as they are; compressing them costs more than it saves
+        if self.compression is None or len(payload) < self.threshold:
+            return payload
+        if self.compression == ZSTD:
+            return ZSTD_MAGIC + zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(payload)
+        return ZLIB_MAGIC + zlib.compress(payload, ZLIB_LEVEL)
+
+    def encode(self, message):
+        """Encode a message as a complete wire frame"""
+        return encode_frame(self.encode_payload(message), self.framing)
+
+_formats = {}
+
+def wire_format(framing=LINE, codec=JSON, compression=None):
+    key = (framing, codec, compression)
+    if key not in _formats:
+        _formats[key] = WireFormat(framing, codec, compression)
+    return _formats[key]
+
+def _decompress(payload):
+    marker = payload[:1]
+    if marker == ZLIB_MAGIC:
+        decompressor = zlib.decompressobj()
+        data = decompressor.decompress(payload[1:], MAX_FRAME_SIZE)
+        if decompressor.unconsumed_tail:
+            raise ValueError("Decompressed frame exceeds maximum size")
+        return data
+    if zstandard is None:
+        raise ValueError("zstd frame received but zstandard is not installed")
+    size = zstandard.frame_content_size(payload[1:])
+    if size < 0 or size > MAX_FRAME_SIZE:
+        raise ValueError("Decompressed frame exceeds maximum size")
+    return zstandard.ZstdDecompressor().decompress(payload[1:])
+
+def decode_payload(payload):
+    """Decode a JSON, msgpack or compressed payload into a message dict"""
+    if payload[:1] in (ZLIB_MAGIC, ZSTD_MAGIC):
+        payload = _decompress(payload)
+    if payload[:1] == MSGPACK_MAGIC:
+        if msgpack is None:
+            raise ValueError("msgpack frame received but msgpack is not installed")
+        try:
+            message = msgpack.unpackb(payload[1:], raw=False)
+        except Exception as e:
+            raise ValueError(f"Invalid msgpack frame: {e}")
+        if not isinstance(message, dict):
+            raise ValueError("Message is not a map")
+        return message
+    return json.loads(payload)
@@ -1,4 +1,87 @@
 # Network constants
 BUFFER_SIZE = 1024 * 1024  # 1MB buffer size
+RECV_SIZE = 64 * 1024  # bytes read per recv() call
+MAX_FRAME_SIZE = 64 * 1024 * 1024  # largest single protocol frame
 DEFAULT_SERVER = '127.0.0.1'
-DEFAULT_PORT = 9999 
\ No newline at end of file
+DEFAULT_PORT = 9999
+CERT_PATH = "app/certs/server.pem"  # server TLS certificate and key
+
+# Codec constants
+COMPRESS_THRESHOLD = 1024  # payloads smaller than this are never compressed
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# GUI constants
+CHAT_SCROLLBACK_LINES = 100000  # chat lines kept in memory; only the visible ones are drawn
+HISTORY_VIEW_PAGE_SIZE = 500  # rows the history window loads each time it nears the top
+UPLOAD_PROGRESS_INTERVAL = 0.1  # seconds between upload progress updates in the status bar
+
+# Outbound queue constants
+OUTBOUND_QUEUE_SIZE = 1000  # frames buffered per client before the slow-client policy applies
+BACKPRESSURE_TIMEOUT = 5.0  # seconds a sender waits for a full queue to drain
+
+# Presence constants
+PRESENCE_WINDOW = 0.2  # seconds of joins and leaves coalesced into one update
+
+# Sharding constants
+BUS_SOCKET_PATH = "app/bus-{port}.sock"  # Unix socket linking the shards of one server
+BUS_RECONNECT_INTERVAL = 1.0  # seconds between attempts to reach a lost bus
+
+# Worker pool constants
+WORKER_POOL_SIZE = None  # handler workers; None means one per CPU core
+WORKER_MAX_PENDING = 64  # frames queued per client before its reads pause
+
+# Metrics constants
+METRICS_HOST = "127.0.0.1"  # the metrics endpoint is only reachable locally
+HISTOGRAM_PRECISION_BITS = 5  # latency quantiles are accurate to within 1/16
+PROFILE_INTERVAL = 0.005  # seconds between profiler stack samples
+
+# Database constants
+DB_PATH = "app/chat_history.db"
+WRITE_BATCH_SIZE = 500  # messages per group commit
+WRITE_FLUSH_INTERVAL = 0.05  # seconds a message may wait before being committed
+DB_BUSY_TIMEOUT = 30.0  # seconds the writer waits on a locked database
+WRITE_MAX_RETRIES = 5  # failed commits of one batch before the writer gives up
+WRITE_RETRY_DELAY = 0.5  # seconds before retrying a failed commit, times the attempt
+HISTORY_PAGE_SIZE = 100  # default rows per history page
+MAX_HISTORY_PAGE_SIZE = 500
+MAX_HISTORY_STREAM_ROWS = 100000  # most rows sent by one streamed history_request
+MAX_HISTORY_STREAMS = 2  # history streams a client may have running or waiting
+HISTORY_CHUNK_SIZE = 200  # rows per history_chunk frame when streaming
+HISTORY_CACHE_ROWS = 2000  # recent messages kept in memory per channel
+HISTORY_CACHE_BYTES = 32 * 1024 * 1024  # approximate memory limit of the history cache
+LOCAL_HISTORY_PATH = "history/{username}@{server}-{port}.db"  # client-side mirror of fetched history
+SEARCH_PAGE_SIZE = 20  # default results per search page
+MAX_SEARCH_PAGE_SIZE = 200
+FTS_BACKFILL_CHUNK = 20000  # messages indexed per transaction by the backfill
+
+# File transfer constants
+FILE_CHUNK_SIZE = 64 * 1024  # raw bytes per file_chunk frame
+BLOB_DIR = "app/blobs"  # server-side content-addressed file store
+UPLOAD_EXPIRY = 24 * 3600  # seconds before an untouched partial upload is deleted
+UPLOAD_SWEEP_INTERVAL = 3600  # seconds between sweeps for expired partial uploads
+BLOB_RANGE_SIZE = 1024 * 1024  # largest range served per blob_request
+
+# Blockchain anchoring constants
+ANCHOR_DB_PATH = "app/anchors.db"  # Merkle proofs for anchored messages
+ANCHOR_WINDOW = 10.0  # seconds of message hashes batched into one anchored root
+ANCHOR_MAX_BATCH = 10000  # anchor early once this many hashes are pending
+CHAIN_URL = "http://127.0.0.1:7545"
+CHAIN_POOL_SIZE = 8  # keep-alive HTTP connections to the node
+CHAIN_MAX_IN_FLIGHT = 16  # transactions submitted but not yet mined
+CHAIN_MAX_RETRIES = 5
+CHAIN_RETRY_BACKOFF = 0.5  # seconds, doubled after each failed attempt
+CHAIN_POLL_INTERVAL = 1.0  # seconds between receipt polls
+CHAIN_MAX_RESUBMITS = 3  # times a failed digest is queued again
+CHAIN_RESUBMIT_DELAY = 30.0  # seconds before the first resubmission, doubled after each
+
+# Crypto constants
+SESSION_CACHE_SIZE = 1024  # peer sessions kept per CryptoHandler (LRU)
+SESSION_REKEY_MESSAGES = 100000  # new session key after this many messages
+SESSION_REKEY_SECONDS = 3600  # ...or after this long
+KEYRING_PATH = "app/keys/keyring.bin"  # encrypted store of identity keys
+KEYRING_PASSPHRASE_ENV = "CHAT_KEYRING_PASSPHRASE"
+KEY_POOL_SIZE = 4  # RSA keypairs generated ahead of time
+RSA_KEY_BITS = 2048
+ECDH_CURVE = "P-256"  # X25519 needs pycryptodome >= 3.21
+CRYPTO_PARALLEL_MIN = 64  # RSA operations per call before the process pool is used
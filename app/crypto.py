@@ -1,11 +1,164 @@
+import hashlib
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from Crypto.Cipher import PKCS1_OAEP, AES
-from Crypto.PublicKey import RSA
+from Crypto.Hash import SHA256
+from Crypto.Protocol.DH import key_agreement
+from Crypto.Protocol.KDF import HKDF
+from Crypto.PublicKey import RSA, ECC
 from Crypto.Random import get_random_bytes
+from app.constants import (
+    SESSION_CACHE_SIZE, SESSION_REKEY_MESSAGES, SESSION_REKEY_SECONDS, RSA_KEY_BITS, ECDH_CURVE,
+    CRYPTO_PARALLEL_MIN
+)
+from app.keystore import KeyRing, default_pool
+from app.workers import process_context
+
+# Session message layout:
+#   header: version, kind, session id, counter
+#   [key kinds only] key material length, then either the RSA-OAEP wrapped
+#   AES key or the sender's ephemeral ECDH public key
+#   GCM tag, ciphertext
+# The header (and wrapped key) are authenticated as GCM associated data.
+SESSION_VERSION = 1
+KIND_KEY = 1   # first message of a session, carries the wrapped key
+KIND_DATA = 2  # later messages, key looked up by session id
+KIND_ECDH = 3  # first message of a session, key agreed with ECDH
+KIND_MULTI = 4  # one body for many recipients, see encrypt_for_many
+_HEADER = struct.Struct('!BB8sQ')
+_KEY_LENGTH = struct.Struct('!H')
+_TAG_SIZE = 16
+
+# Multi-recipient envelope layout:
+#   version, kind, recipient count
+#   per recipient: key fingerprint, wrapped key length, RSA-OAEP wrapped key
+#   GCM nonce, GCM tag, ciphertext (header authenticated as associated data)
+_MULTI_HEADER = struct.Struct('!BBH')
+_FINGERPRINT_SIZE = 16
+_NONCE_SIZE = 12
+
+class SessionError(Exception):
+    """Raised when a session message cannot be decrypted.
+
+    An unknown session id means the receiver evicted or never saw the key
+    message; the sender should call reset_session() and send again.
+    """
+
+def key_fingerprint(pub_key):
+    return hashlib.sha256(pub_key.export_key(format='DER')).digest()[:16]
+
+class _LRU:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+
+    def get(self, key):
+        value = self.items.get(key)
+        if value is not None:
+            self.items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def pop(self, key):
+        return self.items.pop(key, None)
+
+def _ecdh_key(session_id, **keys):
+    return key_agreement(
+        kdf=lambda z: HKDF(z, 16, session_id, SHA256),
+        **keys
+    )
+
+_CORES = os.cpu_count() or 1
+_pool = None
+_pool_lock = threading.Lock()
+
+def _process_pool():
+    """Process pool for public-key RSA work, started on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=_CORES,
+                                        mp_context=process_context(['app.crypto']))
+        return _pool
+
+def _chunks(items, count):
+    size = -(-len(items) // count)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def _wrap_chunk(content_key, public_numbers):
+    # Runs in a worker process; keys travel as (n, e) to keep pickling cheap
+    return [PKCS1_OAEP.new(RSA.construct(numbers, consistency_check=False)).encrypt(content_key)
+            for numbers in public_numbers]
+
+def _unwrap_keys(cipher_rsa, wrapped_keys):
+    keys = []
+    for wrapped in wrapped_keys:
+        try:
+            keys.append(cipher_rsa.decrypt(wrapped))
+        except ValueError:
+            keys.append(None)
+    return keys
+
+_worker_cipher = None  # a private-key pool worker's PKCS1_OAEP cipher
+
+def _load_private_key(private_numbers):
+    # Pool initializer: the private key reaches each worker once, at startup
+    global _worker_cipher
+    _worker_cipher = PKCS1_OAEP.new(RSA.construct(private_numbers, consistency_check=False))
+
+def _unwrap_chunk(wrapped_keys):
+    return _unwrap_keys(_worker_cipher, wrapped_keys)
+
+def _parallel(pool, fn, items, *shared):
+    """fn(*shared, items) on a process pool, split across all cores"""
+    chunks = _chunks(items, _CORES)
+    results = []
+    for part in pool.map(fn, *([value] * len(chunks) for value in shared), chunks):
+        results.extend(part)
+    return results
 
 class CryptoHandler:
-    def __init__(self):
-        self.private_key = RSA.generate(2048)
+    def __init__(self, private_key=None, ec_key=None, ecdh=False,
+                 session_cache_size=SESSION_CACHE_SIZE,
+                 rekey_messages=SESSION_REKEY_MESSAGES, rekey_seconds=SESSION_REKEY_SECONDS):
+        # Generating an RSA key is slow; see from_keyring() and from_pool()
+        self.private_key = private_key or RSA.generate(RSA_KEY_BITS)
         self.public_key = self.private_key.publickey()
+        # Optional EC key so peers can agree session keys with ECDH
+        if ecdh and ec_key is None:
+            ec_key = ECC.generate(curve=ECDH_CURVE)
+        self.ec_key = ec_key
+        self.ec_public_key = ec_key.public_key() if ec_key is not None else None
+        self.rekey_messages = rekey_messages
+        self.rekey_seconds = rekey_seconds
+        self.outgoing = _LRU(session_cache_size)  # {peer fingerprint: session}
+        self.fingerprints = _LRU(session_cache_size)  # {id(pub_key): (pub_key, fingerprint)}
+        self.incoming = _LRU(session_cache_size)  # {session id: session}
+        self.session_lock = threading.Lock()
+        self.unwrap_pool = None  # worker processes holding our private key
+
+    @classmethod
+    def from_keyring(cls, name, keyring=None, ecdh=False, pool=None, **kwargs):
+        """Load the named identity from the encrypted keyring, creating it once"""
+        keyring = keyring or KeyRing()
+        private_key = keyring.load_or_create(name, 'rsa', pool)
+        ec_key = keyring.load_or_create(name, 'ec') if ecdh else None
+        return cls(private_key, ec_key, **kwargs)
+
+    @classmethod
+    def from_pool(cls, pool=None, ecdh=False, **kwargs):
+        """Create a fresh identity from a pre-generated keypair"""
+        pool = pool or default_pool()
+        return cls(pool.get(), ecdh=ecdh, **kwargs)
 
     def encrypt_message(self, message, pub_key):
         session_key = get_random_bytes(16)
@@ -23,3 +176,241 @@ class CryptoHandler:
         session_key = PKCS1_OAEP.new(self.private_key).decrypt(enc_session_key)
         cipher_aes = AES.new(session_key, AES.MODE_GCM, nonce)
         return cipher_aes.decrypt_and_verify(ciphertext, tag).decode()
+
+    def _fingerprint(self, pub_key):
+        # Exporting the key is slow, so remember it per key object
+        cached = self.fingerprints.get(id(pub_key))
+        if cached is not None and cached[0] is pub_key:
+            return cached[1]
+        fingerprint = key_fingerprint(pub_key)
+        self.fingerprints.put(id(pub_key), (pub_key, fingerprint))
+        return fingerprint
+
+    def _outgoing_session(self, pub_key):
+        """Return the session with a peer, starting a new one when due"""
+        peer = self._fingerprint(pub_key)
+        session = self.outgoing.get(peer)
+        if session is not None and (
+                session['counter'] >= self.rekey_messages
+                or time.monotonic() - session['created'] >= self.rekey_seconds):
+            session = None
+        if session is not None:
+            return session
+        session_id = get_random_bytes(8)
+        if isinstance(pub_key, ECC.EccKey):
+            # Ephemeral-static ECDH: only a public point travels
+            ephemeral = ECC.generate(curve=ECDH_CURVE)
+            key = _ecdh_key(session_id, static_pub=pub_key, eph_priv=ephemeral)
+            kind = KIND_ECDH
+            material = ephemeral.public_key().export_key(format='SEC1', compress=True)
+        else:
+            key = get_random_bytes(16)
+            kind = KIND_KEY
+            material = PKCS1_OAEP.new(pub_key).encrypt(key)
+        session = {
+            'id': session_id,
+            'key': key,
+            'counter': 0,
+            'created': time.monotonic(),
+            # Sent with counter 0 only, whichever thread gets that counter
+            'kind': kind,
+            'material': material,
+            'lock': threading.Lock()
+        }
+        self.outgoing.put(peer, session)
+        return session
+
+    def encrypt_session(self, message, pub_key, send=None):
+        """Encrypt for a peer, setting up a key only once per session.
+
+        pub_key is the peer's RSA public key, or its ec_public_key to agree
+        the session key with ECDH instead of RSA. The receiver rejects
+        counters that go backwards, so messages of a session must reach it
+        in counter order. Threads sharing a session should pass send, which
+        is called with the result while the session is held, from counter
+        allocation until the message is handed off.
+        """
+        with self.session_lock:
+            session = self._outgoing_session(pub_key)
+        with session['lock']:
+            counter = session['counter']
+            session['counter'] += 1
+            if counter == 0:
+                kind, material = session['kind'], session['material']
+                session['material'] = None
+            else:
+                kind, material = KIND_DATA, None
+            
+            header = _HEADER.pack(SESSION_VERSION, kind, session['id'], counter)
+            if material is not None:
+                header += _KEY_LENGTH.pack(len(material)) + material
+            # Counter-based nonce: unique for every message under this key
+            nonce = session['id'][:4] + counter.to_bytes(8, 'big')
+            cipher_aes = AES.new(session['key'], AES.MODE_GCM, nonce=nonce)
+            cipher_aes.update(header)
+            ciphertext, tag = cipher_aes.encrypt_and_digest(message.encode())
+            data = header + tag + ciphertext
+            if send is not None:
+                send(data)
+        return data
+
+    def decrypt_session(self, data):
+        """Decrypt a message produced by encrypt_session"""
+        if len(data) < _HEADER.size + _TAG_SIZE:
+            raise SessionError("Message too short")
+        version, kind, session_id, counter = _HEADER.unpack_from(data)
+        if version != SESSION_VERSION:
+            raise SessionError(f"Unsupported session version {version}")
+        pos = _HEADER.size
+        
+        if kind in (KIND_KEY, KIND_ECDH):
+            (key_length,) = _KEY_LENGTH.unpack_from(data, pos)
+            pos += _KEY_LENGTH.size
+            material = data[pos:pos + key_length]
+            pos += key_length
+            with self.session_lock:
+                session = self.incoming.get(session_id)
+            if session is None:
+                try:
+                    if kind == KIND_KEY:
+                        key = PKCS1_OAEP.new(self.private_key).decrypt(material)
+                    elif self.ec_key is None:
+                        raise SessionError("No EC key for ECDH session")
+                    else:
+                        ephemeral = ECC.import_key(material, curve_name=ECDH_CURVE)
+                        key = _ecdh_key(session_id, static_priv=self.ec_key,
+                                        eph_pub=ephemeral)
+                except ValueError:
+                    raise SessionError("Cannot recover session key")
+                session = {'key': key, 'last_counter': -1}
+        elif kind == KIND_DATA:
+            with self.session_lock:
+                session = self.incoming.get(session_id)
+            if session is None:
+                raise SessionError("Unknown session")
+        else:
+            raise SessionError(f"Unknown message kind {kind}")
+        
+        if counter <= session['last_counter']:
+            raise SessionError("Replayed message")
+        header = data[:pos]
+        tag = data[pos:pos + _TAG_SIZE]
+        ciphertext = data[pos + _TAG_SIZE:]
+        nonce = session_id[:4] + counter.to_bytes(8, 'big')
+        cipher_aes = AES.new(session['key'], AES.MODE_GCM, nonce=nonce)
+        cipher_aes.update(header)
+        try:
+            plaintext = cipher_aes.decrypt_and_verify(ciphertext, tag)
+        except ValueError:
+            raise SessionError("Authentication failed")
+        
+        with self.session_lock:
+            session['last_counter'] = counter
+            self.incoming.put(session_id, session)
+        return plaintext.decode()
+
+    def encrypt_for_many(self, message, pub_keys):
+        """Encrypt a message once for many RSA recipients.
+
+        The body is encrypted a single time with a random content key, and
+        only that 16-byte key is wrapped for each recipient. The result is
+        one bytes object every recipient can open with decrypt_batch.
+        """
+        content_key = get_random_bytes(16)
+        if len(pub_keys) >= CRYPTO_PARALLEL_MIN and _CORES > 1:
+            wrapped_keys = _parallel(_process_pool(), _wrap_chunk,
+                                     [(k.n, k.e) for k in pub_keys], content_key)
+        else:
+            wrapped_keys = [PKCS1_OAEP.new(k).encrypt(content_key) for k in pub_keys]
+
+        parts = [_MULTI_HEADER.pack(SESSION_VERSION, KIND_MULTI, len(pub_keys))]
+        for pub_key, wrapped in zip(pub_keys, wrapped_keys):
+            parts.append(self._fingerprint(pub_key) + _KEY_LENGTH.pack(len(wrapped)) + wrapped)
+        header = b''.join(parts)
+        
+        nonce = get_random_bytes(_NONCE_SIZE)
+        cipher_aes = AES.new(content_key, AES.MODE_GCM, nonce=nonce)
+        cipher_aes.update(header)
+        ciphertext, tag = cipher_aes.encrypt_and_digest(message.encode())
+        return header + nonce + tag + ciphertext
+
+    def _parse_envelope(self, data):
+        """Return (header length, our wrapped key or None) for an envelope"""
+        _, _, count = _MULTI_HEADER.unpack_from(data)
+        mine = self._fingerprint(self.public_key)
+        pos = _MULTI_HEADER.size
+        wrapped = None
+        for _ in range(count):
+            fingerprint = data[pos:pos + _FINGERPRINT_SIZE]
+            pos += _FINGERPRINT_SIZE
+            (length,) = _KEY_LENGTH.unpack_from(data, pos)
+            pos += _KEY_LENGTH.size
+            if fingerprint == mine:
+                wrapped = data[pos:pos + length]
+            pos += length
+        return pos, wrapped
+
+    def decrypt_batch(self, messages):
+        """Decrypt a backlog of envelopes and session messages in one call.
+
+        Returns plaintexts in the same order, with None for any message that
+        is not addressed to us or fails to authenticate. The RSA unwraps of
+        a large backlog are spread over the process pool.
+        """
+        results = [None] * len(messages)
+        envelopes = []  # (index, header length, wrapped key)
+        for index, data in enumerate(messages):
+            try:
+                if len(data) > 1 and data[1] == KIND_MULTI:
+                    header_length, wrapped = self._parse_envelope(data)
+                    if wrapped is not None:
+                        envelopes.append((index, header_length, wrapped))
+                else:
+                    results[index] = self.decrypt_session(data)
+            except (SessionError, ValueError, struct.error):
+                pass
+        
+        # Unwrap each distinct content key once
+        wrapped_keys = list(dict.fromkeys(w for _, _, w in envelopes))
+        if len(wrapped_keys) >= CRYPTO_PARALLEL_MIN and _CORES > 1:
+            keys = _parallel(self._unwrap_pool(), _unwrap_chunk, wrapped_keys)
+        else:
+            keys = _unwrap_keys(PKCS1_OAEP.new(self.private_key), wrapped_keys)
+        content_keys = dict(zip(wrapped_keys, keys))
+        
+        for index, header_length, wrapped in envelopes:
+            content_key = content_keys.get(wrapped)
+            if content_key is None:
+                continue
+            data = messages[index]
+            nonce = data[header_length:header_length + _NONCE_SIZE]
+            tag = data[header_length + _NONCE_SIZE:header_length + _NONCE_SIZE + _TAG_SIZE]
+            ciphertext = data[header_length + _NONCE_SIZE + _TAG_SIZE:]
+            cipher_aes = AES.new(content_key, AES.MODE_GCM, nonce=nonce)
+            cipher_aes.update(data[:header_length])
+            try:
+                results[index] = cipher_aes.decrypt_and_verify(ciphertext, tag).decode()
+            except ValueError:
+                pass
+        return results
+
+    def _unwrap_pool(self):
+        """Process pool for our private-key RSA work, started on first use"""
+        with self.session_lock:
+            if self.unwrap_pool is None:
+                k = self.private_key
+                self.unwrap_pool = ProcessPoolExecutor(
+                    max_workers=_CORES, mp_context=process_context(['app.crypto']),
+                    initializer=_load_private_key, initargs=((k.n, k.e, k.d, k.p, k.q, k.u),))
+            return self.unwrap_pool
+
+    def close(self):
+        """Stop the private-key worker processes, if any were started"""
+        if self.unwrap_pool is not None:
+            self.unwrap_pool.shutdown(wait=False)
+            self.unwrap_pool = None
+
+    def reset_session(self, pub_key):
+        """Forget the session with a peer; the next message rekeys"""
+        with self.session_lock:
+            self.outgoing.pop(self._fingerprint(pub_key))
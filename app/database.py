@@ -1,47 +1,335 @@
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timezone
+import argparse
 import json
 import os
+import re
+import queue
+import threading
+import time
+import atexit
+from app.constants import (
+    DB_PATH, DB_BUSY_TIMEOUT, WRITE_BATCH_SIZE, WRITE_FLUSH_INTERVAL, WRITE_MAX_RETRIES,
+    WRITE_RETRY_DELAY, HISTORY_PAGE_SIZE, HISTORY_CHUNK_SIZE, SEARCH_PAGE_SIZE, FTS_BACKFILL_CHUNK
+)
+from app.metrics import REGISTRY
+
+_STOP = object()
+_MAX_ID = 2 ** 63 - 1
+
+# Schema migrations; entry N upgrades a database from version N to N + 1.
+# The applied version is stored in PRAGMA user_version.
+MIGRATIONS = [
+    # 1: messages table
+    '''
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sender TEXT NOT NULL,
+        receiver TEXT DEFAULT 'all',
+        message_type TEXT NOT NULL,
+        content TEXT NOT NULL,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        file_path TEXT
+    );
+    ''',
+    # 2: indexes for per-user history pages
+    '''
+    CREATE INDEX IF NOT EXISTS idx_messages_receiver_id ON messages (receiver, id);
+    CREATE INDEX IF NOT EXISTS idx_messages_sender_id ON messages (sender, id);
+    ''',
+    # 3: full-text index on message content. It reads the text from messages
+    # (external content) and the trigger indexes every new row in the
+    # inserting transaction. Rows already present are left for
+    # backfill_fts(), which works down from fts_backfill.last_id.
+    '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        content, content='messages', content_rowid='id'
+    );
+    CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+    END;
+    CREATE TABLE IF NOT EXISTS fts_backfill (last_id INTEGER NOT NULL);
+    INSERT INTO fts_backfill SELECT COALESCE(MAX(id), 0) FROM messages;
+    ''',
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+DB_COMMIT = REGISTRY.histogram('chat_db_commit_seconds', 'Time to insert and commit one batch of messages')
+DB_ROWS = REGISTRY.counter('chat_db_rows_written_total', 'Messages written to the database')
+
+# Column order of rows passed to on_commit and returned by recent_messages
+MESSAGE_COLUMNS = 'id, sender, receiver, message_type, content, timestamp, file_path'
+
+_SEARCH_TERM = re.compile(r'\w+\*?')
+
+def fts_query(text):
+    """Turn typed words into an FTS5 query matching all of them.
+
+    Each word is quoted so punctuation and FTS5 operators in user input
+    cannot cause syntax errors; a trailing * keeps prefix matching.
+    """
+    terms = []
+    for term in _SEARCH_TERM.findall(text):
+        prefix = term.endswith('*')
+        terms.append('"' + term.rstrip('*') + '"' + ('*' if prefix else ''))
+    return ' '.join(terms)
 
 class ChatDatabase:
-    def __init__(self):
-        self.db_path = "app/chat_history.db"
+    def __init__(self, db_path=DB_PATH, write_behind=False,
+                 batch_size=WRITE_BATCH_SIZE, flush_interval=WRITE_FLUSH_INTERVAL):
+        self.db_path = db_path
+        self.write_behind = write_behind
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.writer_thread = None
+        # Write-behind sequence numbers: messages queued and committed so far
+        self.queued = 0
+        self.committed = 0
+        self.queue_lock = threading.Lock()
+        # Set if the writer thread died; queueing more would lose messages
+        self.error = None
+        # Called with the committed rows (MESSAGE_COLUMNS) after each write
+        self.on_commit = None
         self.init_database()
+        if write_behind:
+            self.start_writer()
 
     def init_database(self):
-        """Initialize the database and create tables if they don't exist"""
-        os.makedirs("app", exist_ok=True)
+        """Initialize the database and upgrade its schema in place"""
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
         
         with sqlite3.connect(self.db_path) as conn:
             cursor = conn.cursor()
-            
-            # Create messages table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    sender TEXT NOT NULL,
-                    receiver TEXT DEFAULT 'all',
-                    message_type TEXT NOT NULL,
-                    content TEXT NOT NULL,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    file_path TEXT
-                )
-            ''')
-            
+            # WAL lets history reads run while the writer commits
+            cursor.execute('PRAGMA journal_mode=WAL')
+            self.migrate(conn)
+            unindexed = self.fts_unindexed(conn)
+        if unindexed:
+            print(f"[!] {unindexed} older messages are not searchable yet; "
+                  f"run: python -m app.database --backfill-fts {self.db_path}")
+
+    def migrate(self, conn):
+        """Apply any migrations newer than the database's schema version"""
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for index in range(version, SCHEMA_VERSION):
+            conn.executescript(MIGRATIONS[index])
+            conn.execute(f'PRAGMA user_version = {index + 1}')
             conn.commit()
+            print(f"[+] Database upgraded to schema version {index + 1}")
+
+    def start_writer(self):
+        """Start the background thread that group-commits queued messages"""
+        self.pending = queue.Queue()
+        self.writer_thread = threading.Thread(target=self._write_loop)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+        # Commit whatever is still queued when the interpreter exits
+        atexit.register(self.close)
+
+    def _write_loop(self):
+        conn = sqlite3.connect(self.db_path, timeout=DB_BUSY_TIMEOUT)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        stopping = False
+        waiters = []
+        try:
+            while not stopping:
+                rows = []
+                waiters = []
+                item = self.pending.get()
+                deadline = time.monotonic() + self.flush_interval
+                while True:
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    elif isinstance(item, threading.Event):
+                        # flush() marker: commit everything queued before it
+                        waiters.append(item)
+                        break
+                    rows.append(item)
+                    if len(rows) >= self.batch_size:
+                        break
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = self.pending.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+                
+                if rows:
+                    self._commit_batch(conn, rows)
+                for waiter in waiters:
+                    waiter.set()
+            
+            # Drain anything queued alongside the stop marker
+            rows = []
+            while True:
+                try:
+                    item = self.pending.get_nowait()
+                except queue.Empty:
+                    break
+                if isinstance(item, threading.Event):
+                    item.set()
+                elif item is not _STOP:
+                    rows.append(item)
+            if rows:
+                self._commit_batch(conn, rows)
+        except BaseException as e:
+            print(f"Database writer stopped: {e}")
+            with self.queue_lock:
+                # save_message and flush raise from now on instead of queueing
+                self.error = e
+            # Wake flush() callers still waiting on this writer
+            for waiter in waiters:
+                waiter.set()
+            while True:
+                try:
+                    item = self.pending.get_nowait()
+                except queue.Empty:
+                    break
+                if isinstance(item, threading.Event):
+                    item.set()
+        finally:
+            conn.close()
+
+    def _commit_batch(self, conn, rows):
+        """Insert rows in one transaction, retrying until it commits.
+
+        committed only advances once the rows are durable; after
+        WRITE_MAX_RETRIES failed attempts the error stops the writer.
+        """
+        attempt = 0
+        while True:
+            try:
+                committed = self._insert_rows(conn, rows)
+                break
+            except sqlite3.Error as e:
+                conn.rollback()
+                attempt += 1
+                if attempt > WRITE_MAX_RETRIES:
+                    raise
+                print(f"Database write error: {e}; retrying ({attempt}/{WRITE_MAX_RETRIES})")
+                time.sleep(WRITE_RETRY_DELAY * attempt)
+        self._notify(committed)
+        # The queue is FIFO, so this is the newest sequence number done
+        self.committed += len(rows)
+
+    def _insert_rows(self, conn, rows):
+        """Insert and commit a batch; returns the rows as MESSAGE_COLUMNS"""
+        start = time.perf_counter()
+        conn.executemany('''
+            INSERT INTO messages (sender, receiver, message_type, content, file_path, timestamp)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', rows)
+        # The transaction holds the write lock, so the batch got consecutive ids
+        last_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+        conn.commit()
+        DB_COMMIT.observe(time.perf_counter() - start)
+        DB_ROWS.inc(len(rows))
+        first_id = last_id - len(rows) + 1
+        return [
+            (first_id + i, sender, receiver, message_type, content, timestamp, file_path)
+            for i, (sender, receiver, message_type, content, file_path, timestamp)
+            in enumerate(rows)
+        ]
+
+    def _notify(self, rows):
+        """Pass committed rows to on_commit; a failing hook never stops the writer"""
+        if self.on_commit is None:
+            return
+        try:
+            self.on_commit(rows)
+        except Exception as e:
+            print(f"Database commit hook error: {e}")
+
+    def _check_writer(self):
+        if self.error is not None:
+            raise RuntimeError(f"Database writer stopped: {self.error}")
+
+    def flush(self, upto=None):
+        """Block until every message queued so far is committed.
+
+        With upto, a sequence number returned by save_message, only wait if
+        that message is not committed yet. Raises RuntimeError if the writer
+        stopped before committing it.
+        """
+        if self.writer_thread is None:
+            return
+        with self.queue_lock:
+            self._check_writer()
+            if upto is None:
+                upto = self.queued
+            if self.committed >= upto:
+                return
+            done = threading.Event()
+            self.pending.put(done)
+        done.wait()
+        if self.committed < upto:
+            self._check_writer()
+
+    def close(self):
+        """Commit queued messages and stop the writer thread"""
+        if self.writer_thread is None:
+            return
+        if self.writer_thread.is_alive():
+            self.pending.put(_STOP)
+            self.writer_thread.join()
+        self.writer_thread = None
+        atexit.unregister(self.close)
 
     def save_message(self, sender, message_type, content, file_path=None, receiver="all"):
-        """Save a message to the database"""
+        """Save a message to the database.
+
+        With write-behind, returns the message's sequence number for flush(upto).
+        """
+        if self.writer_thread is not None:
+            # Write-behind: the row is committed by the writer thread
+            timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+            with self.queue_lock:
+                self._check_writer()
+                # Numbered in queue order, so committed counts up through them
+                self.pending.put((sender, receiver, message_type, content, file_path, timestamp))
+                self.queued += 1
+                return self.queued
+        
+        start = time.perf_counter()
         with sqlite3.connect(self.db_path) as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT INTO messages (sender, receiver, message_type, content, file_path)
                 VALUES (?, ?, ?, ?, ?)
+                RETURNING id, timestamp
             ''', (sender, receiver, message_type, content, file_path))
+            message_id, timestamp = cursor.fetchone()
             conn.commit()
+        DB_COMMIT.observe(time.perf_counter() - start)
+        DB_ROWS.inc()
+        self._notify([(message_id, sender, receiver, message_type, content, timestamp, file_path)])
+
+    def recent_messages(self, limit):
+        """The newest messages of every channel, oldest first (MESSAGE_COLUMNS)"""
+        with sqlite3.connect(self.db_path) as conn:
+            rows = conn.execute(f'''
+                SELECT {MESSAGE_COLUMNS} FROM messages
+                ORDER BY id DESC
+                LIMIT ?
+            ''', (limit,)).fetchall()
+        rows.reverse()
+        return rows
+
+    def messages_after(self, after_id):
+        """Messages committed with an id above after_id, oldest first"""
+        with sqlite3.connect(self.db_path) as conn:
+            return conn.execute(f'''
+                SELECT {MESSAGE_COLUMNS} FROM messages
+                WHERE id > ?
+                ORDER BY id
+            ''', (after_id,)).fetchall()
 
     def get_chat_history(self, limit=100):
         """Get recent chat history"""
+        self.flush()
         with sqlite3.connect(self.db_path) as conn:
             cursor = conn.cursor()
             cursor.execute('''
@@ -52,15 +340,230 @@ class ChatDatabase:
             ''', (limit,))
             return cursor.fetchall()
 
-    def get_user_chat_history(self, username, limit=100):
+    def get_user_chat_history(self, username, limit=HISTORY_PAGE_SIZE, before_id=None):
         """Get chat history for a specific user"""
+        rows, _ = self.get_user_history_page(username, before_id, limit)
+        return rows
+
+    def iter_user_history(self, username, before_id=None, limit=None,
+                          chunk_size=HISTORY_CHUNK_SIZE):
+        """Yield a user's history newest first, chunk_size rows at a time.
+
+        Rows come straight off one cursor walking the primary key backwards
+        (the unary + keeps SQLite from switching to the indexes, which would
+        need a temporary sort), so memory stays at one chunk however long
+        the history is. Rows include the message id first.
+        """
+        self.flush()
+        if before_id is None:
+            before_id = _MAX_ID
+        conn = sqlite3.connect(self.db_path)
+        try:
+            cursor = conn.execute('''
+                SELECT id, sender, message_type, content, timestamp, file_path
+                FROM messages
+                WHERE id < ? AND (+receiver = ? OR +receiver = 'all' OR +sender = ?)
+                ORDER BY id DESC
+                LIMIT ?
+            ''', (before_id, username, username, -1 if limit is None else limit))
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    return
+                yield rows
+        finally:
+            conn.close()
+
+    def get_user_history_page(self, username, before_id=None, limit=HISTORY_PAGE_SIZE,
+                              written=None):
+        """Get one page of a user's history, newest first, older than before_id.
+
+        Returns (rows, next_before_id); pass next_before_id back to fetch the
+        next older page. It is None once the oldest message was returned.
+        Each branch of the query is an index range scan, so a page costs the
+        same no matter how far back it is. written is passed to flush().
+        """
+        self.flush(written)
+        if before_id is None:
+            before_id = _MAX_ID
         with sqlite3.connect(self.db_path) as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                SELECT sender, message_type, content, timestamp, file_path
+                SELECT id, sender, message_type, content, timestamp, file_path FROM (
+                    SELECT * FROM (
+                        SELECT * FROM messages
+                        WHERE receiver = ? AND id < ?
+                        ORDER BY id DESC LIMIT ?
+                    )
+                    UNION
+                    SELECT * FROM (
+                        SELECT * FROM messages
+                        WHERE receiver = 'all' AND id < ?
+                        ORDER BY id DESC LIMIT ?
+                    )
+                    UNION
+                    SELECT * FROM (
+                        SELECT * FROM messages
+                        WHERE sender = ? AND id < ?
+                        ORDER BY id DESC LIMIT ?
+                    )
+                )
+                ORDER BY id DESC
+                LIMIT ?
+            ''', (username, before_id, limit,
+                  before_id, limit,
+                  username, before_id, limit,
+                  limit))
+            rows = cursor.fetchall()
+        next_before_id = rows[-1][0] if len(rows) == limit else None
+        return [row[1:] for row in rows], next_before_id
+
+    def get_room_history_page(self, room, before_id=None, limit=HISTORY_PAGE_SIZE,
+                              written=None):
+        """Get one page of a room's history, newest first, older than before_id.
+
+        Room messages are stored with receiver '#<room>', so this is a single
+        range scan of idx_messages_receiver_id. Returns (rows, next_before_id)
+        like get_user_history_page.
+        """
+        self.flush(written)
+        if before_id is None:
+            before_id = _MAX_ID
+        with sqlite3.connect(self.db_path) as conn:
+            rows = conn.execute('''
+                SELECT id, sender, message_type, content, timestamp, file_path
                 FROM messages
-                WHERE sender = ? OR receiver = ? OR receiver = 'all'
-                ORDER BY timestamp DESC
+                WHERE receiver = ? AND id < ?
+                ORDER BY id DESC
                 LIMIT ?
-            ''', (username, username, limit))
-            return cursor.fetchall() 
\ No newline at end of file
+            ''', ('#' + room, before_id, limit)).fetchall()
+        next_before_id = rows[-1][0] if len(rows) == limit else None
+        return [row[1:] for row in rows], next_before_id
+
+    def iter_user_history_after(self, username, after_id, limit=None,
+                                chunk_size=HISTORY_CHUNK_SIZE):
+        """Yield up to limit of a user's messages with an id above after_id, oldest first.
+
+        Used by clients catching up a local copy; the cursor walks the primary
+        key forward from after_id, so the cost follows the number of newer
+        messages rather than the size of the table. Rows include the id first.
+        """
+        self.flush()
+        conn = sqlite3.connect(self.db_path)
+        try:
+            cursor = conn.execute('''
+                SELECT id, sender, message_type, content, timestamp, file_path
+                FROM messages
+                WHERE id > ? AND (+receiver = ? OR +receiver = 'all' OR +sender = ?)
+                ORDER BY id
+                LIMIT ?
+            ''', (after_id, username, username, -1 if limit is None else limit))
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    return
+                yield rows
+        finally:
+            conn.close()
+
+    def fts_unindexed(self, conn=None):
+        """Messages written before the search index existed and not backfilled yet"""
+        if conn is None:
+            with sqlite3.connect(self.db_path) as conn:
+                return self.fts_unindexed(conn)
+        last_id = conn.execute('SELECT last_id FROM fts_backfill').fetchone()[0]
+        if not last_id:
+            return 0
+        return conn.execute('SELECT COUNT(*) FROM messages WHERE id <= ?', (last_id,)).fetchone()[0]
+
+    def backfill_fts(self, chunk_size=FTS_BACKFILL_CHUNK):
+        """Index the messages that predate the search index, newest first.
+
+        Each chunk of ids is indexed and the watermark lowered in one short
+        transaction, so this can run against a live server's database and
+        can be interrupted and restarted. Returns how many rows were indexed.
+        """
+        indexed = 0
+        # The writer may hold the lock for a commit; wait it out
+        with sqlite3.connect(self.db_path, timeout=30) as conn:
+            while True:
+                last_id = conn.execute('SELECT last_id FROM fts_backfill').fetchone()[0]
+                if not last_id:
+                    return indexed
+                low = max(0, last_id - chunk_size)
+                cursor = conn.execute('''
+                    INSERT INTO messages_fts (rowid, content)
+                    SELECT id, content FROM messages
+                    WHERE id > ? AND id <= ?
+                ''', (low, last_id))
+                conn.execute('UPDATE fts_backfill SET last_id = ?', (low,))
+                conn.commit()
+                indexed += cursor.rowcount
+                print(f"[+] Indexed {indexed} messages (ids above {low} done)")
+
+    def search_messages(self, username, query, sender=None, room=None, since=None,
+                        until=None, rooms=(), offset=0, limit=SEARCH_PAGE_SIZE):
+        """Search the messages a user can see, best match first.
+
+        Matches every word of query against message content (see fts_query),
+        ranked by FTS5's bm25. Visible messages are broadcasts, the user's
+        own direct messages and those of the given rooms; room limits the
+        search to one room. since and until bound the timestamp
+        ('YYYY-MM-DD HH:MM:SS' UTC, until exclusive). Returns (rows,
+        next_offset); rows are MESSAGE_COLUMNS plus a snippet with the
+        matches in [brackets], and next_offset is None on the last page.
+        """
+        match = fts_query(query)
+        if not match:
+            return [], None
+        self.flush()
+        if room is not None:
+            conditions = ['m.receiver = ?']
+            params = [match, '#' + room]
+        else:
+            receivers = ['all', username] + ['#' + name for name in rooms]
+            conditions = [f"(m.receiver IN ({', '.join('?' * len(receivers))}) OR m.sender = ?)"]
+            params = [match] + receivers + [username]
+        if sender is not None:
+            conditions.append('m.sender = ?')
+            params.append(sender)
+        if since is not None:
+            conditions.append('m.timestamp >= ?')
+            params.append(since)
+        if until is not None:
+            conditions.append('m.timestamp < ?')
+            params.append(until)
+        # One extra row tells whether another page follows
+        params += [limit + 1, offset]
+        columns = ', '.join('m.' + column for column in MESSAGE_COLUMNS.split(', '))
+        with sqlite3.connect(self.db_path) as conn:
+            rows = conn.execute(f'''
+                SELECT {columns}, snippet(messages_fts, 0, '[', ']', '...', 12)
+                FROM messages_fts
+                JOIN messages m ON m.id = messages_fts.rowid
+                WHERE messages_fts MATCH ? AND {' AND '.join(conditions)}
+                ORDER BY rank
+                LIMIT ? OFFSET ?
+            ''', params).fetchall()
+        next_offset = offset + limit if len(rows) > limit else None
+        return rows[:limit], next_offset
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Chat database maintenance')
+    parser.add_argument('--backfill-fts',
+                       nargs='+',
+                       metavar='DB',
+                       required=True,
+                       help='Add existing messages of these databases to the search index')
+    parser.add_argument('--chunk-size',
+                       type=int,
+                       default=FTS_BACKFILL_CHUNK,
+                       help='Messages indexed per transaction')
+
+    args = parser.parse_args()
+    for path in args.backfill_fts:
+        if not os.path.exists(path):
+            parser.error(f"no such database: {path}")
+        print(f"[*] Backfilling search index of {path}")
+        db = ChatDatabase(path)
+        print(f"[+] {path}: indexed {db.backfill_fts(args.chunk_size)} messages")
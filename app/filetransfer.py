@@ -0,0 +1,96 @@
+import base64
+import hashlib
+import json
+import struct
+import uuid
+import zlib
+from app.constants import FILE_CHUNK_SIZE
+from app.framing import encode_frame, LENGTH
+from app.codec import decode_payload
+
+# Chunked transfer messages: file_begin, file_chunk..., file_end. Uploads go
+# from a client into the server's blob store; downloads answer a blob_request.
+FILE_TRANSFER_TYPES = ('file_begin', 'file_chunk', 'file_end')
+
+# In length-prefixed framing a file_chunk travels as a binary frame: this
+# marker byte (JSON frames always start with '{'), the transfer id, the
+# offset and the CRC-32 of the data, followed by the raw data. Line framing
+# cannot carry raw bytes, so there the chunk is a JSON message with base64 data.
+CHUNK_MAGIC = b'\x01'
+_CHUNK_HEADER = struct.Struct('!c16sQI')
+
+def new_transfer_id():
+    return uuid.uuid4().hex
+
+def valid_transfer_id(transfer_id):
+    """True for a 32-character hex transfer id (safe to use in file names)"""
+    try:
+        return (len(transfer_id) == 32 and len(bytes.fromhex(transfer_id)) == 16
+                and transfer_id == transfer_id.lower())
+    except (TypeError, ValueError):
+        return False
+
+def chunk_crc(data):
+    return zlib.crc32(data)
+
+def encode_chunk(transfer_id, offset, data, mode, crc=None):
+    """Build the wire frame for one file chunk"""
+    if crc is None:
+        crc = chunk_crc(data)
+    if mode == LENGTH:
+        header = _CHUNK_HEADER.pack(CHUNK_MAGIC, bytes.fromhex(transfer_id), offset, crc)
+        return encode_frame(header + data, mode)
+    payload = json.dumps({
+        'type': 'file_chunk',
+        'transfer_id': transfer_id,
+        'offset': offset,
+        'crc': crc,
+        'data': base64.b64encode(data).decode('ascii')
+    }).encode()
+    return encode_frame(payload, mode)
+
+def decode_message(frame):
+    """Decode a frame into a message dict; file_chunk data is always bytes"""
+    if frame[:1] == CHUNK_MAGIC:
+        if len(frame) < _CHUNK_HEADER.size:
+            raise ValueError("Truncated file chunk")
+        _, transfer_id, offset, crc = _CHUNK_HEADER.unpack_from(frame)
+        return {
+            'type': 'file_chunk',
+            'transfer_id': transfer_id.hex(),
+            'offset': offset,
+            'crc': crc,
+            'data': frame[_CHUNK_HEADER.size:]
+        }
+    message = decode_payload(frame)
+    if message.get('type') == 'file_chunk' and isinstance(message.get('data'), str):
+        message['data'] = base64.b64decode(message['data'])
+    return message
+
+def verify_chunk(message):
+    return chunk_crc(message['data']) == message['crc']
+
+def iter_file_chunks(file, offset=0, chunk_size=FILE_CHUNK_SIZE):
+    """Yield (offset, data) pairs from an open binary file"""
+    file.seek(offset)
+    while True:
+        data = file.read(chunk_size)
+        if not data:
+            return
+        yield offset, data
+        offset += len(data)
+
+def file_sha256(file, length=None, chunk_size=FILE_CHUNK_SIZE):
+    """Hash an open binary file from the start, optionally only its first length bytes"""
+    digest = hashlib.sha256()
+    file.seek(0)
+    remaining = length
+    while remaining is None or remaining > 0:
+        size = chunk_size if remaining is None else min(chunk_size, remaining)
+        data = file.read(size)
+        if not data:
+            break
+        digest.update(data)
+        if remaining is not None:
+            remaining -= len(data)
+    return digest
@@ -0,0 +1,94 @@
+import struct
+from app.constants import MAX_FRAME_SIZE
+
+# Framing modes
+LINE = 'line'      # newline-terminated frames (the original protocol)
+LENGTH = 'length'  # 4-byte big-endian length prefix, then the payload
+FRAMING_MODES = (LINE, LENGTH)
+
+_HEADER = struct.Struct('!I')
+
+class FrameError(Exception):
+    """Raised when the peer sends a frame that cannot be decoded"""
+
+def encode_frame(payload, mode=LINE):
+    """Wrap an encoded payload for the wire"""
+    if mode == LENGTH:
+        return _HEADER.pack(len(payload)) + payload
+    return payload + b'\n'
+
+class FrameDecoder:
+    """Incremental decoder that turns received chunks into whole frames.
+
+    Data is appended to a single bytearray and consumed through a read
+    offset, so large frames arriving in many small chunks are only copied
+    once. The mode can be switched between frames (for example right after
+    login) without losing bytes that were already received.
+    """
+
+    def __init__(self, mode=LINE, max_frame_size=MAX_FRAME_SIZE):
+        if mode not in FRAMING_MODES:
+            raise ValueError(f"Unknown framing mode: {mode}")
+        self.mode = mode
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+        self.pos = 0
+        self.scan_pos = 0  # where the next newline search starts
+
+    def set_mode(self, mode):
+        if mode not in FRAMING_MODES:
+            raise ValueError(f"Unknown framing mode: {mode}")
+        self.mode = mode
+        self.scan_pos = self.pos
+
+    def feed(self, data):
+        # Drop consumed bytes before growing the buffer
+        if self.pos:
+            del self.buffer[:self.pos]
+            self.scan_pos -= self.pos
+            self.pos = 0
+        self.buffer += data
+
+    def pending(self):
+        """Number of received bytes not yet returned as a frame"""
+        return len(self.buffer) - self.pos
+
+    def next_frame(self):
+        """Return the next complete frame, or None if more data is needed"""
+        if self.mode == LENGTH:
+            return self._next_length_frame()
+        return self._next_line_frame()
+
+    def _next_line_frame(self):
+        while True:
+            end = self.buffer.find(b'\n', max(self.scan_pos, self.pos))
+            if end == -1:
+                self.scan_pos = len(self.buffer)
+                if self.pending() > self.max_frame_size:
+                    raise FrameError("Frame exceeds maximum size")
+                return None
+            frame = bytes(self.buffer[self.pos:end])
+            self.pos = self.scan_pos = end + 1
+            # Skip blank lines
+            if frame.strip():
+                return frame
+
+    def _next_length_frame(self):
+        if self.pending() < _HEADER.size:
+            return None
+        (length,) = _HEADER.unpack_from(self.buffer, self.pos)
+        if length > self.max_frame_size:
+            raise FrameError("Frame exceeds maximum size")
+        start = self.pos + _HEADER.size
+        if len(self.buffer) - start < length:
+            return None
+        frame = bytes(self.buffer[start:start + length])
+        self.pos = self.scan_pos = start + length
+        return frame
+
+    def __iter__(self):
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
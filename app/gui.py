@@ -1,6 +1,10 @@
 import tkinter as tk
-from tkinter import scrolledtext, ttk, messagebox, filedialog
+from tkinter import ttk, messagebox, filedialog
 import os
+import threading
+import time
+from app.constants import CHAT_SCROLLBACK_LINES, HISTORY_VIEW_PAGE_SIZE, UPLOAD_PROGRESS_INTERVAL
+from app.transcript import TranscriptModel, TranscriptView
 
 class LoginWindow:
     def __init__(self):
@@ -50,6 +54,8 @@ class ChatGUI:
         tk.Label(self.left_frame, text="Online Users").pack()
         self.users_listbox = tk.Listbox(self.left_frame, width=20, height=20)
         self.users_listbox.pack(fill=tk.Y, expand=True)
+        self.users_version = None  # presence version shown in the listbox
+        self.users_requested = False
         
         # Right frame (chat)
         self.right_frame = tk.Frame(self.container)
@@ -59,9 +65,10 @@ class ChatGUI:
         self.status_label = tk.Label(self.right_frame, text="Connected", fg="green")
         self.status_label.pack(pady=(0, 5))
         
-        # Chat display
-        self.chat_display = scrolledtext.ScrolledText(
-            self.right_frame, wrap=tk.WORD, width=50, height=20
+        # Chat display, rendering only the visible part of the transcript
+        self.chat_display = TranscriptView(
+            self.right_frame, TranscriptModel(CHAT_SCROLLBACK_LINES),
+            search=True, wrap=tk.WORD, width=50, height=20
         )
         self.chat_display.pack(fill=tk.BOTH, expand=True)
         
@@ -93,83 +100,228 @@ class ChatGUI:
         # Bind events
         self.message_input.bind('<Return>', lambda e: self.send_message())
         
-        # Start checking messages
-        self.check_messages()
+        # The receiver thread wakes the Tk loop only when messages arrive
+        self.wake_pending = False
+        self.root.bind('<<MessagesReady>>', lambda e: self.check_messages())
+        self.client.on_receive = self.wake
+        # Pick up anything that arrived before the window existed
+        self.root.after_idle(self.check_messages)
     
-    def update_users(self, users):
-        self.users_listbox.delete(0, tk.END)
-        for user in users:
-            self.users_listbox.insert(tk.END, user)
+    def wake(self):
+        """Called from the receiver thread; posts one event per burst"""
+        if self.wake_pending:
+            return
+        self.wake_pending = True
+        try:
+            self.root.event_generate('<<MessagesReady>>', when='tail')
+        except (RuntimeError, tk.TclError):
+            # Main loop not running yet, or the window is closed
+            self.wake_pending = False
+    
+    def update_users(self, message):
+        """Apply a user_list snapshot or a user_joined/user_left delta"""
+        version = message.get('version')
+        if message['type'] == 'user_list':
+            if self.users_version is not None and version is not None and version < self.users_version:
+                return
+            self.users_listbox.delete(0, tk.END)
+            for user in message['users']:
+                self.users_listbox.insert(tk.END, user)
+            self.users_version = version
+            self.users_requested = False
+            return
+        
+        # Deltas already covered by the snapshot are skipped
+        if self.users_version is None or version <= self.users_version:
+            return
+        if version != self.users_version + 1:
+            if not self.users_requested:
+                self.users_requested = self.client.request_user_list()
+            return
+        if message['type'] == 'user_joined':
+            for user in message['users']:
+                self.users_listbox.insert(tk.END, user)
+        else:
+            for user in message['users']:
+                users = self.users_listbox.get(0, tk.END)
+                if user in users:
+                    self.users_listbox.delete(users.index(user))
+        self.users_version = version
     
     def send_message(self):
         message = self.message_input.get()
         if message:
-            if self.client.send_message(message):
-                self.message_input.delete(0, tk.END)
+            if message.startswith('/'):
+                sent = self.run_command(message)
             else:
+                sent = self.client.send_message(message)
+            if sent:
+                self.message_input.delete(0, tk.END)
+            elif sent is not None:
                 self.show_error("Failed to send message")
+
+    def run_command(self, line):
+        """/msg <user> <text>, /room <room> <text>, /join <room>, /leave <room>, /search <words>"""
+        command, _, rest = line[1:].partition(' ')
+        target, _, text = rest.strip().partition(' ')
+        if command == 'msg' and target and text:
+            return self.client.send_direct(target, text)
+        if command == 'room' and target and text:
+            return self.client.send_to_room(target, text)
+        if command == 'join' and target:
+            return self.client.join_room(target)
+        if command == 'leave' and target:
+            return self.client.leave_room(target)
+        if command == 'search' and rest.strip():
+            return self.client.search(rest.strip())
+        self.status_label.config(text="Usage: /msg user text, /room name text, /join name, /leave name, /search words", fg="red")
+        return None
     
     def upload_file(self):
         filepath = filedialog.askopenfilename()
         if filepath:
-            try:
-                self.status_label.config(text="Sending file...", fg="blue")
-                self.root.update()
-                
-                if self.client.send_file(filepath):
-                    filename = os.path.basename(filepath)
-                    self.status_label.config(text="File sent successfully", fg="green")
-                    self.add_message("You", f"Sent file: {filename}")
-                else:
-                    self.show_error("Failed to send file")
-                    self.status_label.config(text="Error sending file", fg="red")
-            except Exception as e:
-                self.show_error(f"Error sending file: {str(e)}")
-                self.status_label.config(text="Error", fg="red")
-            finally:
-                # Reset status after 3 seconds
-                self.root.after(3000, lambda: self.status_label.config(text="Connected", fg="green"))
+            self.status_label.config(text="Sending file...", fg="blue")
+            # Chunks are sent off the Tk thread so the window keeps redrawing
+            upload_thread = threading.Thread(target=self.send_file_in_background, args=(filepath,))
+            upload_thread.daemon = True
+            upload_thread.start()
+    
+    def send_file_in_background(self, filepath):
+        """Upload thread; progress reaches the window through the client's queue"""
+        filename = os.path.basename(filepath)
+        last_update = 0.0
+        
+        def progress(sent, size):
+            nonlocal last_update
+            now = time.monotonic()
+            if now - last_update >= UPLOAD_PROGRESS_INTERVAL:
+                last_update = now
+                self.client.post_local({'type': 'file_progress', 'filename': filename,
+                                        'sent': sent, 'size': size})
+        
+        sent = self.client.send_file(filepath, progress=progress)
+        self.client.post_local({'type': 'file_sent', 'filename': filename, 'ok': bool(sent)})
+    
+    def show_upload_result(self, message):
+        if message['ok']:
+            self.status_label.config(text="File sent successfully", fg="green")
+            self.add_message("You", f"Sent file: {message['filename']}")
+        else:
+            self.show_error(f"Failed to send file: {message['filename']}")
+            self.status_label.config(text="Error sending file", fg="red")
+        # Reset status after 3 seconds
+        self.root.after(3000, lambda: self.status_label.config(text="Connected", fg="green"))
+    
+    def handle_file_message(self, message):
+        """Save a file sent as a single 'file' message by an older client"""
+        filepath = self.client.save_file(os.path.basename(message['filename']), message['file_data'])
+        if filepath:
+            self.add_message(message['sender'],
+                f"sent file: {message['filename']} (saved to {filepath})")
     
     def show_error(self, message):
         self.status_label.config(text="Error", fg="red")
         messagebox.showerror("Error", message)
     
     def add_message(self, sender, message):
-        self.chat_display.insert(tk.END, f"{sender}: {message}\n")
-        self.chat_display.see(tk.END)
+        self.add_lines([f"{sender}: {message}"])
+    
+    def add_lines(self, lines):
+        """Append a batch of chat lines with a single redraw"""
+        self.chat_display.append([(line, None) for line in lines])
+    
+    def add_file_ref(self, message):
+        """Show a shared file with a link that downloads it on demand"""
+        self.chat_display.append([(
+            f"{message['sender']}: shared file {message['filename']} ({message['size']} bytes)",
+            lambda: self.client.download_file(message['sha256'], message['filename'])
+        )])
     
     def show_history(self):
         history_window = tk.Toplevel(self.root)
         history_window.title("Chat History")
         history_window.geometry("600x400")
         
-        # Create history display
-        history_display = scrolledtext.ScrolledText(
+        # Read from the client's local mirror; the server is only asked for
+        # what it does not hold yet
+        history = self.client.local_history
+        state = {'oldest': None, 'newest': None, 'done': False}
+        
+        def format_rows(rows):
+            lines = []
+            for message_id, sender, msg_type, content, timestamp, file_path in rows:
+                if msg_type == 'chat':
+                    lines.append((f"[{timestamp}] {sender}: {content}", None))
+                elif msg_type == 'file':
+                    lines.append((f"[{timestamp}] {sender} sent file: {content}", None))
+            return lines
+        
+        def show_status():
+            text = f"{len(history_display.model)} messages"
+            if history.loading():
+                text += ", loading..."
+            elif not state['done']:
+                text += ", scroll up for more"
+            status.config(text=text)
+        
+        def load_older():
+            """Called as the view nears the top: next page from the mirror, or the server"""
+            if state['done']:
+                return
+            rows = history.page(state['oldest'], HISTORY_VIEW_PAGE_SIZE)
+            if rows:
+                state['oldest'] = rows[-1][0]
+                if state['newest'] is None:
+                    state['newest'] = rows[0][0]
+                history_display.prepend(format_rows(reversed(rows)))
+            if len(rows) < HISTORY_VIEW_PAGE_SIZE:
+                if history.is_complete():
+                    state['done'] = not rows
+                else:
+                    self.client.fetch_older_history()
+            show_status()
+        
+        def show_newer():
+            if state['newest'] is None:
+                return
+            rows = history.after(state['newest'])
+            if rows:
+                state['newest'] = rows[-1][0]
+                history_display.append(format_rows(rows))
+        
+        # Oldest at the top; older pages load as the view nears the top
+        history_display = TranscriptView(
             history_window,
+            search=True,
+            on_top=load_older,
             wrap=tk.WORD,
             width=70,
             height=20
         )
         history_display.pack(padx=10, pady=10, fill=tk.BOTH, expand=True)
         
-        # Request history from server
-        self.client.request_history()
+        status = tk.Label(history_window, text="Loading...")
+        status.pack(pady=(0, 10))
         
-        def update_history(messages):
-            history_display.delete(1.0, tk.END)
-            for msg in messages:
-                sender, msg_type, content, timestamp, file_path = msg
-                if msg_type == 'chat':
-                    history_display.insert(tk.END, 
-                        f"[{timestamp}] {sender}: {content}\n")
-                elif msg_type == 'file':
-                    history_display.insert(tk.END,
-                        f"[{timestamp}] {sender} sent file: {content}\n")
+        def update_history(message):
+            if not history_window.winfo_exists():
+                return
+            # The client has already stored the rows in the mirror
+            show_newer()
+            if message['type'] == 'history_end':
+                show_status()
+                # Keep loading if the view is still near the top
+                history_display.refresh()
         
         # Update history when received
         self.history_callback = update_history
+        load_older()
+        # Pick up anything sent since the mirror was last synced
+        self.client.sync_history()
 
     def check_messages(self):
+        """Render everything queued by the client since the last wake-up"""
+        self.wake_pending = False
         if not self.client.is_connected():
             self.status_label.config(text="Disconnected", fg="red")
             self.show_error("Connection lost")
@@ -177,19 +329,59 @@ class ChatGUI:
             return
             
         messages = self.client.check_messages()
+        lines = []  # consecutive chat lines, inserted together
         for message in messages:
-            if message['type'] == 'user_list':
-                self.update_users(message['users'])
-            elif message['type'] == 'chat':
-                self.add_message(message['sender'], message['message'])
+            if message['type'] == 'chat':
+                if 'to' in message:
+                    lines.append(f"{message['sender']} → {message['to']}: {message['message']}")
+                elif 'room' in message:
+                    lines.append(f"[#{message['room']}] {message['sender']}: {message['message']}")
+                else:
+                    lines.append(f"{message['sender']}: {message['message']}")
+                continue
+            if message['type'] in ('room_joined', 'room_left'):
+                verb = "Joined" if message['type'] == 'room_joined' else "Left"
+                lines.append(f"{verb} #{message['room']}")
+                continue
+            if message['type'] == 'file_saved':
+                lines.append(f"Download: {message['filename']} saved to {message['path']}")
+                continue
+            # Keep the transcript in order around anything rendered separately
+            self.add_lines(lines)
+            lines = []
+            if message['type'] in ('user_list', 'user_joined', 'user_left'):
+                self.update_users(message)
             elif message['type'] == 'file':
                 self.handle_file_message(message)
-            elif message['type'] == 'chat_history':
+            elif message['type'] == 'file_ref':
+                if message['sender'] != self.client.username:
+                    self.add_file_ref(message)
+            elif message['type'] == 'file_progress':
+                percent = 100 * message['sent'] // max(1, message['size'])
+                self.status_label.config(text=f"Sending {message['filename']}: {percent}%", fg="blue")
+            elif message['type'] == 'file_sent':
+                self.show_upload_result(message)
+            elif message['type'] == 'file_error':
+                self.status_label.config(text=f"File error: {message['error']}", fg="red")
+            elif message['type'] == 'search_results':
+                self.show_search_results(message)
+            elif message['type'] == 'request_error':
+                self.status_label.config(text=f"{message['request']}: {message['error']}", fg="red")
+            elif message['type'] == 'chat_error':
+                self.status_label.config(text=message['error'], fg="red")
+            elif message['type'] in ('history_chunk', 'history_end'):
                 if hasattr(self, 'history_callback'):
-                    self.history_callback(message['history'])
-        
-        self.root.after(100, self.check_messages)
+                    self.history_callback(message)
+        self.add_lines(lines)
     
+    def show_search_results(self, message):
+        results = message['results']
+        lines = [f"Search '{message['query']}': {len(results)} result(s)"
+                 + (", more with a narrower query" if message.get('next_offset') else "")]
+        for _, sender, _, _, _, timestamp, _, snippet in results:
+            lines.append(f"  {timestamp} {sender}: {snippet}")
+        self.add_lines(lines)
+
     def on_closing(self):
         self.client.close()
         self.root.destroy()
@@ -0,0 +1,176 @@
+import heapq
+import threading
+from collections import deque
+from app.constants import HISTORY_CACHE_ROWS, HISTORY_CACHE_BYTES, HISTORY_PAGE_SIZE
+
+BROADCAST = 'all'
+_ROW_OVERHEAD = 120  # rough bytes per cached row beyond its text
+
+def _row_size(row):
+    return _ROW_OVERHEAD + len(row[1]) + len(row[4])
+
+class HistoryCache:
+    """Recent messages kept in memory in front of a ChatDatabase.
+
+    Messages live in one ring buffer per channel: 'all' for broadcasts,
+    '#<room>' for room messages and '@<user>' for each side of a direct
+    message (and for the sender of a room message). A user's history is the
+    merge of 'all' and their own channel, so recent pages are answered
+    without touching SQLite; pages reaching past what a channel still holds
+    fall through to the database query.
+
+    Rows are (id, sender, receiver, message_type, content, timestamp,
+    file_path). The cache follows the writer through ChatDatabase.on_commit,
+    so a lookup only waits for the writer when the requester's own newest
+    message (the `written` sequence number) is not committed yet. With
+    tail=True (several processes writing to one database) it instead picks
+    up new rows with a small id range query before each lookup.
+    """
+
+    def __init__(self, db, max_rows=HISTORY_CACHE_ROWS, max_bytes=HISTORY_CACHE_BYTES,
+                 tail=False):
+        self.db = db
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.tail = tail
+        self.channels = {}  # {channel: deque of rows, oldest first}
+        # (oldest id, channel) for each channel head; entries go stale as
+        # heads are evicted and are skipped when popped
+        self.heads = []
+        # Every row with an id above a channel's floor is in its buffer
+        self.floors = {}
+        self.floor = 0  # floor of channels with no rows yet
+        self.max_id = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if not tail:
+            db.on_commit = self.add
+        self.warm()
+
+    def warm(self):
+        """Load the newest messages so the first requests are hits"""
+        rows = self.db.recent_messages(self.max_rows)
+        with self.lock:
+            if len(rows) == self.max_rows:
+                # Older messages exist that were not loaded
+                self.floor = rows[0][0] - 1
+            self._add(rows)
+
+    def add(self, rows):
+        """Append newly committed rows, oldest first"""
+        with self.lock:
+            self._add(rows)
+
+    def _add(self, rows):
+        for row in rows:
+            if row[0] <= self.max_id:
+                continue
+            self.max_id = row[0]
+            if row[2] == BROADCAST:
+                self._append(BROADCAST, row)
+            elif row[2].startswith('#'):
+                self._append(row[2], row)
+                self._append('@' + row[1], row)
+            else:
+                self._append('@' + row[2], row)
+                if row[1] != row[2]:
+                    self._append('@' + row[1], row)
+        while self.bytes > self.max_bytes:
+            # Evict the oldest row across all channels
+            oldest_id, channel = heapq.heappop(self.heads)
+            rows = self.channels[channel]
+            if rows and rows[0][0] == oldest_id:
+                self._evict(channel)
+
+    def _append(self, channel, row):
+        if channel not in self.channels:
+            self.channels[channel] = deque()
+            self.floors[channel] = self.floor
+        rows = self.channels[channel]
+        rows.append(row)
+        if len(rows) == 1:
+            heapq.heappush(self.heads, (row[0], channel))
+        self.bytes += _row_size(row)
+        if len(rows) > self.max_rows:
+            self._evict(channel)
+
+    def _evict(self, channel):
+        rows = self.channels[channel]
+        row = rows.popleft()
+        self.bytes -= _row_size(row)
+        self.floors[channel] = row[0]
+        if rows:
+            heapq.heappush(self.heads, (rows[0][0], channel))
+        if len(self.heads) > 2 * len(self.channels) + 64:
+            # Drop the stale entries left by evictions
+            self.heads = [(rows[0][0], c) for c, rows in self.channels.items() if rows]
+            heapq.heapify(self.heads)
+
+    def _newest_first(self, channel, before_id, floor):
+        for row in reversed(self.channels.get(channel, ())):
+            if row[0] <= floor:
+                return
+            if row[0] < before_id:
+                yield row
+
+    def _cached_page(self, channels, before_id, limit):
+        floor = max(self.floors.get(channel, self.floor) for channel in channels)
+        if before_id is not None and before_id <= floor + 1:
+            return None
+        bound = before_id if before_id is not None else self.max_id + 1
+        merged = heapq.merge(
+            *(self._newest_first(channel, bound, floor) for channel in channels),
+            key=lambda row: row[0], reverse=True)
+        rows = []
+        for row in merged:
+            rows.append(row)
+            if len(rows) == limit:
+                break
+        # A short page is only the whole answer if nothing older was evicted
+        if len(rows) < limit and floor > 0:
+            return None
+        next_before_id = rows[-1][0] if len(rows) == limit else None
+        return [(row[1], row[3], row[4], row[5], row[6]) for row in rows], next_before_id
+
+    def _lookup(self, channels, before_id, limit, written):
+        # Make sure the requester's own queued writes have reached the cache
+        self.db.flush(written)
+        if self.tail:
+            rows = self.db.messages_after(self.max_id)
+            with self.lock:
+                self._add(rows)
+        with self.lock:
+            page = self._cached_page(channels, before_id, limit)
+            if page is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return page
+
+    def get_user_history_page(self, username, before_id=None, limit=HISTORY_PAGE_SIZE,
+                              written=None):
+        """Same result as ChatDatabase.get_user_history_page, from memory when possible"""
+        page = self._lookup((BROADCAST, '@' + username), before_id, limit, written)
+        if page is not None:
+            return page
+        return self.db.get_user_history_page(username, before_id, limit, written)
+
+    def get_room_history_page(self, room, before_id=None, limit=HISTORY_PAGE_SIZE,
+                              written=None):
+        """Same result as ChatDatabase.get_room_history_page, from memory when possible"""
+        page = self._lookup(('#' + room,), before_id, limit, written)
+        if page is not None:
+            return page
+        return self.db.get_room_history_page(room, before_id, limit, written)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'channels': len(self.channels),
+                'rows': sum(len(rows) for rows in self.channels.values()),
+                'bytes': self.bytes
+            }
@@ -0,0 +1,154 @@
+import json
+import os
+import queue
+import struct
+import threading
+from Crypto.Cipher import AES
+from Crypto.Protocol.KDF import scrypt
+from Crypto.PublicKey import RSA, ECC
+from Crypto.Random import get_random_bytes
+from app.constants import (
+    KEYRING_PATH, KEYRING_PASSPHRASE_ENV, KEY_POOL_SIZE, RSA_KEY_BITS, ECDH_CURVE
+)
+
+# Keyring file: magic, scrypt salt, GCM nonce, GCM tag, encrypted JSON
+_MAGIC = b'CKR1'
+_LAYOUT = struct.Struct('!4s16s12s16s')
+_RSA_COMPONENTS = ('n', 'e', 'd', 'p', 'q', 'u')
+
+class KeyRingError(Exception):
+    """Raised when the keyring cannot be opened (wrong passphrase or corrupt file)"""
+
+class KeyRing:
+    """Identity keys kept in one passphrase-encrypted file.
+
+    The passphrase is stretched with scrypt once when the keyring is
+    opened; after that loading a key is only a DER import, which is far
+    cheaper than generating one.
+    """
+
+    def __init__(self, path=KEYRING_PATH, passphrase=None):
+        if passphrase is None:
+            passphrase = os.environ.get(KEYRING_PASSPHRASE_ENV)
+        if not passphrase:
+            raise KeyRingError(f"No keyring passphrase (set {KEYRING_PASSPHRASE_ENV})")
+        self.path = path
+        self.passphrase = passphrase.encode() if isinstance(passphrase, str) else passphrase
+        self.lock = threading.Lock()
+        self.keys = {}  # {name: {kind: serialized key}}
+        self.salt = None
+        self.file_key = None
+        if os.path.exists(path):
+            self._read()
+        else:
+            self.salt = get_random_bytes(16)
+            self.file_key = self._derive(self.salt)
+
+    def _derive(self, salt):
+        return scrypt(self.passphrase, salt, 32, N=2 ** 14, r=8, p=1)
+
+    def _read(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        if len(data) < _LAYOUT.size or data[:4] != _MAGIC:
+            raise KeyRingError("Not a keyring file")
+        _, self.salt, nonce, tag = _LAYOUT.unpack_from(data)
+        self.file_key = self._derive(self.salt)
+        cipher = AES.new(self.file_key, AES.MODE_GCM, nonce=nonce)
+        try:
+            plaintext = cipher.decrypt_and_verify(data[_LAYOUT.size:], tag)
+        except ValueError:
+            raise KeyRingError("Wrong passphrase or corrupt keyring")
+        self.keys = json.loads(plaintext)
+
+    def _write(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        nonce = get_random_bytes(12)
+        cipher = AES.new(self.file_key, AES.MODE_GCM, nonce=nonce)
+        ciphertext, tag = cipher.encrypt_and_digest(json.dumps(self.keys).encode())
+        tmp_path = self.path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_LAYOUT.pack(_MAGIC, self.salt, nonce, tag) + ciphertext)
+        os.replace(tmp_path, self.path)
+
+    def load(self, name, kind='rsa'):
+        """Return the stored key, or None"""
+        with self.lock:
+            stored = self.keys.get(name, {}).get(kind)
+        if stored is None:
+            return None
+        if kind == 'rsa':
+            # Stored as components: the keyring is authenticated, so the slow
+            # primality checks of a DER import can be skipped
+            return RSA.construct([int(stored[c], 16) for c in _RSA_COMPONENTS],
+                                 consistency_check=False)
+        return ECC.import_key(bytes.fromhex(stored))
+
+    def save(self, name, key, kind='rsa'):
+        if kind == 'rsa':
+            serialized = {c: format(int(getattr(key, c)), 'x') for c in _RSA_COMPONENTS}
+        else:
+            serialized = key.export_key(format='DER').hex()
+        with self.lock:
+            self.keys.setdefault(name, {})[kind] = serialized
+            self._write()
+
+    def load_or_create(self, name, kind='rsa', pool=None):
+        key = self.load(name, kind)
+        if key is None:
+            if kind == 'rsa':
+                key = pool.get() if pool is not None else RSA.generate(RSA_KEY_BITS)
+            else:
+                key = ECC.generate(curve=ECDH_CURVE)
+            self.save(name, key, kind)
+        return key
+
+class KeyPool:
+    """RSA keypairs generated ahead of time on a background thread.
+
+    get() hands out a ready key immediately and the thread makes a
+    replacement; if the pool has run dry it generates one inline.
+    """
+
+    def __init__(self, size=KEY_POOL_SIZE, bits=RSA_KEY_BITS):
+        self.bits = bits
+        self.keys = queue.Queue(maxsize=size)
+        self.running = True
+        self.thread = threading.Thread(target=self._fill)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _fill(self):
+        while self.running:
+            key = RSA.generate(self.bits)
+            # Blocks while the pool is full
+            self.keys.put(key)
+
+    def get(self):
+        try:
+            return self.keys.get_nowait()
+        except queue.Empty:
+            return RSA.generate(self.bits)
+
+    def ready(self):
+        return self.keys.qsize()
+
+    def close(self):
+        self.running = False
+        # Unblock the filler if it is waiting on a full pool
+        try:
+            self.keys.get_nowait()
+        except queue.Empty:
+            pass
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+def default_pool():
+    """Process-wide KeyPool, started on first use"""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = KeyPool()
+        return _default_pool
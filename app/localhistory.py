@@ -0,0 +1,119 @@
+import os
+import re
+import sqlite3
+import threading
+from app.constants import LOCAL_HISTORY_PATH, HISTORY_VIEW_PAGE_SIZE
+
+# Local schema; the rows are the server's, keyed by the server message id
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    sender TEXT NOT NULL,
+    message_type TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp DATETIME,
+    file_path TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+# Rows returned by page() and after()
+COLUMNS = 'id, sender, message_type, content, timestamp, file_path'
+
+def local_history_path(username, server, port):
+    """Mirror file for one user on one server"""
+    safe = lambda value: re.sub(r'[^\w.-]', '_', str(value))
+    return LOCAL_HISTORY_PATH.format(username=safe(username), server=safe(server), port=port)
+
+class LocalHistory:
+    """Client-side SQLite mirror of the history fetched from the server.
+
+    The mirror always holds one unbroken run of the user's history, from
+    its oldest row up to a high-water mark. It only grows at the ends: a
+    catch-up stream of everything after the newest id, or a page before the
+    oldest one. Once a page comes back short, the start of the history has
+    been reached and 'complete' is recorded. Streams this mirror did not
+    ask for are ignored, so other history requests cannot leave gaps.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.pending = set()  # ('after', id) and ('before', id) requests in flight
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with sqlite3.connect(path) as conn:
+            conn.executescript(SCHEMA)
+
+    def bounds(self):
+        """(oldest id, newest id), both None while the mirror is empty"""
+        with sqlite3.connect(self.path) as conn:
+            return conn.execute('SELECT MIN(id), MAX(id) FROM messages').fetchone()
+
+    def is_complete(self):
+        with sqlite3.connect(self.path) as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'complete'").fetchone()
+        return row is not None
+
+    def page(self, before_id=None, limit=HISTORY_VIEW_PAGE_SIZE):
+        """Up to limit rows older than before_id, newest first"""
+        with sqlite3.connect(self.path) as conn:
+            return conn.execute(f'''
+                SELECT {COLUMNS} FROM messages
+                WHERE id < ?
+                ORDER BY id DESC
+                LIMIT ?
+            ''', (2 ** 63 - 1 if before_id is None else before_id, limit)).fetchall()
+
+    def after(self, after_id):
+        """Rows newer than after_id, oldest first"""
+        with sqlite3.connect(self.path) as conn:
+            return conn.execute(f'''
+                SELECT {COLUMNS} FROM messages
+                WHERE id > ?
+                ORDER BY id
+            ''', (after_id,)).fetchall()
+
+    def expect(self, kind, cursor):
+        """Record a request about to be sent; False if it is already in flight"""
+        with self.lock:
+            if (kind, cursor) in self.pending:
+                return False
+            self.pending.add((kind, cursor))
+            return True
+
+    def reset(self):
+        """Forget requests lost with a dropped connection"""
+        with self.lock:
+            self.pending.clear()
+
+    def loading(self):
+        with self.lock:
+            return bool(self.pending)
+
+    def receive(self, message):
+        """Store a history_chunk or history_end answering one of our requests"""
+        if message.get('after_id') is not None:
+            request = ('after', message['after_id'])
+        else:
+            request = ('before', message.get('before_id'))
+        with self.lock:
+            if request not in self.pending:
+                return
+            if message['type'] == 'history_end':
+                self.pending.discard(request)
+                if request[0] == 'before' and message.get('next_before_id') is None:
+                    with sqlite3.connect(self.path) as conn:
+                        conn.execute("INSERT OR REPLACE INTO meta VALUES ('complete', '1')")
+                return
+            # Servers without message ids cannot be mirrored
+            if 'ids' not in message:
+                return
+            with sqlite3.connect(self.path) as conn:
+                conn.executemany(f'''
+                    INSERT OR IGNORE INTO messages ({COLUMNS})
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', [(message_id,) + tuple(row)
+                      for message_id, row in zip(message['ids'], message['history'])])
@@ -0,0 +1,277 @@
+import os
+import sys
+import threading
+from collections import Counter as _Tally
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from app.constants import METRICS_HOST, HISTOGRAM_PRECISION_BITS, PROFILE_INTERVAL
+
+# Quantiles reported for every histogram
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+_MAX_MICROSECONDS = 2 ** 36  # about 19 hours; longer observations are clamped
+
+class Counter:
+    """Monotonic count, optionally split by one label"""
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        # Unlabelled counters report 0 before their first increment
+        self.values = {} if label else {None: 0}  # {label value or None: count}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, label=None):
+        with self.lock:
+            if label in self.values:
+                self.values[label] += amount
+            else:
+                self.values[label] = amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            values = sorted(self.values.items(), key=lambda item: str(item[0]))
+        for label, value in values:
+            selector = f'{{{self.label}="{label}"}}' if self.label and label is not None else ''
+            lines.append(f"{self.name}{selector} {value}")
+        return lines
+
+class Histogram:
+    """Latency histogram with HDR-style log-linear buckets.
+
+    Values are recorded in whole microseconds. Below 2**bits every value
+    has its own bucket; above that each power of two is split into
+    2**(bits - 1) equal buckets, so any quantile is accurate to within
+    1 / 2**(bits - 1) of the true value however wide the range is. Buckets
+    are a fixed list covering up to about 19 hours, so recording is a shift,
+    a list increment and a float add. Exposed as a Prometheus summary:
+    quantiles, _sum and _count, in seconds.
+    """
+
+    def __init__(self, name, help, bits=HISTOGRAM_PRECISION_BITS):
+        self.name = name
+        self.help = help
+        self.bits = bits
+        self.sub = 1 << bits
+        self.half = self.sub >> 1
+        self.buckets = [0] * (self._index(_MAX_MICROSECONDS) + 1)
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def _index(self, value):
+        if value < self.sub:
+            return value
+        shift = value.bit_length() - self.bits
+        return self.sub + (shift - 1) * self.half + (value >> shift) - self.half
+
+    def _bounds(self, index):
+        """Lowest value and width of a bucket"""
+        if index < self.sub:
+            return index, 1
+        shift = (index - self.sub) // self.half + 1
+        top = (index - self.sub) % self.half + self.half
+        return top << shift, 1 << shift
+
+    def observe(self, seconds):
+        value = int(seconds * 1000000)
+        if value < self.sub:
+            index = value
+        else:
+            if value > _MAX_MICROSECONDS:
+                value = _MAX_MICROSECONDS
+            shift = value.bit_length() - self.bits
+            index = self.sub + (shift - 1) * self.half + (value >> shift) - self.half
+        with self.lock:
+            self.buckets[index] += 1
+            self.total += seconds
+
+    def snapshot(self):
+        """(bucket counts, sum of observations)"""
+        with self.lock:
+            return list(self.buckets), self.total
+
+    def quantiles(self, quantiles=QUANTILES, buckets=None):
+        """{quantile: seconds}, taking the middle of the bucket each one falls in"""
+        if buckets is None:
+            buckets, _ = self.snapshot()
+        count = sum(buckets)
+        result = {}
+        if not count:
+            return result
+        remaining = list(quantiles)
+        seen = 0
+        for index, bucket_count in enumerate(buckets):
+            if not bucket_count:
+                continue
+            seen += bucket_count
+            while remaining and seen >= remaining[0] * count:
+                low, width = self._bounds(index)
+                result[remaining.pop(0)] = (low + (width - 1) / 2) / 1e6
+            if not remaining:
+                break
+        return result
+
+    def render(self):
+        buckets, total = self.snapshot()
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} summary"]
+        for quantile, value in self.quantiles(buckets=buckets).items():
+            lines.append(f'{self.name}{{quantile="{quantile}"}} {value:.6f}')
+        lines.append(f"{self.name}_sum {total:.6f}")
+        lines.append(f"{self.name}_count {sum(buckets)}")
+        return lines
+
+class Gauge:
+    """Value read from a callback at scrape time.
+
+    kind='counter' marks totals that only grow, such as those kept by the
+    worker pool and history cache, so rate() treats them correctly.
+    """
+
+    def __init__(self, name, help, read, kind='gauge'):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.kind = kind
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            lines.append(f"{self.name} {self.read()}")
+        except Exception as e:
+            lines.append(f"# {self.name} unavailable: {e}")
+        return lines
+
+class Registry:
+    """Named metrics, rendered together in the Prometheus text format"""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _add(self, metric):
+        with self.lock:
+            # Re-registering a name keeps the existing metric (gauges are replaced)
+            if metric.name in self.metrics and not isinstance(metric, Gauge):
+                return self.metrics[metric.name]
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help, label=None):
+        return self._add(Counter(name, help, label))
+
+    def histogram(self, name, help):
+        return self._add(Histogram(name, help))
+
+    def gauge(self, name, help, read, kind='gauge'):
+        return self._add(Gauge(name, help, read, kind))
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+# Process-wide registry the server modules record into
+REGISTRY = Registry()
+
+class SamplingProfiler:
+    """Wall-clock sampling profiler that can be switched on and off at runtime.
+
+    While running, a thread grabs the stack of every other thread each
+    `interval` seconds and counts identical stacks. stop() returns them in
+    the collapsed format (frames joined by ';', then the count) that
+    flamegraph.pl and speedscope read. Threads blocked in I/O or waits are
+    sampled too, which shows where time goes rather than only CPU.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = _Tally()
+        self.samples = 0
+        self.thread = None
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return False
+            self.stacks = _Tally()
+            self.samples = 0
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self._sample_loop)
+            self.thread.daemon = True
+            self.thread.start()
+            return True
+
+    def stop(self):
+        """Stop sampling and return the collapsed stacks"""
+        with self.lock:
+            if self.thread is None:
+                return ''
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def _sample_loop(self):
+        own = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stack.reverse()
+                self.stacks[';'.join(stack)] += 1
+            self.samples += 1
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        registry, profiler = self.server.registry, self.server.profiler
+        if self.path == '/metrics':
+            self._reply(registry.render(), 'text/plain; version=0.0.4')
+        elif self.path == '/profile/start':
+            started = profiler.start()
+            self._reply("profiler started\n" if started else "profiler already running\n")
+        elif self.path == '/profile/stop':
+            samples = profiler.samples
+            stacks = profiler.stop()
+            self._reply(stacks or f"profiler not running ({samples} samples)\n")
+        elif self.path == '/profile':
+            self._reply(f"running: {profiler.running}, samples: {profiler.samples}\n")
+        else:
+            self.send_error(404)
+
+    def _reply(self, text, content_type='text/plain'):
+        body = text.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are too frequent to print
+        pass
+
+def serve_metrics(port, registry=REGISTRY, profiler=None, host=METRICS_HOST):
+    """Serve /metrics and the /profile switches over HTTP from a daemon thread"""
+    httpd = ThreadingHTTPServer((host, port), _MetricsHandler)
+    httpd.daemon_threads = True
+    httpd.registry = registry
+    httpd.profiler = profiler if profiler is not None else SamplingProfiler()
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print(f"[+] Metrics on http://{host}:{port}/metrics")
+    return httpd
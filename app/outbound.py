@@ -0,0 +1,174 @@
+import asyncio
+import threading
+from collections import deque
+from app.constants import OUTBOUND_QUEUE_SIZE, BACKPRESSURE_TIMEOUT
+
+# Policies for clients whose outbound queue is full
+DROP_OLDEST = 'drop_oldest'    # discard the oldest queued frame
+DISCONNECT = 'disconnect'      # drop the client
+BACKPRESSURE = 'backpressure'  # make the sender wait, then drop the client
+SLOW_CLIENT_POLICIES = (DROP_OLDEST, DISCONNECT, BACKPRESSURE)
+
+class OutboundQueue:
+    """Bounded queue of encoded frames waiting to be written to one client.
+
+    Frames are shared bytes objects, so a broadcast costs one reference per
+    recipient rather than one copy. put() returns False when the client
+    should be disconnected.
+    """
+
+    def __init__(self, maxsize=OUTBOUND_QUEUE_SIZE, policy=DISCONNECT,
+                 timeout=BACKPRESSURE_TIMEOUT):
+        if policy not in SLOW_CLIENT_POLICIES:
+            raise ValueError(f"Unknown slow client policy: {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.timeout = timeout
+        self.frames = deque()
+        self.closed = False
+        self.queued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.high_water = 0
+
+    def depth(self):
+        return len(self.frames)
+
+    def full(self):
+        return len(self.frames) >= self.maxsize
+
+    def _append(self, data):
+        self.frames.append(data)
+        self.queued += 1
+        if len(self.frames) > self.high_water:
+            self.high_water = len(self.frames)
+
+    def stats(self):
+        return {
+            'depth': len(self.frames),
+            'high_water': self.high_water,
+            'queued': self.queued,
+            'sent': self.sent,
+            'dropped': self.dropped
+        }
+
+class ThreadedOutboundQueue(OutboundQueue):
+    """Outbound queue drained by a dedicated writer thread"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cond = threading.Condition()
+
+    def put(self, data):
+        with self.cond:
+            if self.closed:
+                return False
+            if self.full():
+                if self.policy == DROP_OLDEST:
+                    self.frames.popleft()
+                    self.dropped += 1
+                elif self.policy == DISCONNECT:
+                    return False
+                elif not self.cond.wait_for(
+                        lambda: not self.full() or self.closed, self.timeout):
+                    return False
+                if self.closed:
+                    return False
+            self._append(data)
+            self.cond.notify_all()
+            return True
+
+    def get(self):
+        """Block until a frame is available; returns None once closed"""
+        with self.cond:
+            self.cond.wait_for(lambda: self.frames or self.closed)
+            if self.closed:
+                return None
+            data = self.frames.popleft()
+            self.sent += 1
+            self.cond.notify_all()
+            return data
+
+    def wait_below(self, depth, timeout=None):
+        """Wait until fewer than depth frames are queued; False on timeout or close"""
+        with self.cond:
+            self.cond.wait_for(lambda: len(self.frames) < depth or self.closed, timeout)
+            return len(self.frames) < depth and not self.closed
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.frames.clear()
+            self.cond.notify_all()
+
+class AsyncOutboundQueue(OutboundQueue):
+    """Outbound queue drained by a writer task on the event loop.
+
+    put() never blocks; under the backpressure policy it lets the queue
+    overfill and the sending connection awaits wait_for_space() instead.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ready = asyncio.Event()
+        self.space = asyncio.Event()
+        self.space.set()
+        self.below = asyncio.Event()
+        self.below_depth = 0
+
+    def put(self, data):
+        if self.closed:
+            return False
+        if self.full():
+            if self.policy == DROP_OLDEST:
+                self.frames.popleft()
+                self.dropped += 1
+            elif self.policy == DISCONNECT:
+                return False
+            else:
+                self.space.clear()
+        self._append(data)
+        self.ready.set()
+        return True
+
+    async def get(self):
+        """Wait until a frame is available; returns None once closed"""
+        while not self.frames:
+            if self.closed:
+                return None
+            self.ready.clear()
+            await self.ready.wait()
+        data = self.frames.popleft()
+        self.sent += 1
+        if not self.full():
+            self.space.set()
+        if len(self.frames) < self.below_depth:
+            self.below.set()
+        return data
+
+    def overfull(self):
+        """True while a backpressure put has pushed the queue past its limit"""
+        return not self.space.is_set()
+
+    async def wait_for_space(self):
+        """Wait for the queue to drain below its limit; False on timeout"""
+        try:
+            await asyncio.wait_for(self.space.wait(), self.timeout)
+            return not self.closed
+        except asyncio.TimeoutError:
+            return False
+
+    async def wait_below(self, depth):
+        """Wait until fewer than depth frames are queued; False once closed"""
+        while len(self.frames) >= depth and not self.closed:
+            self.below_depth = depth
+            self.below.clear()
+            await self.below.wait()
+        return not self.closed
+
+    def close(self):
+        self.closed = True
+        self.frames.clear()
+        self.ready.set()
+        self.space.set()
+        self.below.set()
@@ -0,0 +1,140 @@
+import threading
+from app.constants import PRESENCE_WINDOW
+
+# Presence message types
+USER_LIST = 'user_list'      # full snapshot of online users
+USER_JOINED = 'user_joined'  # delta: users who logged in
+USER_LEFT = 'user_left'      # delta: users who logged out
+PRESENCE_TYPES = (USER_LIST, USER_JOINED, USER_LEFT)
+
+def _add(counts, username):
+    counts[username] = counts.get(username, 0) + 1
+
+def _take(counts, username):
+    """Remove one count of username; False if there was none"""
+    count = counts.get(username)
+    if not count:
+        return False
+    if count == 1:
+        del counts[username]
+    else:
+        counts[username] = count - 1
+    return True
+
+def _expand(counts):
+    """Usernames repeated once per count, in insertion order"""
+    return [username for username, count in counts.items() for _ in range(count)]
+
+class Presence:
+    """Versioned roster of online users.
+
+    join() and leave() calls are collected for `window` seconds and then sent
+    as at most one user_left and one user_joined delta, each bumping the
+    version by one, plus a single chat notice for each. A user who leaves
+    and comes back within the window produces no event at all. Clients
+    apply deltas in version order and ask for a snapshot on a gap.
+    """
+
+    def __init__(self, on_events=None, window=PRESENCE_WINDOW):
+        self.on_events = on_events
+        self.window = window
+        # Counted per connection, so a user with two logins stays listed
+        # until both are gone; dicts keep login order and make leave O(1)
+        self.users = {}  # {username: connections}
+        self.version = 0
+        self.joined = {}  # pending since the last flush, {username: count}
+        self.left = {}
+        self.lock = threading.Lock()
+        self.timer = None
+        # Events waiting for on_events, delivered in version order
+        self.outbox = []
+        self.delivering = False
+
+    def join(self, username):
+        with self.lock:
+            if not _take(self.left, username):
+                _add(self.joined, username)
+            self._schedule()
+
+    def leave(self, username):
+        with self.lock:
+            if not _take(self.joined, username):
+                _add(self.left, username)
+            self._schedule()
+
+    def _schedule(self):
+        if self.timer is None:
+            self.timer = threading.Timer(self.window, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        """Apply pending changes and hand their events to on_events"""
+        with self.lock:
+            self.timer = None
+            if self.left:
+                left = _expand(self.left)
+                for username in left:
+                    _take(self.users, username)
+                self.version += 1
+                self.outbox.append({
+                    'type': 'chat',
+                    'sender': 'Server',
+                    'message': f"{', '.join(left)} left the chat"
+                })
+                self.outbox.append({'type': USER_LEFT, 'users': left, 'version': self.version})
+            if self.joined:
+                joined = _expand(self.joined)
+                for username in joined:
+                    _add(self.users, username)
+                self.version += 1
+                self.outbox.append({
+                    'type': 'chat',
+                    'sender': 'Server',
+                    'message': f"{', '.join(joined)} joined the chat"
+                })
+                self.outbox.append({'type': USER_JOINED, 'users': joined, 'version': self.version})
+            self.joined = {}
+            self.left = {}
+            # Whoever is already delivering sends these after its own batch
+            if self.delivering or self.on_events is None:
+                return
+            self.delivering = True
+        # on_events runs without the lock, so a slow broadcast holds up
+        # only later deliveries, never join(), leave() or snapshot()
+        while True:
+            with self.lock:
+                events = self.outbox
+                self.outbox = []
+                if not events:
+                    self.delivering = False
+                    return
+            try:
+                self.on_events(events)
+            except Exception as e:
+                print(f"Presence delivery error: {e}")
+
+    def snapshot(self):
+        with self.lock:
+            return {'type': USER_LIST, 'users': _expand(self.users), 'version': self.version}
+
+    def apply(self, message):
+        """Follow another Presence through its snapshot and delta messages"""
+        with self.lock:
+            if message['type'] == USER_LIST:
+                self.users = {}
+                for username in message['users']:
+                    _add(self.users, username)
+                self.version = message['version']
+            elif message.get('version') == self.version + 1:
+                for username in message['users']:
+                    if message['type'] == USER_JOINED:
+                        _add(self.users, username)
+                    else:
+                        _take(self.users, username)
+                self.version = message['version']
+
+    def close(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
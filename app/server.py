@@ -1,9 +1,78 @@
 import socket, ssl, threading
 import json
+import re
 import base64
+import argparse
+import os
+import signal
+import sys
+import time
+from collections import deque
 import netifaces  # You might need to install this: pip install netifaces
 from app.crypto import CryptoHandler
 from app.database import ChatDatabase
+from app.historycache import HistoryCache
+from app.constants import (
+    RECV_SIZE, OUTBOUND_QUEUE_SIZE, HISTORY_PAGE_SIZE, MAX_HISTORY_PAGE_SIZE, BLOB_RANGE_SIZE,
+    ANCHOR_WINDOW, WORKER_POOL_SIZE, WORKER_MAX_PENDING, BACKPRESSURE_TIMEOUT,
+    CERT_PATH, DB_PATH, BLOB_DIR, SEARCH_PAGE_SIZE, MAX_SEARCH_PAGE_SIZE,
+    HISTORY_CACHE_ROWS, HISTORY_CACHE_BYTES, MAX_HISTORY_STREAM_ROWS, MAX_HISTORY_STREAMS
+)
+from app.bus import BusClient, JOIN, LEAVE
+from app.presence import Presence, PRESENCE_TYPES, USER_LIST
+from app.framing import FrameDecoder, FrameError, LINE, LENGTH, FRAMING_MODES
+from app.codec import wire_format, negotiate, available_codecs, available_compressions, JSON
+from app.outbound import ThreadedOutboundQueue, DISCONNECT, SLOW_CLIENT_POLICIES
+from app.filetransfer import decode_message, encode_chunk, verify_chunk, valid_transfer_id
+from app.blobstore import BlobStore
+from app.workers import WorkerPool, THREAD, WORKER_KINDS
+from app.metrics import REGISTRY, serve_metrics
+
+# Hot-path instrumentation; served with --metrics-port
+FRAMES_RECEIVED = REGISTRY.counter('chat_frames_received_total', 'Frames received from logged-in clients')
+MESSAGES_HANDLED = REGISTRY.counter('chat_messages_handled_total', 'Messages handled, by type', label='type')
+FRAME_DECODE = REGISTRY.histogram('chat_frame_decode_seconds', 'Time to decode one frame')
+MESSAGE_HANDLE = REGISTRY.histogram('chat_message_handle_seconds', 'Time to handle one decoded message')
+BROADCAST_FANOUT = REGISTRY.histogram('chat_broadcast_fanout_seconds', 'Time to encode and queue one broadcast for every client')
+BROADCAST_FRAMES = REGISTRY.counter('chat_broadcast_frames_total', 'Frames queued by broadcasts')
+CLIENT_SEND = REGISTRY.histogram('chat_client_send_seconds', 'Time to write one frame to a client connection')
+HISTORY_QUERY = REGISTRY.histogram('chat_history_query_seconds', 'Time to look up one history page')
+HISTORY_STREAM = REGISTRY.histogram('chat_history_stream_seconds', 'Time to stream one history request to the client')
+SEARCH_QUERY = REGISTRY.histogram('chat_search_query_seconds', 'Time to run one full-text search page')
+LOGINS = REGISTRY.counter('chat_logins_total', 'Successful logins')
+CLIENTS_DROPPED = REGISTRY.counter('chat_clients_dropped_total', 'Clients dropped by a broadcast for falling behind')
+
+# Room messages are stored with receiver '#<room>'
+ROOM_PREFIX = '#'
+_ROOM_NAME = re.compile(r'[\w-]{1,64}')
+
+def valid_room(room):
+    return isinstance(room, str) and _ROOM_NAME.fullmatch(room) is not None
+
+def valid_username(username):
+    """Usernames cannot clash with the 'all' and room receivers"""
+    return (isinstance(username, str) and username.strip() != ''
+            and username != 'all' and not username.startswith(ROOM_PREFIX))
+
+class BadRequest(ValueError):
+    """A request with invalid fields; the client gets a request_error, not a disconnect"""
+
+def int_field(message, key, default=None, low=None, high=None):
+    """An integer field of a request clamped to [low, high]; missing or null gives default"""
+    value = message.get(key)
+    if value is None:
+        return default
+    if isinstance(value, bool):
+        raise BadRequest(f"{key} must be an integer")
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise BadRequest(f"{key} must be an integer")
+    if low is not None:
+        value = max(low, value)
+    if high is not None:
+        value = min(high, value)
+    return value
 
 def get_local_ips():
     ips = []
@@ -21,146 +90,790 @@ def get_local_ips():
     return ips
 
 class SecureServer:
-    def __init__(self, host='0.0.0.0', port=9999):
+    def __init__(self, host='0.0.0.0', port=9999, queue_size=OUTBOUND_QUEUE_SIZE,
+                 slow_policy=DISCONNECT, anchor=False, workers=THREAD,
+                 worker_count=WORKER_POOL_SIZE, bus_path=None, certfile=CERT_PATH,
+                 db_path=DB_PATH, blob_dir=BLOB_DIR, metrics_port=None,
+                 history_cache_rows=HISTORY_CACHE_ROWS, history_cache_bytes=HISTORY_CACHE_BYTES):
         self.host = host
         self.port = port
+        self.certfile = certfile
+        # Shards of one server share the port and reach each other over the bus
+        self.reuse_port = bus_path is not None
+        self.queue_size = queue_size
+        self.slow_policy = slow_policy
         self.clients = {}  # {connection: username}
-        self.lock = threading.Lock()
+        # Recipient index, so routed messages cost O(recipients)
+        self.connections = {}  # {username: set of connections}
+        self.rooms = {}  # {room: set of connections}
+        self.memberships = {}  # {connection: set of rooms}
+        self.framing = {}  # {connection: framing mode}
+        self.formats = {}  # {connection: negotiated WireFormat}
+        self.outbound = {}  # {connection: outbound queue}
+        self.transfers = {}  # {transfer id: in-progress chunked upload}
+        self.streams = {}  # {connection: history streams waiting behind the running one}
+        self.blobs = BlobStore(blob_dir)
+        self.lock = threading.RLock()
         self.running = True
-        self.db = ChatDatabase()
+        # Decoding and handling run here; connection loops only frame and dispatch
+        self.workers = WorkerPool(workers, worker_count, preload=['app.filetransfer'])
+        # Messages are group-committed off the broadcast path
+        self.db = ChatDatabase(db_path, write_behind=True)
+        # Recent pages come from memory; shards share the database, so they tail it
+        self.history = HistoryCache(self.db, history_cache_rows, history_cache_bytes,
+                                    tail=bus_path is not None)
+        # {username: sequence number of their newest queued message}
+        self.written = {}
+        # Optional blockchain anchoring; web3 is only needed when enabled
+        self.chain = None
+        if anchor:
+            from app.blockchain import BlockchainManager
+            self.chain = BlockchainManager(
+                anchor_window=ANCHOR_WINDOW,
+                background=True,
+                on_status=self.post_event
+            )
         self.setup_server()
+        self.bus = None
+        if bus_path is not None:
+            # Shards follow the roster kept by the bus instead of owning one
+            self.presence = Presence()
+            self.bus = BusClient(bus_path, on_message=self.on_bus_message,
+                                 on_reconnect=self.rejoin_bus)
+        else:
+            self.presence = Presence(on_events=self.post_events)
+        self.register_gauges()
+        self.metrics_server = None
+        if metrics_port is not None:
+            self.metrics_server = serve_metrics(metrics_port)
+
+    def register_gauges(self):
+        """Expose the existing stats methods as metrics read at scrape time"""
+        queues = lambda: list(self.outbound_stats().values())
+        REGISTRY.gauge('chat_clients_connected', 'Logged-in clients', lambda: len(self.clients))
+        REGISTRY.gauge('chat_outbound_queue_depth', 'Frames waiting in all outbound queues',
+                       lambda: sum(q['depth'] for q in queues()))
+        REGISTRY.gauge('chat_outbound_queue_max_depth', 'Deepest outbound queue',
+                       lambda: max((q['depth'] for q in queues()), default=0))
+        REGISTRY.gauge('chat_outbound_dropped_frames', 'Frames dropped for connected clients',
+                       lambda: sum(q['dropped'] for q in queues()))
+        REGISTRY.gauge('chat_worker_active', 'Handler jobs running',
+                       lambda: self.worker_stats()['active'])
+        REGISTRY.gauge('chat_worker_queue_depth', 'Handler jobs waiting',
+                       lambda: self.worker_stats()['queue_depth'])
+        REGISTRY.gauge('chat_worker_completed_total', 'Handler jobs completed',
+                       lambda: self.worker_stats()['completed'], kind='counter')
+        REGISTRY.gauge('chat_history_cache_hits_total', 'History pages answered from memory',
+                       lambda: self.history_stats()['hits'], kind='counter')
+        REGISTRY.gauge('chat_history_cache_misses_total', 'History pages read from the database',
+                       lambda: self.history_stats()['misses'], kind='counter')
+        REGISTRY.gauge('chat_history_cache_bytes', 'Approximate size of the history cache',
+                       lambda: self.history_stats()['bytes'])
 
     def setup_server(self):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-        self.context.load_cert_chain(certfile="app/certs/server.pem")
+        self.context.load_cert_chain(certfile=self.certfile)
+
+    def send_raw(self, client, data):
+        """Write already-encoded bytes to a single client"""
+        client.sendall(data)
+
+    def close_client(self, client):
+        try:
+            # Unblock a writer thread stuck in sendall
+            client.shutdown(socket.SHUT_RDWR)
+        except:
+            pass
+        client.close()
+
+    def open_outbound(self, client):
+        """Create the client's outbound queue and start its writer thread"""
+        queue = ThreadedOutboundQueue(self.queue_size, self.slow_policy)
+        self.outbound[client] = queue
+        writer_thread = threading.Thread(
+            target=self.write_loop,
+            args=(client, queue)
+        )
+        writer_thread.daemon = True
+        writer_thread.start()
+
+    def write_loop(self, client, queue):
+        while True:
+            data = queue.get()
+            if data is None:
+                break
+            try:
+                start = time.perf_counter()
+                self.send_raw(client, data)
+                CLIENT_SEND.observe(time.perf_counter() - start)
+            except Exception:
+                self.remove_client(client)
+                break
+
+    def enqueue(self, client, data):
+        """Queue an encoded frame for a client; False if it must be dropped"""
+        queue = self.outbound.get(client)
+        if queue is None:
+            return False
+        return queue.put(data)
+
+    def outbound_stats(self):
+        """Outbound queue metrics per connected user"""
+        return {
+            username: self.outbound[client].stats()
+            for client, username in list(self.clients.items())
+            if client in self.outbound
+        }
+
+    def worker_stats(self):
+        """Handler pool size and queue depth"""
+        return self.workers.stats()
+
+    def history_stats(self):
+        """History cache hits, misses and size"""
+        return self.history.stats()
+
+    def send_to(self, client, message):
+        if not self.enqueue(client, self.formats.get(client, wire_format()).encode(message)):
+            self.remove_client(client)
 
     def broadcast(self, message):
-        data = (json.dumps(message) + '\n').encode()
+        """Send a message to every client, on every shard"""
+        if self.bus is not None:
+            self.bus.publish(message)
+        self.broadcast_local(message)
+
+    def broadcast_local(self, message):
+        # Serialize once per format; every queue shares the same frame object
+        self.broadcast_frames(lambda wire: wire.encode(message))
+
+    def route(self, message, users=None, room=None):
+        """Send a message to the connections of some users or of a room, on every shard"""
+        if self.bus is not None:
+            self.bus.publish(message, users=users, room=room)
+        self.route_local(message, users, room)
+
+    def route_local(self, message, users=None, room=None):
+        with self.lock:
+            if room is not None:
+                recipients = list(self.rooms.get(room, ()))
+            else:
+                recipients = [client for username in set(users)
+                              for client in self.connections.get(username, ())]
+        if recipients:
+            self.broadcast_frames(lambda wire: wire.encode(message), recipients)
+
+    def join_room(self, client, room):
+        with self.lock:
+            self.rooms.setdefault(room, set()).add(client)
+            self.memberships.setdefault(client, set()).add(room)
+
+    def leave_room(self, client, room):
+        with self.lock:
+            members = self.rooms.get(room)
+            if members is not None:
+                members.discard(client)
+                if not members:
+                    del self.rooms[room]
+            self.memberships.get(client, set()).discard(room)
+
+    def broadcast_frames(self, make_frame, clients=None):
+        """Send a frame to clients (all by default), encoding it once per wire format"""
+        start = time.perf_counter()
+        encoded = {}  # {wire format: frame}
         disconnected = []
+        if clients is None:
+            clients = list(self.clients)
         
-        for client in self.clients:
-            try:
-                client.sendall(data)
-            except:
+        for client in clients:
+            wire = self.formats.get(client, wire_format())
+            if wire not in encoded:
+                encoded[wire] = make_frame(wire)
+            if not self.enqueue(client, encoded[wire]):
                 disconnected.append(client)
+        BROADCAST_FANOUT.observe(time.perf_counter() - start)
+        BROADCAST_FRAMES.inc(len(clients) - len(disconnected))
         
-        # Clean up disconnected clients
+        # Clean up slow or disconnected clients
         for client in disconnected:
+            if client in self.clients:
+                print(f"[-] Dropping slow client: {self.clients[client]}")
+                CLIENTS_DROPPED.inc()
             self.remove_client(client)
 
+    def post_event(self, message):
+        """Broadcast a message from a background thread"""
+        self.broadcast(message)
+
+    def post_to(self, client, message):
+        """Send a message to one client from a background thread"""
+        self.send_to(client, message)
+
+    def wait_for_room(self, client):
+        """Block a bulk sender until the client's queue is half empty"""
+        queue = self.outbound.get(client)
+        if queue is None:
+            return False
+        return queue.wait_below(max(1, self.queue_size // 2), BACKPRESSURE_TIMEOUT)
+
+    def post_events(self, messages):
+        for message in messages:
+            self.post_event(message)
+
+    def post_local(self, message, users=None, room=None):
+        """Deliver a message relayed by the bus to this shard's clients"""
+        if users is None and room is None:
+            self.broadcast_local(message)
+        else:
+            self.route_local(message, users, room)
+
+    def on_bus_message(self, message, users=None, room=None):
+        if message['type'] in PRESENCE_TYPES:
+            # Update the roster first so a snapshot never misses a delta
+            self.presence.apply(message)
+            if message['type'] == USER_LIST:
+                return
+        self.post_local(message, users, room)
+
+    def announce_presence(self, presence, username):
+        """Report a login or logout; clients get coalesced, versioned deltas"""
+        if self.bus is not None:
+            # The bus owns the global roster and sends its events to every shard
+            self.bus.send({'type': presence, 'username': username})
+        elif presence == JOIN:
+            self.presence.join(username)
+        else:
+            self.presence.leave(username)
+
+    def rejoin_bus(self, attach):
+        """Switch to a restarted bus broker and announce this shard's users again"""
+        # Under the client lock, every login is announced exactly once:
+        # before attach() its JOIN was dropped but it is in the list below
+        with self.lock:
+            attach()
+            for username in self.clients.values():
+                self.bus.send({'type': JOIN, 'username': username})
+
+    def anchor_message(self, username, text):
+        """Queue a chat message for batched on-chain anchoring"""
+        if self.chain is not None:
+            self.chain.store_hash(json.dumps({'sender': username, 'message': text}, sort_keys=True))
+
+    def shutdown(self):
+        self.running = False
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+        self.workers.close()
+        self.presence.close()
+        if self.bus is not None:
+            self.bus.close()
+        self.db.close()
+        if self.chain is not None:
+            self.chain.close()
+
+    def add_client(self, client, username):
+        with self.lock:
+            self.clients[client] = username
+            self.connections.setdefault(username, set()).add(client)
+            print(f"[+] New user connected: {username}")
+            # The newcomer starts from a snapshot; everyone else gets a delta
+            self.send_to(client, self.presence.snapshot())
+            self.announce_presence(JOIN, username)
+
     def remove_client(self, client):
         with self.lock:
             if client in self.clients:
                 username = self.clients[client]
                 del self.clients[client]
+                connections = self.connections.get(username)
+                if connections is not None:
+                    connections.discard(client)
+                    if not connections:
+                        del self.connections[username]
+                        self.written.pop(username, None)
+                for room in list(self.memberships.get(client, ())):
+                    self.leave_room(client, room)
+                self.memberships.pop(client, None)
+                self.framing.pop(client, None)
+                self.formats.pop(client, None)
+                queue = self.outbound.pop(client, None)
+                if queue is not None:
+                    queue.close()
+                # The running stream stops at its next chunk; drop the waiting ones
+                pending = self.streams.get(client)
+                if pending is not None:
+                    pending.clear()
+                # Partial uploads stay on disk so the sender can resume until they expire
+                for transfer_id, transfer in list(self.transfers.items()):
+                    if transfer['client'] is client:
+                        self.abort_transfer(transfer_id)
                 try:
-                    client.close()
+                    self.close_client(client)
                 except:
                     pass
                 
                 # Notify others
-                self.broadcast({
-                    'type': 'chat',
-                    'sender': 'Server',
-                    'message': f"{username} left the chat"
-                })
-                self.broadcast({
-                    'type': 'user_list',
-                    'users': list(self.clients.values())
-                })
+                self.announce_presence(LEAVE, username)
 
-    def handle_client(self, client_sock, addr):
+    def save_message(self, sender, **fields):
+        """Store a message, remembering the sender's newest write for history reads"""
+        written = self.db.save_message(sender=sender, **fields)
+        if written is not None:
+            self.written[sender] = written
+
+    def handle_message(self, client, username, message):
+        """Process one decoded message from a logged-in client"""
+        if message['type'] == 'chat':
+            to, room = message.get('to'), message.get('room')
+            if to is not None and not valid_username(to):
+                self.send_to(client, {'type': 'chat_error', 'error': f"Invalid recipient: {to}"})
+                return
+            if room is not None and not valid_room(room):
+                self.send_to(client, {'type': 'chat_error', 'error': f"Invalid room: {room}"})
+                return
+            # Store chat message under the receiver it is routed to
+            receiver = to if to is not None else ROOM_PREFIX + room if room is not None else 'all'
+            self.save_message(
+                sender=username,
+                message_type='chat',
+                content=message['message'],
+                receiver=receiver
+            )
+            self.anchor_message(username, message['message'])
+            chat = {
+                'type': 'chat',
+                'sender': username,
+                'message': message['message']
+            }
+            if to is not None:
+                # Direct message: the recipient and the sender's own connections
+                chat['to'] = to
+                self.route(chat, users=[to, username])
+            elif room is not None:
+                # Posting to a room joins it
+                chat['room'] = room
+                self.join_room(client, room)
+                self.route(chat, room=room)
+            else:
+                # Broadcast message
+                self.broadcast(chat)
+        elif message['type'] == 'join_room':
+            if not valid_room(message.get('room')):
+                self.send_to(client, {'type': 'chat_error', 'error': "Invalid room name"})
+                return
+            self.join_room(client, message['room'])
+            self.send_to(client, {'type': 'room_joined', 'room': message['room']})
+        elif message['type'] == 'leave_room':
+            self.leave_room(client, message.get('room'))
+            self.send_to(client, {'type': 'room_left', 'room': message.get('room')})
+        elif message['type'] == 'file':
+            # Store file message
+            self.save_message(
+                sender=username,
+                message_type='file',
+                content=message['filename'],
+                file_path=f"downloads/{message['filename']}"
+            )
+            # Broadcast file
+            self.broadcast({
+                'type': 'file',
+                'sender': username,
+                'filename': message['filename'],
+                'file_data': message['file_data']
+            })
+        elif message['type'] == 'file_begin':
+            self.begin_transfer(client, username, message)
+        elif message['type'] == 'file_chunk':
+            self.store_chunk(client, message)
+        elif message['type'] == 'file_end':
+            self.end_transfer(client, username, message)
+        elif message['type'] == 'blob_request':
+            self.send_blob_range(client, message)
+        elif message['type'] == 'user_list_request':
+            # Clients ask for a snapshot when they miss a presence version
+            self.send_to(client, self.presence.snapshot())
+        elif message['type'] == 'search_request':
+            # Ranked full-text search over the messages this user can see
+            room = message.get('room')
+            if room is not None and not valid_room(room):
+                self.send_to(client, {'type': 'chat_error', 'error': "Invalid room name"})
+                return
+            offset = int_field(message, 'offset', 0, low=0)
+            limit = int_field(message, 'limit', SEARCH_PAGE_SIZE, 1, MAX_SEARCH_PAGE_SIZE)
+            for key in ('sender', 'since', 'until'):
+                if message.get(key) is not None and not isinstance(message[key], str):
+                    raise BadRequest(f"{key} must be a string")
+            with self.lock:
+                rooms = list(self.memberships.get(client, ()))
+            if room is not None and room not in rooms:
+                # An explicit room filter never reaches beyond the default search
+                self.send_to(client, {'type': 'chat_error', 'error': f"Not a member of room: {room}"})
+                return
+            start = time.perf_counter()
+            results, next_offset = self.db.search_messages(
+                username, str(message.get('query', '')),
+                sender=message.get('sender'), room=room,
+                since=message.get('since'), until=message.get('until'),
+                rooms=rooms, offset=offset, limit=limit)
+            SEARCH_QUERY.observe(time.perf_counter() - start)
+            self.send_to(client, {
+                'type': 'search_results',
+                'query': message.get('query', ''),
+                'results': results,
+                'offset': offset,
+                'next_offset': next_offset
+            })
+        elif message['type'] == 'history_request' and message.get('room') is not None:
+            # One page of a room's history, older than before_id
+            room = message['room']
+            if not valid_room(room):
+                self.send_to(client, {'type': 'chat_error', 'error': "Invalid room name"})
+                return
+            with self.lock:
+                member = room in self.memberships.get(client, ())
+            if not member:
+                self.send_to(client, {'type': 'chat_error', 'error': f"Not a member of room: {room}"})
+                return
+            before_id = int_field(message, 'before_id', low=1)
+            limit = int_field(message, 'limit', HISTORY_PAGE_SIZE, 1, MAX_HISTORY_PAGE_SIZE)
+            start = time.perf_counter()
+            history, next_before_id = self.history.get_room_history_page(
+                room, before_id, limit, self.written.get(username, 0))
+            HISTORY_QUERY.observe(time.perf_counter() - start)
+            self.send_to(client, {
+                'type': 'chat_history',
+                'room': room,
+                'history': history,
+                'before_id': before_id,
+                'next_before_id': next_before_id
+            })
+        elif message['type'] == 'history_request' and message.get('stream'):
+            # Streams are chunked and paced by the client, so the cap is generous
+            self.start_stream(client, username,
+                              int_field(message, 'before_id', low=1),
+                              int_field(message, 'limit', MAX_HISTORY_STREAM_ROWS,
+                                        1, MAX_HISTORY_STREAM_ROWS),
+                              int_field(message, 'after_id', low=0))
+        elif message['type'] == 'history_request':
+            # Handle history request, one page older than before_id
+            before_id = int_field(message, 'before_id', low=1)
+            limit = int_field(message, 'limit', HISTORY_PAGE_SIZE, 1, MAX_HISTORY_PAGE_SIZE)
+            start = time.perf_counter()
+            history, next_before_id = self.history.get_user_history_page(
+                username, before_id, limit, self.written.get(username, 0))
+            HISTORY_QUERY.observe(time.perf_counter() - start)
+            self.send_to(client, {
+                'type': 'chat_history',
+                'history': history,
+                'before_id': before_id,
+                'next_before_id': next_before_id
+            })
+
+    def start_stream(self, client, username, *args):
+        """Run a history stream on the client's stream thread.
+
+        Each client gets one thread that runs its streams one after another,
+        with at most MAX_HISTORY_STREAMS running or waiting.
+        """
+        with self.lock:
+            pending = self.streams.get(client)
+            if pending is not None:
+                if len(pending) + 1 >= MAX_HISTORY_STREAMS:
+                    raise BadRequest("Too many history streams")
+                pending.append(args)
+                return
+            self.streams[client] = deque([args])
+        stream_thread = threading.Thread(target=self.run_streams, args=(client, username))
+        stream_thread.daemon = True
+        stream_thread.start()
+
+    def run_streams(self, client, username):
+        while True:
+            with self.lock:
+                pending = self.streams[client]
+                if not pending:
+                    del self.streams[client]
+                    return
+                args = pending.popleft()
+            try:
+                self.stream_history(client, username, *args)
+            except Exception as e:
+                print(f"History stream error: {e}")
+
+    def stream_history(self, client, username, before_id, limit, after_id=None):
+        """Send history as history_chunk frames followed by history_end.
+
+        Chunks are read from the database only as fast as the client takes
+        them, so neither side holds more than a queue's worth of history.
+        Normally the stream runs newest first from before_id; with after_id
+        it runs oldest first over everything newer, for clients catching up
+        a local copy. Chunks carry the message ids alongside the rows.
+        """
+        start = time.perf_counter()
+        if after_id is not None:
+            chunks = self.db.iter_user_history_after(username, after_id, limit)
+        else:
+            chunks = self.db.iter_user_history(username, before_id, limit)
+        count = 0
+        last_id = None
+        for rows in chunks:
+            if not self.wait_for_room(client):
+                return
+            self.post_to(client, {
+                'type': 'history_chunk',
+                'before_id': before_id,
+                'after_id': after_id,
+                'ids': [row[0] for row in rows],
+                'history': [row[1:] for row in rows]
+            })
+            count += len(rows)
+            last_id = rows[-1][0]
+        self.post_to(client, {
+            'type': 'history_end',
+            'before_id': before_id,
+            'after_id': after_id,
+            'count': count,
+            'last_id': last_id,
+            # Only a stream that reached its limit can have older messages left
+            'next_before_id': last_id if after_id is None and count == limit else None
+        })
+        HISTORY_STREAM.observe(time.perf_counter() - start)
+
+    def file_error(self, client, transfer_id, error, **extra):
+        self.send_to(client, dict({
+            'type': 'file_error',
+            'transfer_id': transfer_id,
+            'error': error
+        }, **extra))
+
+    def begin_transfer(self, client, username, message):
+        """Start storing an uploaded file, or resume one from message['offset']"""
+        transfer_id = message.get('transfer_id')
+        if not valid_transfer_id(transfer_id):
+            self.file_error(client, transfer_id, 'Invalid transfer id')
+            return
+        filename = message.get('filename')
+        if not isinstance(filename, str):
+            raise BadRequest("filename must be a string")
+        offset = int_field(message, 'offset', 0, low=0)
+        size = int_field(message, 'size', low=0)
+        if size is not None and offset > size:
+            raise BadRequest("offset is past the end of the file")
+        existing = self.transfers.get(transfer_id)
+        if existing is not None:
+            if existing['client'] is not client:
+                self.file_error(client, transfer_id, 'Transfer id already in use')
+                return
+            existing['upload'].close()
+        upload = self.blobs.open_upload(transfer_id, offset, self.transfers)
+        if upload.size != offset:
+            # The server has less than the sender assumed; resume from there
+            upload.close()
+            self.file_error(client, transfer_id, 'Resume from offset', offset=upload.size)
+            return
+        self.transfers[transfer_id] = {
+            'client': client,
+            'filename': os.path.basename(filename),
+            'upload': upload
+        }
+
+    def store_chunk(self, client, message):
+        """Append one uploaded chunk to its blob store upload"""
+        transfer_id = message['transfer_id']
+        transfer = self.transfers.get(transfer_id)
+        if transfer is None or transfer['client'] is not client:
+            return
+        upload = transfer['upload']
+        if message['offset'] != upload.size or not verify_chunk(message):
+            self.abort_transfer(transfer_id)
+            self.file_error(client, transfer_id, 'Corrupt or out-of-order chunk',
+                            offset=upload.size)
+            return
+        upload.write(message['offset'], message['data'])
+
+    def end_transfer(self, client, username, message):
+        transfer_id = message['transfer_id']
+        transfer = self.transfers.get(transfer_id)
+        if transfer is None or transfer['client'] is not client:
+            return
+        del self.transfers[transfer_id]
+        upload = transfer['upload']
         try:
-            data = client_sock.recv(4096).decode()
-            if not data:
+            digest = self.blobs.commit(upload, message.get('sha256'))
+        except ValueError as e:
+            self.file_error(client, transfer_id, str(e))
+            return
+        # Store file message
+        self.save_message(
+            sender=username,
+            message_type='file',
+            content=transfer['filename'],
+            file_path=f"blob:{digest}"
+        )
+        # Recipients fetch the content on demand with blob_request
+        self.broadcast({
+            'type': 'file_ref',
+            'sender': username,
+            'filename': transfer['filename'],
+            'size': upload.size,
+            'sha256': digest
+        })
+
+    def abort_transfer(self, transfer_id):
+        """Stop an upload; its partial data is kept so the sender can resume"""
+        transfer = self.transfers.pop(transfer_id, None)
+        if transfer is not None:
+            transfer['upload'].close()
+
+    def send_blob_range(self, client, message):
+        """Answer a blob_request with one range of a stored file"""
+        digest = message.get('sha256')
+        transfer_id = digest[:32] if isinstance(digest, str) else None
+        if not self.blobs.exists(digest):
+            self.file_error(client, transfer_id, 'Unknown file')
+            return
+        size = self.blobs.size(digest)
+        offset = int_field(message, 'offset', 0, low=0)
+        length = int_field(message, 'length', BLOB_RANGE_SIZE, 1, BLOB_RANGE_SIZE)
+        mode = self.framing.get(client, LINE)
+        
+        self.send_to(client, {
+            'type': 'file_begin',
+            'transfer_id': transfer_id,
+            'sha256': digest,
+            'filename': os.path.basename(message.get('filename') or digest),
+            'size': size,
+            'offset': offset
+        })
+        end = offset
+        for pos, data in self.blobs.iter_range(digest, offset, length):
+            if not self.enqueue(client, encode_chunk(transfer_id, pos, data, mode)):
+                self.remove_client(client)
                 return
-            
-            message = json.loads(data.strip())
-            if message['type'] == 'login':
-                username = message['username']
-                with self.lock:
-                    self.clients[client_sock] = username
-                    print(f"[+] New user connected: {username}")
-                    # Announce new user
-                    self.broadcast({
-                        'type': 'chat',
-                        'sender': 'Server',
-                        'message': f"{username} joined the chat"
-                    })
-                    # Send updated user list
-                    self.broadcast({
-                        'type': 'user_list',
-                        'users': list(self.clients.values())
-                    })
+            end = pos + len(data)
+        self.send_to(client, {
+            'type': 'file_end',
+            'transfer_id': transfer_id,
+            'sha256': digest,
+            'size': size,
+            'end': max(end, offset)
+        })
+
+    def process_frame(self, client, username, frame):
+        """Worker job: decode one frame and hand the message on"""
+        if client not in self.clients:
+            return
+        FRAMES_RECEIVED.inc()
+        start = time.perf_counter()
+        try:
+            message = self.workers.run(decode_message, frame)
+        except ValueError as e:
+            print(f"Invalid message format: {e}")
+            return
+        FRAME_DECODE.observe(time.perf_counter() - start)
+        self.deliver(client, username, message)
+
+    def deliver(self, client, username, message):
+        self.dispatch_message(client, username, message)
+
+    def dispatch_message(self, client, username, message):
+        if client not in self.clients:
+            return
+        start = time.perf_counter()
+        try:
+            self.handle_message(client, username, message)
+            MESSAGE_HANDLE.observe(time.perf_counter() - start)
+            MESSAGES_HANDLED.inc(label=message.get('type'))
+        except BadRequest as e:
+            self.send_to(client, {'type': 'request_error', 'request': message.get('type'), 'error': str(e)})
+        except Exception as e:
+            print(f"Error handling client message: {e}")
+            self.remove_client(client)
+
+    def handle_frame(self, client, decoder, frame):
+        """Dispatch one frame; returns False to close the connection"""
+        username = self.clients.get(client)
+        if username is not None:
+            self.workers.submit(client, self.process_frame, client, username, frame)
+            return True
+        
+        try:
+            message = decode_message(frame)
+        except ValueError as e:
+            print(f"Invalid message format: {e}")
+            return True
+        # The first frame must be a login, always sent as a JSON line. It is
+        # handled inline because it decides how the following frames are split.
+        if message.get('type') != 'login':
+            return False
+        if not valid_username(message.get('username')):
+            print(f"[-] Rejected login with invalid username: {message.get('username')!r}")
+            return False
+        mode = message.get('framing', LINE)
+        if mode not in FRAMING_MODES:
+            mode = LINE
+        decoder.set_mode(mode)
+        self.framing[client] = mode
+        # Compact codecs and compression are opt-in and need length framing
+        codec, compression = JSON, None
+        if mode == LENGTH:
+            codec = negotiate(message.get('codecs'), available_codecs()) or JSON
+            compression = negotiate(message.get('compression'), available_compressions())
+        self.formats[client] = wire_format(mode, codec, compression)
+        self.open_outbound(client)
+        if 'codecs' in message or 'compression' in message:
+            self.send_to(client, {'type': 'welcome', 'codec': codec, 'compression': compression})
+        self.add_client(client, message['username'])
+        LOGINS.inc()
+        return True
+
+    def handle_client(self, client_sock, addr):
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = client_sock.recv(RECV_SIZE)
+                if not data:
+                    # Let frames already dispatched finish before cleanup
+                    self.workers.wait(client_sock, 0)
+                    break
                 
-                while True:
+                decoder.feed(data)
+                for frame in decoder:
                     try:
-                        data = client_sock.recv(4096).decode()
-                        if not data:
-                            break
-                        
-                        message = json.loads(data.strip())
-                        if message['type'] == 'chat':
-                            # Store chat message
-                            self.db.save_message(
-                                sender=username,
-                                message_type='chat',
-                                content=message['message']
-                            )
-                            # Broadcast message
-                            self.broadcast({
-                                'type': 'chat',
-                                'sender': username,
-                                'message': message['message']
-                            })
-                        elif message['type'] == 'file':
-                            # Store file message
-                            self.db.save_message(
-                                sender=username,
-                                message_type='file',
-                                content=message['filename'],
-                                file_path=f"downloads/{message['filename']}"
-                            )
-                            # Broadcast file
-                            self.broadcast({
-                                'type': 'file',
-                                'sender': username,
-                                'filename': message['filename'],
-                                'file_data': message['file_data']
-                            })
-                        elif message['type'] == 'history_request':
-                            # Handle history request
-                            history = self.db.get_user_chat_history(username)
-                            client_sock.send(json.dumps({
-                                'type': 'chat_history',
-                                'history': history
-                            }).encode() + b'\n')
-                            
-                    except json.JSONDecodeError:
-                        continue
+                        if not self.handle_frame(client_sock, decoder, frame):
+                            return
                     except Exception as e:
                         print(f"Error handling client message: {e}")
-                        break
+                        return
+                # Stop reading while this client's backlog is worked off
+                self.workers.wait(client_sock, WORKER_MAX_PENDING)
                         
+        except FrameError as e:
+            print(f"Framing error from {addr}: {e}")
         except Exception as e:
             print(f"Client handler error: {e}")
         finally:
             self.remove_client(client_sock)
 
+    def print_server_info(self):
+        print("\n=== Server Information ===")
+        print(f"Port: {self.port}")
+        print("\nServer IP Addresses:")
+        for ip in get_local_ips():
+            print(f"  - {ip}")
+        print("\nShare any of these IPs with clients on the same network")
+        print("=========================\n")
+
     def start(self):
         try:
             self.sock.bind((self.host, self.port))
             self.sock.listen(5)
             
-            print("\n=== Server Information ===")
-            print(f"Port: {self.port}")
-            print("\nServer IP Addresses:")
-            for ip in get_local_ips():
-                print(f"  - {ip}")
-            print("\nShare any of these IPs with clients on the same network")
-            print("=========================\n")
+            self.print_server_info()
             
             while self.running:
                 try:
@@ -184,11 +897,94 @@ class SecureServer:
             self.running = False
             self.sock.close()
 
-if __name__ == "__main__":
-    server = SecureServer()
+def run_server(engine='threads', **options):
+    """Run one server process until it is interrupted"""
+    if engine == 'asyncio':
+        from app.async_server import AsyncSecureServer
+        server_class = AsyncSecureServer
+    else:
+        server_class = SecureServer
+    # Exit through the finally below so worker processes are shut down too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    server = server_class(**options)
     try:
         server.start()
     except KeyboardInterrupt:
         print("\nShutting down server...")
     finally:
-        server.running = False
\ No newline at end of file
+        server.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Secure Chat Server')
+    parser.add_argument('--engine', '-e',
+                       choices=['threads', 'asyncio'],
+                       default='threads',
+                       help='Connection handling engine')
+    parser.add_argument('--port', '-p',
+                       type=int,
+                       default=9999,
+                       help='Port to listen on')
+    parser.add_argument('--queue-size',
+                       type=int,
+                       default=OUTBOUND_QUEUE_SIZE,
+                       help='Frames buffered per client before the slow client policy applies')
+    parser.add_argument('--slow-policy',
+                       choices=SLOW_CLIENT_POLICIES,
+                       default=DISCONNECT,
+                       help='What to do when a client cannot keep up')
+    parser.add_argument('--anchor',
+                       action='store_true',
+                       help='Anchor chat messages on the blockchain in Merkle batches')
+    parser.add_argument('--workers',
+                       choices=WORKER_KINDS,
+                       default=THREAD,
+                       help='Run message decoding in handler threads or worker processes')
+    parser.add_argument('--worker-count',
+                       type=int,
+                       default=WORKER_POOL_SIZE,
+                       help='Handler pool size (default: one per CPU core)')
+    
+    parser.add_argument('--cert',
+                       default=CERT_PATH,
+                       help='TLS certificate and key (PEM)')
+    parser.add_argument('--db',
+                       default=DB_PATH,
+                       help='Message database path')
+    parser.add_argument('--blob-dir',
+                       default=BLOB_DIR,
+                       help='Directory of the shared file store')
+    
+    parser.add_argument('--history-cache-rows',
+                       type=int,
+                       default=HISTORY_CACHE_ROWS,
+                       help='Recent messages kept in memory per history channel')
+    parser.add_argument('--history-cache-mb',
+                       type=float,
+                       default=HISTORY_CACHE_BYTES / (1024 * 1024),
+                       help='Approximate memory limit of the history cache')
+    
+    parser.add_argument('--metrics-port',
+                       type=int,
+                       help='Serve Prometheus metrics and profiler switches on this local port')
+    
+    parser.add_argument('--shards',
+                       type=int,
+                       default=1,
+                       help='Server processes sharing the port (Linux SO_REUSEPORT)')
+    
+    args = parser.parse_args()
+    if args.anchor and args.shards > 1:
+        parser.error("--anchor cannot be combined with --shards")
+    
+    options = dict(port=args.port, queue_size=args.queue_size,
+                   slow_policy=args.slow_policy, anchor=args.anchor,
+                   workers=args.workers, worker_count=args.worker_count,
+                   certfile=args.cert, db_path=args.db, blob_dir=args.blob_dir,
+                   metrics_port=args.metrics_port,
+                   history_cache_rows=args.history_cache_rows,
+                   history_cache_bytes=int(args.history_cache_mb * 1024 * 1024))
+    if args.shards > 1:
+        from app.sharding import run_sharded
+        run_sharded(args.engine, args.shards, **options)
+    else:
+        run_server(args.engine, **options)
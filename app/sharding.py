@@ -0,0 +1,49 @@
+import multiprocessing
+import signal
+import sys
+from app.bus import BusBroker
+from app.constants import BUS_SOCKET_PATH, DB_PATH
+from app.database import ChatDatabase
+from app.server import run_server
+
+def run_sharded(engine, shards, port, **options):
+    """Run a server as several processes sharing one listening port.
+
+    The kernel spreads new connections across the shards (SO_REUSEPORT), and
+    the shards exchange broadcasts and presence through a BusBroker running
+    in this supervising process. History and files are shared through the
+    database and blob store on disk.
+    """
+    path = BUS_SOCKET_PATH.format(port=port)
+    # Apply migrations once, before the shards open the database together
+    ChatDatabase(options.get('db_path', DB_PATH))
+    broker = BusBroker(path)
+    broker.start()
+    
+    # Fresh interpreters; forking would copy the broker's threads
+    context = multiprocessing.get_context('spawn')
+    # Each shard serves its own metrics, on consecutive ports
+    metrics_port = options.pop('metrics_port', None)
+    processes = [
+        context.Process(target=run_server, args=(engine,),
+                        kwargs=dict(options, port=port, bus_path=path,
+                                    metrics_port=None if metrics_port is None else metrics_port + i))
+        for i in range(shards)
+    ]
+    for process in processes:
+        process.start()
+    print(f"[+] Started {shards} shards on port {port}")
+    
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        print("\nShutting down shards...")
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+        broker.close()
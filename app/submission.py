@@ -0,0 +1,176 @@
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from app.constants import (
+    CHAIN_POOL_SIZE, CHAIN_MAX_IN_FLIGHT, CHAIN_MAX_RETRIES,
+    CHAIN_RETRY_BACKOFF, CHAIN_POLL_INTERVAL, CHAIN_MAX_RESUBMITS, CHAIN_RESUBMIT_DELAY
+)
+
+class SubmissionPipeline:
+    """Get digests on chain from background threads.
+
+    submit() only queues the digest. A submitter thread assigns nonces
+    locally, so up to `max_in_flight` transactions can be pending at once,
+    and retries failed sends with exponential backoff. A poller thread
+    collects receipts. A digest whose sends are exhausted or whose
+    transaction reverts is queued again after `resubmit_delay` seconds,
+    doubling each time, up to `max_resubmits` times. Progress is reported
+    through on_status(event) with event['status'] one of queued, submitted,
+    confirmed or failed; a failed event with 'retry_in' will be resubmitted.
+
+    `chain` provides pending_nonce(), send_store(digest, nonce) and
+    get_receipt(tx_hash) (None until mined); BlockchainManager and FakeChain
+    both do.
+    """
+
+    def __init__(self, chain, on_status=None, max_in_flight=CHAIN_MAX_IN_FLIGHT,
+                 max_retries=CHAIN_MAX_RETRIES, backoff=CHAIN_RETRY_BACKOFF,
+                 poll_interval=CHAIN_POLL_INTERVAL, workers=CHAIN_POOL_SIZE,
+                 max_resubmits=CHAIN_MAX_RESUBMITS, resubmit_delay=CHAIN_RESUBMIT_DELAY):
+        self.chain = chain
+        self.on_status = on_status
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self.max_resubmits = max_resubmits
+        self.resubmit_delay = resubmit_delay
+        self.resubmits = {}  # {digest: times resubmitted}
+        self.timers = set()
+        self.closing = False
+        self.jobs = queue.Queue()
+        self.in_flight = {}  # {tx hash: digest}
+        self.in_flight_lock = threading.Lock()
+        self.slots = threading.Semaphore(max_in_flight)
+        self.nonce = None
+        self.running = True
+        # Read-only calls such as verifyHash run here instead of on the caller
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        
+        self.submit_thread = threading.Thread(target=self._submit_loop)
+        self.submit_thread.daemon = True
+        self.submit_thread.start()
+        self.receipt_thread = threading.Thread(target=self._receipt_loop)
+        self.receipt_thread.daemon = True
+        self.receipt_thread.start()
+
+    def _emit(self, digest, status, **details):
+        if self.on_status is None:
+            return
+        event = {'type': 'anchor_status', 'digest': digest, 'status': status}
+        event.update(details)
+        try:
+            self.on_status(event)
+        except Exception as e:
+            print(f"Anchor status callback error: {e}")
+
+    def submit(self, digest):
+        self.jobs.put(digest)
+        self._emit(digest, 'queued')
+
+    def call(self, fn, *args):
+        """Run a blocking chain call in the pool; returns a Future"""
+        return self.executor.submit(fn, *args)
+
+    def pending(self):
+        with self.in_flight_lock:
+            return self.jobs.qsize() + len(self.in_flight)
+
+    def _submit_loop(self):
+        while True:
+            digest = self.jobs.get()
+            if digest is None:
+                break
+            self.slots.acquire()
+            if not self._send(digest):
+                self.slots.release()
+
+    def _send(self, digest):
+        delay = self.backoff
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                if self.nonce is None:
+                    self.nonce = self.chain.pending_nonce()
+                tx_hash = self.chain.send_store(digest, self.nonce)
+                self.nonce += 1
+                if hasattr(tx_hash, 'hex'):
+                    tx_hash = tx_hash.hex()
+                with self.in_flight_lock:
+                    self.in_flight[tx_hash] = digest
+                self._emit(digest, 'submitted', tx_hash=tx_hash)
+                return True
+            except Exception as e:
+                print(f"Chain submit failed (attempt {attempt}): {e}")
+                # Re-read the nonce in case ours went stale
+                self.nonce = None
+                if attempt < self.max_retries and self.running:
+                    time.sleep(delay)
+                    delay *= 2
+        self._fail(digest, error='submit retries exhausted')
+        return False
+
+    def _fail(self, digest, **details):
+        """Report a failure and schedule the digest again if it has resubmits left"""
+        with self.in_flight_lock:
+            count = self.resubmits.get(digest, 0)
+            retry = count < self.max_resubmits and not self.closing
+            if retry:
+                self.resubmits[digest] = count + 1
+                delay = self.resubmit_delay * 2 ** count
+                timer = threading.Timer(delay, self._resubmit, (digest,))
+                timer.daemon = True
+                self.timers.add(timer)
+                timer.start()
+            else:
+                self.resubmits.pop(digest, None)
+        if retry:
+            self._emit(digest, 'failed', retry_in=delay, **details)
+        else:
+            self._emit(digest, 'failed', **details)
+
+    def _resubmit(self, digest):
+        with self.in_flight_lock:
+            self.timers.discard(threading.current_thread())
+            if self.closing:
+                return
+        self.submit(digest)
+
+    def _receipt_loop(self):
+        while self.running or self.in_flight:
+            time.sleep(self.poll_interval)
+            with self.in_flight_lock:
+                waiting = list(self.in_flight.items())
+            for tx_hash, digest in waiting:
+                try:
+                    receipt = self.chain.get_receipt(tx_hash)
+                except Exception as e:
+                    print(f"Receipt poll failed: {e}")
+                    continue
+                if receipt is None:
+                    continue
+                with self.in_flight_lock:
+                    del self.in_flight[tx_hash]
+                self.slots.release()
+                if receipt.get('status', 1) == 1:
+                    with self.in_flight_lock:
+                        self.resubmits.pop(digest, None)
+                    self._emit(digest, 'confirmed', tx_hash=tx_hash,
+                               block=receipt.get('blockNumber'))
+                else:
+                    self._fail(digest, tx_hash=tx_hash, error='transaction reverted')
+
+    def close(self, timeout=None):
+        """Submit what is queued, wait for receipts, then stop.
+
+        Resubmissions still waiting on their delay are dropped.
+        """
+        with self.in_flight_lock:
+            self.closing = True
+            for timer in self.timers:
+                timer.cancel()
+            self.timers.clear()
+        self.jobs.put(None)
+        self.submit_thread.join(timeout)
+        self.running = False
+        self.receipt_thread.join(timeout)
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,239 @@
+import bisect
+import re
+import tkinter as tk
+from tkinter import font as tkfont
+
+_WORD = re.compile(r"\w+")
+
+def _words(text):
+    return set(_WORD.findall(text.lower()))
+
+class TranscriptModel:
+    """Lines of a transcript, oldest first, with a word index for search.
+
+    Entries are (text, link) pairs; link is None or a callback run when the
+    entry's [Download] link is clicked. Each entry gets a sequence number
+    that never changes: appended entries count up, prepended (older) ones
+    count down, so positions, search hits and trimming are all O(1) lookups
+    in a dict rather than shifts of a list. At most max_entries are kept;
+    appending beyond that drops the oldest.
+    """
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries
+        self.entries = {}  # {seq: (text, link)}
+        self.first = 0     # seq of the oldest entry
+        self.end = 0       # seq after the newest entry
+        self.index = {}    # {word: set of seqs}
+
+    def __len__(self):
+        return self.end - self.first
+
+    def __getitem__(self, position):
+        return self.entries[self.first + position]
+
+    def position(self, seq):
+        return seq - self.first
+
+    def _index(self, seq, text):
+        for word in _words(text):
+            self.index.setdefault(word, set()).add(seq)
+
+    def append(self, entries):
+        """Add entries at the newest end; returns how many old ones were dropped"""
+        for text, link in entries:
+            self.entries[self.end] = (text, link)
+            self._index(self.end, text)
+            self.end += 1
+        trimmed = 0
+        if self.max_entries is not None:
+            while len(self) > self.max_entries:
+                self._drop_oldest()
+                trimmed += 1
+        return trimmed
+
+    def prepend(self, entries):
+        """Add older entries, given oldest first, in front of the oldest one"""
+        for text, link in reversed(entries):
+            self.first -= 1
+            self.entries[self.first] = (text, link)
+            self._index(self.first, text)
+
+    def _drop_oldest(self):
+        text, _ = self.entries.pop(self.first)
+        for word in _words(text):
+            seqs = self.index[word]
+            seqs.discard(self.first)
+            if not seqs:
+                del self.index[word]
+        self.first += 1
+
+    def search(self, query):
+        """Positions of entries containing every word of query, oldest first"""
+        words = _words(query)
+        if not words:
+            return []
+        seqs = None
+        for word in sorted(words, key=lambda w: len(self.index.get(w, ()))):
+            found = self.index.get(word)
+            if not found:
+                return []
+            seqs = set(found) if seqs is None else seqs & found
+        return sorted(self.position(seq) for seq in seqs)
+
+class TranscriptView(tk.Frame):
+    """Scrollable view of a TranscriptModel that renders only what is visible.
+
+    The Text widget only ever holds the screenful of entries starting at
+    `top`, so appending, scrolling and jumping cost the same with ten
+    lines or a million. The scrollbar is driven from the model position.
+    While the view is at the bottom it follows new entries. on_top, if set,
+    is called when the view gets within two screens of the oldest entry,
+    which is where older pages should be loaded.
+    """
+
+    def __init__(self, master, model=None, search=False, on_top=None, **text_options):
+        super().__init__(master)
+        self.model = model if model is not None else TranscriptModel()
+        self.on_top = on_top
+        self.top = 0
+        self.rows = 20
+        self.follow = True
+        self.render_pending = False
+        self.matches = []
+        self.match = None  # position of the highlighted search hit
+
+        if search:
+            search_frame = tk.Frame(self)
+            search_frame.pack(fill=tk.X, pady=(0, 5))
+            self.search_input = tk.Entry(search_frame)
+            self.search_input.pack(side=tk.LEFT, fill=tk.X, expand=True)
+            self.search_input.bind('<Return>', lambda e: self.find_previous())
+            tk.Button(search_frame, text="Find", command=self.find_previous).pack(side=tk.LEFT, padx=5)
+            self.search_status = tk.Label(search_frame, width=12)
+            self.search_status.pack(side=tk.LEFT)
+
+        self.scrollbar = tk.Scrollbar(self, command=self.yview)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.text = tk.Text(self, state=tk.DISABLED, **text_options)
+        self.text.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.line_height = tkfont.Font(font=self.text.cget('font')).metrics('linespace')
+        self.text.tag_config('link', foreground="blue", underline=True)
+        self.text.tag_config('match', background="yellow")
+        self.text.tag_bind('link', '<Button-1>', self.click_link)
+
+        self.text.bind('<Configure>', self.resize)
+        self.text.bind('<MouseWheel>', lambda e: self.scroll(-3 if e.delta > 0 else 3))
+        self.text.bind('<Button-4>', lambda e: self.scroll(-3))
+        self.text.bind('<Button-5>', lambda e: self.scroll(3))
+        self.text.bind('<Prior>', lambda e: self.scroll(-self.rows))
+        self.text.bind('<Next>', lambda e: self.scroll(self.rows))
+
+    def append(self, entries):
+        if not entries:
+            return
+        trimmed = self.model.append(entries)
+        self.top = max(0, self.top - trimmed)
+        if self.match is not None:
+            self.match = self.match - trimmed if self.match >= trimmed else None
+        self.refresh()
+
+    def prepend(self, entries):
+        if not entries:
+            return
+        self.model.prepend(entries)
+        # Keep the same entries on screen
+        self.top += len(entries)
+        if self.match is not None:
+            self.match += len(entries)
+        self.refresh()
+
+    def resize(self, event):
+        self.rows = max(1, event.height // self.line_height)
+        self.refresh()
+
+    def last_top(self):
+        return max(0, len(self.model) - self.rows)
+
+    def scroll(self, lines):
+        self.move_to(self.top + lines)
+        return 'break'
+
+    def move_to(self, top):
+        self.top = min(max(0, top), self.last_top())
+        self.follow = self.top >= self.last_top()
+        self.refresh()
+
+    def yview(self, *args):
+        """Scrollbar command: moveto fraction, or scroll n units/pages"""
+        if args[0] == tk.MOVETO:
+            self.move_to(int(float(args[1]) * len(self.model)))
+        elif args[0] == tk.SCROLL:
+            step = self.rows if args[2] == tk.PAGES else 1
+            self.move_to(self.top + int(args[1]) * step)
+
+    def refresh(self):
+        """Re-render once the current burst of updates is done"""
+        if not self.render_pending:
+            self.render_pending = True
+            self.after_idle(self.render)
+
+    def render(self):
+        self.render_pending = False
+        if not self.winfo_exists():
+            return
+        if self.follow:
+            self.top = self.last_top()
+        # One extra entry so a partly visible last line is still drawn
+        end = min(len(self.model), self.top + self.rows + 1)
+        self.text.config(state=tk.NORMAL)
+        self.text.delete('1.0', tk.END)
+        for position in range(self.top, end):
+            text, link = self.model[position]
+            if position > self.top:
+                self.text.insert(tk.END, '\n')
+            # One Text line per entry, so clicks map back to entries
+            self.text.insert(tk.END, text.replace('\n', ' '),
+                             'match' if position == self.match else ())
+            if link is not None:
+                self.text.insert(tk.END, ' ')
+                self.text.insert(tk.END, "[Download]", 'link')
+        self.text.config(state=tk.DISABLED)
+        # Wrapped lines can push the newest entry off screen
+        if self.follow:
+            self.text.see(tk.END)
+
+        total = len(self.model)
+        if total:
+            self.scrollbar.set(self.top / total, min(1.0, (self.top + self.rows) / total))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+        if self.on_top is not None and self.top < 2 * self.rows:
+            self.on_top()
+
+    def click_link(self, event):
+        line = int(self.text.index(f'@{event.x},{event.y}').split('.')[0])
+        _, link = self.model[self.top + line - 1]
+        if link is not None:
+            link()
+
+    def find_previous(self):
+        """Jump to the next older entry matching the search box"""
+        query = self.search_input.get()
+        self.matches = self.model.search(query)
+        start = self.match if self.match is not None else len(self.model)
+        i = bisect.bisect_left(self.matches, start)
+        if not self.matches:
+            self.match = None
+            self.search_status.config(text="No matches")
+        elif i == 0:
+            # Wrap around to the newest match
+            self.match = self.matches[-1]
+            self.search_status.config(text=f"{len(self.matches)}/{len(self.matches)}")
+        else:
+            self.match = self.matches[i - 1]
+            self.search_status.config(text=f"{i}/{len(self.matches)}")
+        if self.match is not None:
+            self.move_to(self.match - self.rows // 2)
+        else:
+            self.refresh()
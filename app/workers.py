@@ -0,0 +1,116 @@
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from app.constants import WORKER_POOL_SIZE
+
+# Where CPU-heavy steps run
+THREAD = 'thread'    # handler threads; cheap hand-off, shares the GIL
+PROCESS = 'process'  # pure steps such as decoding also go to worker processes
+WORKER_KINDS = (THREAD, PROCESS)
+
+_preload = set()
+
+def process_context(preload=()):
+    """Multiprocessing context for every worker process pool in the server.
+
+    Forking a process that already runs I/O threads can deadlock the child,
+    so workers fork from a clean forkserver instead. Modules in preload are
+    imported there once, if it has not started yet.
+    """
+    context = multiprocessing.get_context('forkserver')
+    _preload.update(preload)
+    context.set_forkserver_preload(sorted(_preload))
+    return context
+
+class WorkerPool:
+    """Runs message handling off the connection I/O loops.
+
+    Jobs are submitted under a key (the connection) and jobs with the same
+    key run one at a time in submission order, so a client's frames are
+    still handled in the order they arrived. Different keys take turns on
+    the pool, so one busy uploader cannot starve everyone else's chat.
+    """
+
+    def __init__(self, kind=THREAD, size=WORKER_POOL_SIZE, preload=()):
+        if kind not in WORKER_KINDS:
+            raise ValueError(f"Unknown worker kind: {kind}")
+        self.kind = kind
+        self.size = size or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix='worker')
+        self.processes = None
+        if kind == PROCESS:
+            self.processes = ProcessPoolExecutor(max_workers=self.size,
+                                                 mp_context=process_context(preload))
+        self.queues = {}  # {key: deque of (fn, args) waiting or running}
+        self.cond = threading.Condition()
+        self.submitted = 0
+        self.completed = 0
+        self.active = 0
+
+    def run(self, fn, *args):
+        """Run a pure CPU step, in a worker process when the pool has them"""
+        if self.processes is None:
+            return fn(*args)
+        return self.processes.submit(fn, *args).result()
+
+    def submit(self, key, fn, *args):
+        """Queue fn(*args) to run after every earlier job with the same key"""
+        with self.cond:
+            self.submitted += 1
+            queue = self.queues.get(key)
+            if queue is not None:
+                queue.append((fn, args))
+                return
+            self.queues[key] = deque([(fn, args)])
+        self.executor.submit(self._run_next, key)
+
+    def _run_next(self, key):
+        with self.cond:
+            queue = self.queues[key]
+            fn, args = queue[0]
+            self.active += 1
+        try:
+            fn(*args)
+        except Exception as e:
+            print(f"Worker error: {e}")
+        with self.cond:
+            self.active -= 1
+            self.completed += 1
+            queue.popleft()
+            self.cond.notify_all()
+            if not queue:
+                del self.queues[key]
+                return
+        # Back of the line, so other keys get a turn
+        self.executor.submit(self._run_next, key)
+
+    def pending(self, key):
+        """Jobs queued or running for one key"""
+        with self.cond:
+            queue = self.queues.get(key)
+            return len(queue) if queue else 0
+
+    def wait(self, key, limit, timeout=None):
+        """Block until a key has at most limit jobs pending"""
+        with self.cond:
+            return self.cond.wait_for(
+                lambda: len(self.queues.get(key, ())) <= limit, timeout)
+
+    def stats(self):
+        with self.cond:
+            pending = sum(len(queue) for queue in self.queues.values())
+            return {
+                'kind': self.kind,
+                'size': self.size,
+                'active': self.active,
+                'queue_depth': pending - self.active,
+                'submitted': self.submitted,
+                'completed': self.completed
+            }
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        if self.processes is not None:
+            self.processes.shutdown(wait=False)
@@ -0,0 +1,105 @@
+"""Compare wire size and encode/decode time of each negotiable wire format.
+
+    python -m benchmarks.bench_codecs [--count N] [--json results.json]
+
+Traffic:
+  chat     a burst of individual chat broadcasts of mixed length
+  history  chat_history pages of 100 rows
+  users    user_list snapshots of 500 users
+
+Formats are every available codec (json, msgpack) with no compression,
+zlib and zstd. Formats whose optional package is missing are skipped.
+"""
+import argparse
+import json
+import random
+import time
+from app.codec import (
+    WireFormat, decode_payload, available_codecs, available_compressions
+)
+from app.framing import LENGTH
+
+WORDS = ("the quick brown fox jumps over lazy dog meeting at noon see you there "
+         "sounds good file sent thanks let me check blockchain anchored message").split()
+
+def sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+def chat_traffic(rng, count):
+    return [{
+        'type': 'chat',
+        'sender': f"user{rng.randrange(50)}",
+        'message': sentence(rng, rng.choice((3, 8, 20, 60)))
+    } for _ in range(count)]
+
+def history_traffic(rng, count):
+    return [{
+        'type': 'chat_history',
+        'history': [
+            [f"user{rng.randrange(50)}", 'chat', sentence(rng, rng.randrange(3, 30)),
+             f"2024-05-{rng.randrange(1, 29):02d} 12:{rng.randrange(60):02d}:00", None]
+            for _ in range(100)
+        ],
+        'before_id': None,
+        'next_before_id': rng.randrange(10 ** 6)
+    } for _ in range(max(1, count // 100))]
+
+def users_traffic(rng, count):
+    return [{
+        'type': 'user_list',
+        'users': [f"user{i}" for i in range(500)],
+        'version': i
+    } for i in range(max(1, count // 100))]
+
+def measure(wire, messages):
+    start = time.perf_counter()
+    payloads = [wire.encode_payload(m) for m in messages]
+    encode = time.perf_counter() - start
+    start = time.perf_counter()
+    for payload in payloads:
+        decode_payload(payload)
+    decode = time.perf_counter() - start
+    return {
+        'messages': len(messages),
+        # Length-prefixed frames: 4 header bytes each
+        'bytes': sum(len(p) + 4 for p in payloads),
+        'encode_us': round(encode / len(messages) * 1e6, 2),
+        'decode_us': round(decode / len(messages) * 1e6, 2)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Wire format benchmark')
+    parser.add_argument('--count', '-n', type=int, default=5000,
+                        help='Chat messages per run (history and user lists scale from it)')
+    parser.add_argument('--json', help='Write results to this file')
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    traffic = {
+        'chat': chat_traffic(rng, args.count),
+        'history': history_traffic(rng, args.count),
+        'users': users_traffic(rng, args.count)
+    }
+    formats = [(codec, compression) for codec in available_codecs()
+               for compression in [None] + available_compressions()]
+
+    results = {}
+    for name, messages in traffic.items():
+        # Baseline: the original JSON lines
+        baseline = sum(len(json.dumps(m).encode()) + 1 for m in messages)
+        results[name] = {'json_lines_bytes': baseline, 'formats': {}}
+        print(f"\n{name} ({len(messages)} messages, JSON lines: {baseline} bytes)")
+        print(f"{'format':<18}{'bytes':>12}{'ratio':>8}{'encode us':>12}{'decode us':>12}")
+        for codec, compression in formats:
+            label = codec + (f"+{compression}" if compression else '')
+            stats = measure(WireFormat(LENGTH, codec, compression), messages)
+            results[name]['formats'][label] = stats
+            print(f"{label:<18}{stats['bytes']:>12}{stats['bytes'] / baseline:>8.2f}"
+                  f"{stats['encode_us']:>12}{stats['decode_us']:>12}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
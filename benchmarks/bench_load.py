@@ -0,0 +1,380 @@
+"""Drive a local server with many headless clients and measure throughput and latency.
+
+    python -m benchmarks.bench_load [--clients N] [--rate R] [--duration S]
+        [--mix chat=90,file=5,history=5] [--procs P] [--engine threads|asyncio]
+        [--json results.json] [--baseline old.json] [--server-arg=--workers=process ...]
+
+The server runs as a subprocess on localhost with a throwaway certificate,
+database and blob store in a temporary directory, so nothing under app/ is
+touched. Clients are plain SecureClient connections without the GUI, split
+across --procs load processes so the load generator itself is not held back
+by one interpreter lock.
+
+Traffic is sent at --rate operations per second in total, each picked by
+--mix weight and sent by a random client:
+  chat     a broadcast carrying its send time; every client that receives
+           it records the end-to-end latency
+  file     a --file-size upload through the chunked file protocol
+  history  a streamed history_request of 100 rows, timed to its history_end
+
+Reported: connect rate and connect time, messages sent and delivered per
+second, p50/p99/p999 broadcast latency, and upload and history timings.
+With --json the results (and the git commit) are saved; --baseline prints
+the change against an earlier results file.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from app.client import SecureClient
+from app.database import ChatDatabase
+
+TAG = 'bench@'  # prefix of timed chat messages: bench@<send time>
+OPERATIONS = ('chat', 'file', 'history')
+
+def parse_mix(text):
+    weights = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Unknown operation: {name}")
+        weights[name] = float(weight)
+    return weights
+
+def percentiles(samples):
+    """p50/p99/p999/max of a list of seconds, in milliseconds"""
+    if not samples:
+        return None
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+    return {
+        'count': len(samples),
+        'p50_ms': round(pick(0.5) * 1000, 3),
+        'p99_ms': round(pick(0.99) * 1000, 3),
+        'p999_ms': round(pick(0.999) * 1000, 3),
+        'max_ms': round(samples[-1] * 1000, 3)
+    }
+
+def make_cert(path):
+    subprocess.run([
+        "openssl", "req", "-x509", "-newkey", "rsa:2048",
+        "-keyout", path, "-out", path,
+        "-days", "1", "-nodes", "-subj", "/CN=localhost"
+    ], check=True, capture_output=True)
+
+def preload_history(db_path, count):
+    """Fill the database so history requests scan a realistic table"""
+    ChatDatabase(db_path)
+    rng = random.Random(1)
+    with sqlite3.connect(db_path) as conn:
+        conn.executemany('''
+            INSERT INTO messages (sender, receiver, message_type, content)
+            VALUES (?, 'all', 'chat', ?)
+        ''', ((f"old{rng.randrange(100)}", f"preloaded message {i}") for i in range(count)))
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Server exited during startup")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("Server did not start listening")
+
+class LoadClient:
+    """One connection plus the timings recorded from its receiver thread"""
+
+    def __init__(self, name, port, stats):
+        self.stats = stats
+        self.history_sent = deque()
+        self.client = SecureClient(name, port=port, local_history=False)
+        self.client.on_receive = self.on_receive
+
+    def on_receive(self):
+        now = time.time()
+        for message in self.client.check_messages():
+            if message['type'] == 'chat':
+                text = message.get('message', '')
+                if text.startswith(TAG):
+                    self.stats['chat'].append(now - float(text[len(TAG):].split(' ', 1)[0]))
+            elif message['type'] == 'history_end' and self.history_sent:
+                self.stats['history'].append(time.monotonic() - self.history_sent.popleft())
+
+    def chat(self, size):
+        text = f"{TAG}{time.time():.6f} "
+        return self.client.send_message(text + 'x' * max(0, size - len(text)))
+
+    def history(self):
+        self.history_sent.append(time.monotonic())
+        return self.client.request_history(limit=100, stream=True)
+
+    def upload(self, path):
+        start = time.monotonic()
+        if self.client.send_file(path):
+            self.stats['file'].append(time.monotonic() - start)
+
+def load_process(index, names, config, connected, started, results):
+    """Connect this process's share of clients, then send its share of the load"""
+    # Client chatter goes to a log file instead of the terminal
+    sys.stdout = open(os.path.join(config['tmp_dir'], f"clients-{index}.log"), 'w')
+    stats = {'chat': [], 'history': [], 'file': [], 'connect': []}
+    clients = []
+
+    def connect(name):
+        start = time.monotonic()
+        try:
+            client = LoadClient(name, config['port'], stats)
+        except ConnectionError:
+            return
+        stats['connect'].append(time.monotonic() - start)
+        clients.append(client)
+
+    connect_start = time.time()
+    with ThreadPoolExecutor(config['connect_concurrency']) as pool:
+        list(pool.map(connect, names))
+    connect_end = time.time()
+    connected.wait()
+    started.wait()
+
+    rng = random.Random(index)
+    operations = list(config['mix'])
+    weights = [config['mix'][op] for op in operations]
+    rate = config['rate'] / config['procs']
+    sent = {op: 0 for op in OPERATIONS}
+    late = 0
+    uploads = ThreadPoolExecutor(4)
+    start = time.monotonic()
+    count = int(rate * config['duration'])
+    for i in range(count):
+        # Operations are paced against a fixed schedule
+        due = start + i / rate
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < -0.01:
+            late += 1
+        if not clients:
+            break
+        client = rng.choice(clients)
+        op = rng.choices(operations, weights)[0]
+        if op == 'chat':
+            client.chat(config['message_size'])
+        elif op == 'history':
+            client.history()
+        else:
+            uploads.submit(client.upload, config['file_path'])
+        sent[op] += 1
+    uploads.shutdown(wait=True)
+    send_seconds = time.monotonic() - start
+
+    # Give in-flight messages time to arrive
+    time.sleep(config['drain'])
+    results.put({
+        'connect_start': connect_start,
+        'connect_end': connect_end,
+        'connected': len(clients),
+        'still_connected': sum(1 for c in clients if c.client.is_connected()),
+        'sent': sent,
+        'late': late,
+        'send_seconds': send_seconds,
+        'stats': stats
+    })
+    for client in clients:
+        client.client.close()
+
+def summarize(config, reports):
+    merged = {key: [] for key in ('chat', 'history', 'file', 'connect')}
+    for report in reports:
+        for key in merged:
+            merged[key].extend(report['stats'][key])
+    sent = {op: sum(r['sent'][op] for r in reports) for op in OPERATIONS}
+    connected = sum(r['connected'] for r in reports)
+    connect_seconds = max(r['connect_end'] for r in reports) - min(r['connect_start'] for r in reports)
+    send_seconds = max(r['send_seconds'] for r in reports)
+    # Every client, the sender included, gets each broadcast
+    expected = sent['chat'] * connected
+    return {
+        'config': {key: value for key, value in config.items()
+                   if key not in ('tmp_dir', 'file_path', 'port')},
+        'commit': git_commit(),
+        'connect': dict(percentiles(merged['connect']) or {},
+                        clients=config['clients'],
+                        connected=connected,
+                        seconds=round(connect_seconds, 3),
+                        per_second=round(connected / connect_seconds, 1) if connect_seconds else None),
+        'chat': {
+            'sent': sent['chat'],
+            'sent_per_second': round(sent['chat'] / send_seconds, 1),
+            'delivered': len(merged['chat']),
+            'expected': expected,
+            'delivered_per_second': round(len(merged['chat']) / send_seconds, 1),
+            'latency': percentiles(merged['chat'])
+        },
+        'file': {'sent': sent['file'], 'upload': percentiles(merged['file'])},
+        'history': {'sent': sent['history'], 'latency': percentiles(merged['history'])},
+        'late_operations': sum(r['late'] for r in reports),
+        'disconnected': connected - sum(r['still_connected'] for r in reports)
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def report(results):
+    connect = results['connect']
+    chat = results['chat']
+    print(f"\nconnect   {connect['connected']}/{connect['clients']} clients in {connect['seconds']}s"
+          f" ({connect['per_second']}/s), p50 {connect.get('p50_ms')} ms, p99 {connect.get('p99_ms')} ms")
+    print(f"chat      {chat['sent']} sent ({chat['sent_per_second']}/s),"
+          f" {chat['delivered']}/{chat['expected']} delivered ({chat['delivered_per_second']}/s)")
+    for label, stats in (('latency', chat['latency']),
+                         ('file', results['file']['upload']),
+                         ('history', results['history']['latency'])):
+        if stats:
+            print(f"{label:<10}p50 {stats['p50_ms']} ms  p99 {stats['p99_ms']} ms"
+                  f"  p999 {stats['p999_ms']} ms  max {stats['max_ms']} ms  (n={stats['count']})")
+    print(f"late operations: {results['late_operations']}, disconnected: {results['disconnected']}")
+
+def compare(results, baseline):
+    """Print the change of the headline numbers against an earlier run"""
+    print(f"\nagainst {baseline.get('commit')}:")
+    rows = [
+        ('connect/s', ('connect', 'per_second')),
+        ('delivered/s', ('chat', 'delivered_per_second')),
+        ('chat p50 ms', ('chat', 'latency', 'p50_ms')),
+        ('chat p99 ms', ('chat', 'latency', 'p99_ms')),
+        ('chat p999 ms', ('chat', 'latency', 'p999_ms')),
+        ('history p99 ms', ('history', 'latency', 'p99_ms')),
+    ]
+    for label, path in rows:
+        old, new = baseline, results
+        for key in path:
+            old = (old or {}).get(key)
+            new = (new or {}).get(key)
+        if old and new:
+            print(f"  {label:<16}{old:>12} -> {new:<12} ({(new - old) / old:+.1%})")
+
+def raise_file_limit():
+    """Thousands of sockets need more than the usual 1024 descriptors"""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+def main():
+    parser = argparse.ArgumentParser(description='Server load benchmark')
+    parser.add_argument('--clients', '-c', type=int, default=1000)
+    parser.add_argument('--rate', '-r', type=float, default=50,
+                        help='Operations per second across all clients')
+    parser.add_argument('--duration', '-d', type=float, default=10, help='Seconds of load')
+    parser.add_argument('--mix', type=parse_mix, default='chat=90,file=5,history=5',
+                        help='Operation weights, e.g. chat=90,file=5,history=5')
+    parser.add_argument('--message-size', type=int, default=100, help='Chat message bytes')
+    parser.add_argument('--file-size', type=int, default=64 * 1024, help='Upload bytes')
+    parser.add_argument('--preload', type=int, default=10000,
+                        help='Messages in the database before the run')
+    parser.add_argument('--procs', type=int, default=min(4, os.cpu_count() or 1),
+                        help='Load generator processes')
+    parser.add_argument('--connect-concurrency', type=int, default=8,
+                        help='Connections opened at once per load process')
+    parser.add_argument('--drain', type=float, default=3,
+                        help='Seconds to wait for in-flight messages after the load')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads')
+    parser.add_argument('--server-arg', action='append', default=[],
+                        help='Extra server flag, e.g. --server-arg=--workers=process')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the temporary directory with the server and client logs')
+    parser.add_argument('--json', help='Write results to this file')
+    parser.add_argument('--baseline', help='Earlier results file to compare against')
+    args = parser.parse_args()
+
+    raise_file_limit()
+    with tempfile.TemporaryDirectory(prefix='bench_load_') as tmp_dir:
+        if args.keep:
+            tmp_dir = tempfile.mkdtemp(prefix='bench_load_')
+            print(f"Logs in {tmp_dir}")
+        cert_path = os.path.join(tmp_dir, 'server.pem')
+        db_path = os.path.join(tmp_dir, 'chat.db')
+        file_path = os.path.join(tmp_dir, 'upload.bin')
+        make_cert(cert_path)
+        preload_history(db_path, args.preload)
+        with open(file_path, 'wb') as f:
+            f.write(os.urandom(args.file_size))
+
+        port = free_port()
+        server_log = open(os.path.join(tmp_dir, 'server.log'), 'w')
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'app.server', '--engine', args.engine, '--port', str(port),
+             '--cert', cert_path, '--db', db_path,
+             '--blob-dir', os.path.join(tmp_dir, 'blobs')] + args.server_arg,
+            stdout=server_log, stderr=subprocess.STDOUT
+        )
+        try:
+            wait_for_port(port, server)
+            config = {
+                'clients': args.clients, 'rate': args.rate, 'duration': args.duration,
+                'mix': args.mix, 'message_size': args.message_size,
+                'file_size': args.file_size, 'preload': args.preload,
+                'procs': args.procs, 'connect_concurrency': args.connect_concurrency,
+                'drain': args.drain, 'engine': args.engine, 'server_args': args.server_arg,
+                'port': port, 'tmp_dir': tmp_dir, 'file_path': file_path
+            }
+            names = [f"bench{i}" for i in range(args.clients)]
+            connected = multiprocessing.Barrier(args.procs + 1)
+            started = multiprocessing.Barrier(args.procs + 1)
+            results = multiprocessing.Queue()
+            processes = [
+                multiprocessing.Process(target=load_process, args=(
+                    i, names[i::args.procs], config, connected, started, results))
+                for i in range(args.procs)
+            ]
+            for process in processes:
+                process.start()
+            print(f"Connecting {args.clients} clients...")
+            connected.wait()
+            # Let the presence updates of the connect phase settle
+            time.sleep(1)
+            print(f"Sending {args.rate:g} operations/s for {args.duration:g}s...")
+            started.wait()
+            reports = [results.get() for _ in processes]
+            for process in processes:
+                process.join()
+        finally:
+            server.terminate()
+            server.wait()
+            server_log.close()
+
+    results = summarize(config, reports)
+    report(results)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
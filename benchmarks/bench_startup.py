@@ -0,0 +1,95 @@
+"""Compare how long it takes to get a ready CryptoHandler in each key mode.
+
+    python -m benchmarks.bench_startup [--count N] [--json results.json]
+
+Modes:
+  generate  RSA.generate on every instantiation (the original behaviour)
+  keyring   load a stored identity from the encrypted keyring
+  pool      take a pre-generated keypair from a warm KeyPool
+  pool+ecdh pool keypair plus an EC key for ECDH sessions
+
+It also times the first (key-establishing) message of a session with RSA
+wrapping and with ECDH.
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+from app.crypto import CryptoHandler
+from app.keystore import KeyRing, KeyPool
+
+def timed(fn, count):
+    samples = []
+    for i in range(count):
+        start = time.perf_counter()
+        fn(i)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+def summarize(samples):
+    return {
+        'count': len(samples),
+        'mean_ms': round(statistics.mean(samples), 3),
+        'median_ms': round(statistics.median(samples), 3),
+        'max_ms': round(max(samples), 3)
+    }
+
+def wait_until_full(pool, size):
+    while pool.ready() < size:
+        time.sleep(0.05)
+
+def main():
+    parser = argparse.ArgumentParser(description='CryptoHandler startup benchmark')
+    parser.add_argument('--count', '-n', type=int, default=5,
+                        help='Instances created per mode')
+    parser.add_argument('--json', help='Write results to this file')
+    args = parser.parse_args()
+    count = args.count
+    results = {}
+    
+    results['generate'] = summarize(timed(lambda i: CryptoHandler(), count))
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'keyring.bin')
+        setup = KeyRing(path, 'benchmark')
+        for i in range(count):
+            setup.load_or_create(f"user{i}")
+        start = time.perf_counter()
+        keyring = KeyRing(path, 'benchmark')
+        results['keyring_unlock'] = summarize([(time.perf_counter() - start) * 1000])
+        results['keyring'] = summarize(timed(
+            lambda i: CryptoHandler.from_keyring(f"user{i}", keyring), count))
+    
+    pool = KeyPool(size=count)
+    wait_until_full(pool, count)
+    results['pool'] = summarize(timed(lambda i: CryptoHandler.from_pool(pool), count))
+    wait_until_full(pool, count)
+    results['pool+ecdh'] = summarize(timed(
+        lambda i: CryptoHandler.from_pool(pool, ecdh=True), count))
+    pool.close()
+    
+    # Cost of the first message of a session (key setup on both ends)
+    receiver = CryptoHandler(ecdh=True)
+    def handshake(pub_key):
+        def run(i):
+            sender = CryptoHandler(receiver.private_key)
+            receiver.decrypt_session(sender.encrypt_session("hello", pub_key))
+        return run
+    results['handshake_rsa'] = summarize(timed(handshake(receiver.public_key), count * 10))
+    results['handshake_ecdh'] = summarize(timed(handshake(receiver.ec_public_key), count * 10))
+    
+    baseline = results['generate']['mean_ms']
+    print(f"{'mode':<16}{'mean ms':>12}{'median ms':>12}{'max ms':>12}{'speedup':>10}")
+    for mode, stats in results.items():
+        speedup = '' if mode.startswith('handshake') else f"{baseline / stats['mean_ms']:.0f}x"
+        print(f"{mode:<16}{stats['mean_ms']:>12}{stats['median_ms']:>12}"
+              f"{stats['max_ms']:>12}{speedup:>10}")
+    
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()